@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+
+## bench.py -- Performance benchmarks for the runtime
+
+import sys, time
+from argparse import ArgumentParser
+
+benchmarks = []
+
+def benchmark(func):
+  benchmarks.append(func)
+  return func
+
+def timed(func, *args, **kwargs):
+  start = time.time()
+  rv = func(*args, **kwargs)
+  return (time.time() - start, rv)
+
+def report(name, *columns):
+  print "  %-28s %s" % (name, "  ".join(columns))
+
+def gen_source(forms, width):
+  "Generate a source file of forms, each a nested list of width elements."
+  out = []
+  for i in xrange(forms):
+    items = " ".join("(item-%d %d \"s%d\" '(a b))" % (j, j, j)
+                     for j in xrange(width))
+    out.append("(define data-%d '(%s))\n" % (i, items))
+  return "".join(out)
+
+@benchmark
+def reader():
+  "Parse throughput of load.load on large generated sources."
+  from load import load
+  for (forms, width) in ((5000, 4), (500, 50), (5, 5000)):
+    source = gen_source(forms, width)
+    (t, sexps) = timed(load, source)
+    mb = len(source) / (1024.0 * 1024.0)
+    report("%d forms x %d elements" % (forms, width),
+           "%8.0f forms/s" % (forms / t),
+           "%6.2f MB/s" % (mb / t),
+           "(%.2f MB in %.2fs)" % (mb, t))
+
+@benchmark
+def lexer():
+  "Tokenising throughput of lex.Scanner against the shlex based lex.Lexer."
+  from lex import Lexer, Scanner
+  source = gen_source(500, 50)
+  mb = len(source) / (1024.0 * 1024.0)
+  for cls in (Lexer, Scanner):
+    (t, count) = timed(lambda: sum(1 for token in cls(source)))
+    report(cls.__name__,
+           "%8.0f tokens/s" % (count / t),
+           "%6.2f MB/s" % (mb / t))
+
+@benchmark
+def startup():
+  "Cold starts of lolisp.py, and reading a large file, with and without the cache."
+  import os, subprocess, tempfile, cache
+  from load import load
+  here = os.path.dirname(os.path.abspath(__file__))
+  directory = tempfile.mkdtemp()
+  empty = os.path.join(directory, "empty.loli")
+  large = os.path.join(directory, "large.loli")
+  open(empty, "w").close()
+  with open(large, "w") as f:
+    f.write(gen_source(500, 50))
+  def start(env):
+    return subprocess.check_call([sys.executable, os.path.join(here, "lolisp.py"),
+                                  empty], env = env)
+  try:
+    uncached = dict(os.environ, LOLISP_NO_CACHE = "1")
+    cached = dict(os.environ)
+    cached.pop("LOLISP_NO_CACHE", None)
+    start(cached)
+    for (name, env) in (("without cache", uncached), ("with cache", cached)):
+      t = min(timed(start, env)[0] for i in xrange(5))
+      report("start " + name, "%.3fs" % t)
+    cache.read(large)
+    t = min(timed(lambda: load(file(large)))[0] for i in xrange(3))
+    tc = min(timed(cache.read, large)[0] for i in xrange(3))
+    report("read 500 forms x 50", "parse %.3fs" % t, "cache %.3fs" % tc,
+           "%.1fx" % (t / tc))
+  finally:
+    for name in (empty, large):
+      for path in (name, cache.cache_path(name)):
+        if os.path.exists(path):
+          os.unlink(path)
+    os.rmdir(directory)
+
+@benchmark
+def images():
+  "New runtimes by running rt.loli, restoring an image of one, and forking one."
+  import os, tempfile, image
+  from rt import RT
+  base = build_rt()
+  (fd, path) = tempfile.mkstemp(suffix = ".image")
+  os.close(fd)
+  try:
+    image.save(base, path)
+    n = 500
+    for (name, make) in (("rt.loli", build_rt),
+                         ("restore", lambda: image.restore(path)),
+                         ("fork", base.fork),
+                         ("bare RT()", RT)):
+      (t, rv) = timed(lambda: [make() for i in xrange(n)])
+      report(name, "%8.0f runtimes/s" % (n / t), "%6.3fms each" % (1000 * t / n))
+    report("image", "%d bytes" % os.path.getsize(path))
+  finally:
+    os.unlink(path)
+
+@benchmark
+def modules():
+  "Requiring the bundled libraries the first time, and again once loaded."
+  rt = build_rt()
+  for name in ("lists", "kanren"):
+    (t, rv) = timed(run_forms, rt, "(require \"%s\")" % name)
+    (t2, rv) = timed(run_forms, rt, "(require \"%s\")" % name)
+    (path, seconds) = rt.modules.stats()[-1]
+    report(name, "first %.2fms" % (1000 * t), "again %.2fms" % (1000 * t2),
+           "(loading %.2fms)" % (1000 * seconds))
+
+def build_rt(*files, **kwargs):
+  import os.path
+  from rt import RT
+  rt = RT(**kwargs)
+  for name in ("rt.loli",) + files:
+    rt.load_file(rt.ns, os.path.join(os.path.dirname(__file__), name))
+  return rt
+
+def run_forms(rt, source):
+  from load import load
+  rv = None
+  for form in load(source):
+    rv = rt.execute(rt.ns, form)
+  return rv
+
+fib = """
+   (defn fib (n) (cond ((< n 2) n) (else (+ (fib (- n 1)) (fib (- n 2))))))"""
+
+count_down = """
+   (defn count-down (n acc)
+     (let ((m (- n 1)))
+       (cond ((and (> n 0) (number? acc)) (count-down m (+ acc 1)))
+             (else acc))))"""
+
+call_programs = (
+  ("fib 16", fib + "(fib 16)"),
+  ("fib 20", fib + "(fib 20)"),
+  ("let/and loop", count_down + "(count-down 40 0)"),
+  ("kanren unify", """
+   (define l1 '(1 2 3 4 5 6 7 8))
+   (define l2 (list-of-vars 8))
+   (defn unify-n (n) (cond ((= n 0) true)
+                           (else (unify l1 l2 empty-subst) (unify-n (- n 1)))))
+   (unify-n 20)"""),
+)
+
+engines = (("walker", {"compiled": False}), ("compiled", {}),
+           ("bytecode", {"bytecode": True}), ("jit", {"jit": True}))
+
+@benchmark
+def calls():
+  "Function call heavy programs on each engine: walker, closures, bytecode and JIT."
+  prelude = """
+   (defn list-of-vars (n)
+     (cond ((= n 0) nil) (else (cons (var n) (list-of-vars (- n 1))))))"""
+  for (name, source) in call_programs:
+    times = []
+    for (engine, options) in engines:
+      rt = build_rt("kanren.loli", **options)
+      run_forms(rt, prelude)
+      times.append(timed(run_forms, rt, source)[0])
+    report(name, *["%s %.3fs" % (engine, t)
+                   for ((engine, options), t) in zip(engines, times)])
+
+@benchmark
+def lookup():
+  "Variable references one to six frames deep from a hot closure."
+  data = "(define big '(%s))" % " ".join(str(i) for i in xrange(900))
+  source = """
+   (let ((a 1)) (let ((b 2)) (let ((c 3)) (let ((d 4)) (let ((e 5))
+     (foldr (lambda (acc x) (+ acc a b c d e x)) 0 big))))))"""
+  for (engine, options) in engines:
+    rt = build_rt(**options)
+    run_forms(rt, data)
+    (t, rv) = timed(lambda: [run_forms(rt, source) for i in xrange(10)])
+    report(engine, "%8.0f calls/s" % (9000 / t))
+
+@benchmark
+def contention():
+  "Futures reading globals concurrently, against the same work run serially."
+  setup = """
+   (define g1 1) (define g2 2) (define g3 3)
+   (define data '(%s))
+   (defn work () (foldr (lambda (acc x) (+ acc g1 g2 g3 x)) 0 data))""" % \
+    " ".join(str(i) for i in xrange(500))
+  rt = build_rt()
+  run_forms(rt, setup)
+  for n in (1, 8, 32):
+    serial = "(list-of %s)" % " ".join(["(work)"] * n)
+    futures = "(map deref (list-of %s))" % " ".join(["(future (work))"] * n)
+    run_forms(rt, "(defn list-of (& xs) xs)")
+    (ts, rv) = timed(run_forms, rt, serial)
+    (tf, rv) = timed(run_forms, rt, futures)
+    report("%d readers" % n,
+           "serial %.3fs" % ts,
+           "futures %.3fs" % tf,
+           "%8.0f reads/s" % (n * 500 * 3 / tf))
+
+@benchmark
+def futures():
+  "Thousands of futures on the worker pool, and pmap against map."
+  import threading, workers
+  import lisptypes as types
+  rt = build_rt()
+  run_forms(rt, """
+   (defn work (x) (foldr (lambda (acc y) (+ acc y)) x '(1 2 3 4 5 6 7 8)))""")
+  for n in (100, 2000):
+    rt.define(types.mksymbol("xs"), types.py_to_type(range(n)))
+    before = threading.active_count()
+    (t, rv) = timed(run_forms, rt,
+                    "(map deref (map (lambda (x) (future (work x))) xs))")
+    report("%d futures" % n, "%8.0f futures/s" % (n / t),
+           "%d threads" % (threading.active_count() - before))
+    (tm, rv) = timed(run_forms, rt, "(map work xs)")
+    (tp, rv) = timed(run_forms, rt, "(pmap work xs)")
+    report("%d elements" % n, "map %.3fs" % tm, "pmap %.3fs" % tp)
+  stats = workers.shared().stats()
+  report("pool", "%d workers" % stats["workers"],
+         "max %d queued" % stats["max-queued"],
+         "wait %.2fms" % (stats["mean-wait"] * 1000),
+         "run %.2fms" % (stats["mean-run"] * 1000))
+
+@benchmark
+def cooperative():
+  "Sleeping futures as tasks on one thread's event loop, against threaded futures."
+  import threading, workers, coop
+  import lisptypes as types
+  from load import load
+  rt = build_rt()
+  run_forms(rt, """
+   (defn spawn-n (n acc)
+     (cond ((= n 0) acc)
+           (else (spawn-n (- n 1) (cons (future (sleep 0.05) 1) acc)))))
+   (defn sum-refs (refs acc)
+     (cond ((nil? refs) acc)
+           (else (sum-refs (cdr refs) (+ acc @(car refs))))))""")
+  forms = list(load("(sum-refs (spawn-n n nil) 0)"))
+  loop = coop.Loop(rt)
+  for n in (1000, 10000, 50000):
+    rt.define(types.mksymbol("n"), types.py_to_type(n))
+    before = rss()
+    (t, rv) = timed(loop.run, rt.ns, forms)
+    report("%d tasks" % n, "%8.0f tasks/s" % (n / t),
+           "%6.0f bytes/task" % (max(0, rss() - before) / float(n)))
+  workers.configure(64)
+  for n in (1000, 5000):
+    rt.define(types.mksymbol("n"), types.py_to_type(n))
+    before = threading.active_count()
+    (t, rv) = timed(run_forms, rt, "(sum-refs (spawn-n n nil) 0)")
+    report("%d threaded futures" % n, "%8.0f futures/s" % (n / t),
+           "%d threads" % (threading.active_count() - before))
+  workers.configure()
+
+@benchmark
+def processes():
+  "CPU-bound work on threads against worker processes, for 1 to CPUs + 1 processes."
+  import multiprocessing, processes
+  import lisptypes as types
+  rt = build_rt()
+  run_forms(rt, """
+   (defn fib (n) (cond ((< n 2) n) (else (+ (fib (- n 1)) (fib (- n 2))))))""")
+  tasks = 16
+  rt.define(types.mksymbol("xs"), types.py_to_type([15] * tasks))
+  (t, rv) = timed(run_forms, rt, "(map fib xs)")
+  report("serial", "%.3fs" % t, "%6.1f tasks/s" % (tasks / t))
+  (t, rv) = timed(run_forms, rt, "(pmap fib xs)")
+  report("threads", "%.3fs" % t, "%6.1f tasks/s" % (tasks / t))
+  for n in xrange(1, multiprocessing.cpu_count() + 2):
+    processes.configure(n)
+    run_forms(rt, "(ppmap fib '(1))")
+    (t, rv) = timed(run_forms, rt, "(ppmap fib xs)")
+    report("%d processes" % n, "%.3fs" % t, "%6.1f tasks/s" % (tasks / t))
+    (t, rv) = timed(run_forms, rt,
+                    "(map deref (map (lambda (x) (pfuture (fib x))) xs))")
+    report("", "pfuture %.3fs" % t, "%6.1f tasks/s" % (tasks / t))
+
+@benchmark
+def atoms():
+  "Concurrent swap! on one atom, and reads while a slow swap is running."
+  import threading
+  from primitives.concurrent import Atom
+  call = lambda func, args: func(*args)
+  for n in (1, 4, 16):
+    a = Atom(0)
+    def work():
+      for i in xrange(2000):
+        a.swap(call, lambda x: x + 1)
+    threads = [threading.Thread(target = work) for i in xrange(n)]
+    def run():
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+    (t, rv) = timed(run)
+    assert a.deref() == n * 2000
+    report("%d threads" % n, "%8.0f swaps/s" % (n * 2000 / t),
+           "%d retries" % a.retries)
+  a = Atom(0)
+  release = threading.Event()
+  slow = threading.Thread(target = a.swap,
+                          args = (call, lambda x: release.wait() and x + 1))
+  slow.start()
+  (t, rv) = timed(lambda: [a.deref() for i in xrange(100000)])
+  release.set()
+  slow.join()
+  report("reads during swap", "%8.0f reads/s" % (100000 / t))
+
+primitive_calls = (
+  ("+", "1 2"),
+  ("car", "'(1 2)"),
+  ("cdr", "'(1 2)"),
+  ("cons", "1 nil"),
+  ("=", "'a 'a"),
+  ("<", "1 2"),
+  ("atomic?", "nil"),
+  ("foldr", "+ 0 nil"),
+)
+
+@benchmark
+def primitives():
+  "Calls per second of single primitives, with literal and evaluated arguments."
+  from load import load
+  rt = build_rt()
+  n = 20000
+  for (name, args) in primitive_calls:
+    prim = rt.ns.lookup(name)
+    forms = list(load(args))
+    values = [rt.execute(rt.ns, form) for form in forms]
+    (ti, rv) = timed(lambda: [prim.invoke(rt.ns, list(forms)) for i in xrange(n)])
+    (ta, rv) = timed(lambda: [prim.apply(rt.ns, list(values)) for i in xrange(n)])
+    report("(%s %s)" % (name, args),
+           "invoke %8.0f calls/s" % (n / ti),
+           "apply %8.0f calls/s" % (n / ta))
+
+@benchmark
+def associative():
+  "Key lookups in an association list against a persistent hash map."
+  import lisptypes as types
+  rt = build_rt()
+  for n in (10, 100, 1000):
+    keys = [types.mksymbol("k%d" % i) for i in xrange(n)]
+    alist = types.mklist([types.cons(key, key) for key in keys])
+    hmap = types.mkmap((key, key) for key in keys)
+    assq = rt.ns.lookup("assq").apply
+    get = rt.ns.lookup("get").apply
+    (ta, rv) = timed(lambda: [assq(rt.ns, [key, alist]) for key in keys])
+    (tg, rv) = timed(lambda: [get(rt.ns, [hmap, key]) for key in keys])
+    report("%d keys" % n,
+           "assq %8.0f lookups/s" % (n / ta),
+           "get %8.0f lookups/s" % (n / tg))
+
+kanren_queries = (
+  ("appendo split 20", 21, """
+   (run (let ((a (var 'a)) (b (var 'b)))
+          (conj* (appendo a b (list-of %s)) (== vq (cons a b)))))""" %
+   " ".join(str(i) for i in xrange(20))),
+  ("appendo forward 50", 1, """
+   (run (appendo (list-of %s) '(end) vq))""" %
+   " ".join(str(i) for i in xrange(50))),
+  ("membero 50", 50, """
+   (run (membero vq (list-of %s)))""" % " ".join(str(i) for i in xrange(50))),
+  ("common-el 30", 15, """
+   (run (conj* (common-el (list-of %s) (list-of %s)) (== vq vx)))""" %
+   (" ".join(str(i) for i in xrange(30)),
+    " ".join(str(i) for i in xrange(0, 60, 2)))),
+  ("splits holding 3", 7, """
+   (run (let ((a (var 'a)) (b (var 'b)))
+          (conj* (appendo a b '(1 2 3 4 5 6 7 8 9)) (membero 3 a)
+                 (== vq a))))"""),
+  ("first split of 200", 1, """
+   (run 1 (let ((a (var 'a)) (b (var 'b)))
+            (conj* (appendo a b (list-of %s)) (== vq (cons a b)))))""" %
+   " ".join(str(i) for i in xrange(200))),
+  ("10 of unbounded appendo", 10, """
+   (run 10 (appendo vx vy vq))"""),
+)
+
+@benchmark
+def kanren():
+  "Classic relational queries on kanren.loli and the native logic engine."
+  rt = build_rt("kanren.loli")
+  run_forms(rt, "(defn list-of (& xs) xs)")
+  for (name, expected, source) in kanren_queries:
+    run_forms(rt, source)
+    (t, rv) = timed(lambda: [run_forms(rt, source) for i in xrange(10)])
+    assert len(list(rv[0])) == expected, (name, rv[0])
+    report(name, "%8.0f solutions/s" % (10 * expected / t),
+           "%8.0f queries/s" % (10 / t))
+
+def rss():
+  "The resident set size of this process in bytes."
+  import os, resource
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * resource.getpagesize()
+
+def bytes_per(n, make):
+  import gc
+  gc.collect()
+  before = rss()
+  objects = make()
+  gc.collect()
+  return (rss() - before) / float(n)
+
+@benchmark
+def memory():
+  "Bytes per cons cell and per symbol in a list of a million elements."
+  import lisptypes as types
+  n = 1000000
+  value = types.mksymbol("a")
+  names = ["s%d" % i for i in xrange(n)]
+  report("cons cell", "%6.1f bytes" %
+         bytes_per(n, lambda: types.mklist([value] * n)))
+  report("symbol", "%6.1f bytes" %
+         bytes_per(n, lambda: [types.mksymbol(name) for name in names]))
+  report("number", "%6.1f bytes" %
+         bytes_per(n, lambda: [types.py_to_type(1) for name in names]))
+
+if __name__ == "__main__":
+  arg_parser = ArgumentParser(description = "Run lolisp benchmarks")
+  arg_parser.add_argument("names", nargs = "*",
+                          help = "Benchmarks to run (default: all)")
+  args = arg_parser.parse_args()
+
+  for func in benchmarks:
+    if args.names and func.__name__ not in args.names:
+      continue
+    print "%s: %s" % (func.__name__, func.__doc__)
+    func()
@@ -0,0 +1,116 @@
+## cache.py -- Source files read once and cached on disk
+
+# Reading a source file means lexing and parsing all of it, which for
+# rt.loli is most of the time it takes to start. The forms read from
+# a file are kept next to it in a cache file (rt.loli in rt.lolic),
+# encoded as a wire opcode program and marshalled, which decodes far
+# faster than the source reads. The cache is used while the source's
+# mtime and size match those recorded in it, or, failing that, while
+# its SHA-1 hash does. A CRC-32 of the encoded forms catches caches
+# damaged since they were written, and any that still fail to decode
+# are read from source all the same.
+#
+# Cache files are written to a temporary file and renamed into place,
+# so a reader never sees half of one, and are mapped rather than read.
+# Setting $LOLISP_NO_CACHE turns the cache off, and one that can't be
+# written is silently done without.
+
+import os, marshal, mmap, struct, hashlib, tempfile, zlib
+from load import load
+from lex import Scanner
+import wire
+
+magic = "LOLC"
+version = 2
+# Magic, format version, the mtime, size and SHA-1 of the source, and
+# the CRC-32 of the encoded forms following the header.
+header = struct.Struct("<4sB3xdQ20sI")
+
+def enabled():
+  return not os.environ.get("LOLISP_NO_CACHE")
+
+def cache_path(path):
+  return path + "c"
+
+def encode(forms):
+  return marshal.dumps(wire.Encoder(None).encode(forms))
+
+def decode(data):
+  return wire.Decoder({}).decode(marshal.loads(data))
+
+def read_cache(path):
+  """
+  The header fields and encoded forms of the cache file for path, or
+  None if there isn't a readable one.
+  """
+  try:
+    f = open(cache_path(path), "rb")
+  except IOError:
+    return None
+  try:
+    data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+  except (ValueError, EnvironmentError):
+    f.close()
+    return None
+  try:
+    if len(data) < header.size:
+      return None
+    fields = header.unpack_from(data)
+    payload = data[header.size:]
+    if fields[:2] != (magic, version) or \
+          fields[-1] != zlib.crc32(payload) & 0xffffffff:
+      return None
+    return fields[2:-1] + (payload,)
+  finally:
+    data.close()
+    f.close()
+
+def write_cache(path, stat, digest, payload):
+  "Write the cache file for path, unless its directory isn't writable."
+  directory = os.path.dirname(os.path.abspath(path))
+  try:
+    (fd, temp) = tempfile.mkstemp(prefix = ".lolic", dir = directory)
+  except EnvironmentError:
+    return
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(header.pack(magic, version, stat.st_mtime, stat.st_size, digest,
+                          zlib.crc32(payload) & 0xffffffff))
+      f.write(payload)
+    # Readable by whoever can read the source, as .pyc files are.
+    os.chmod(temp, stat.st_mode & 0666)
+    os.rename(temp, cache_path(path))
+  except EnvironmentError:
+    try:
+      os.unlink(temp)
+    except EnvironmentError:
+      pass
+
+def read(path):
+  "The forms in the source file at path, as a list like load's."
+  if not enabled():
+    with open(path) as f:
+      return load(f)
+  stat = os.stat(path)
+  cached = read_cache(path)
+  if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+    try:
+      return decode(cached[3])
+    except Exception:
+      # Corrupt forms that passed the CRC can fail to decode in any
+      # number of ways, down to asking for enormous allocations.
+      cached = None
+  with open(path, "rb") as f:
+    source = f.read()
+  digest = hashlib.sha1(source).digest()
+  forms = None
+  if cached is not None and cached[2] == digest:
+    # Touched, but not changed.
+    try:
+      forms = decode(cached[3])
+    except Exception:
+      pass
+  if forms is None:
+    forms = load(source, lambda stream: Scanner(stream, path))
+  write_cache(path, stat, digest, encode(forms))
+  return forms
@@ -0,0 +1,344 @@
+## compiler.py -- Compiling s-expressions into Python closures
+
+import lisptypes as types
+from errors import LispException
+from scope import Frame, Params, params, bind
+
+special_forms = {}
+
+def special(name):
+  "Register a compiler for calls to the primitive called name."
+  def decorate(func):
+    special_forms[name] = func
+    return func
+  return decorate
+
+class TailCall(object):
+  """
+  Returned in place of a result by calls in tail position, for the
+  trampoline in Compiler.call to make without growing the stack.
+  """
+  __slots__ = ("func", "args")
+
+  def __init__(self, func, args):
+    self.func = func
+    self.args = args
+
+def constant(value):
+  return lambda scope: value
+
+class Env(object):
+  """
+  The static shape of the frames a form is compiled for: the slot index
+  of each local symbol, and the Env of the enclosing function. The
+  outermost Env's parent is the Scope holding the globals.
+  """
+
+  def __init__(self, index, parent):
+    self.index = index
+    self.parent = parent
+
+def scope_env(scope):
+  "The Env describing an existing chain of frames."
+  if scope.__class__ is Frame:
+    return Env(scope.index, scope_env(scope.parent))
+  return scope
+
+def resolve(env, symbol):
+  """
+  Find the (depth, slot) address of the local bound to symbol, or
+  (None, ns) with the global Scope if it is not a local.
+  """
+  depth = 0
+  while env.__class__ is Env:
+    i = env.index.get(symbol)
+    if i is not None:
+      return (depth, i)
+    env = env.parent
+    depth += 1
+  return (None, env)
+
+def is_literal(form):
+  "True if form evaluates to itself."
+  if types.is_collection(form):
+    return all(is_literal(el) for el in form.forms())
+  return not types.is_symbol(form) and (types.is_nil(form) or not types.is_list(form))
+
+def local_ref(depth, i):
+  if depth == 0:
+    return lambda scope: scope.slots[i]
+  if depth == 1:
+    return lambda scope: scope.parent.slots[i]
+  if depth == 2:
+    return lambda scope: scope.parent.parent.slots[i]
+  def ref(scope):
+    for n in xrange(depth):
+      scope = scope.parent
+    return scope.slots[i]
+  return ref
+
+def sequence(codes):
+  if not codes:
+    return constant(types.nil)
+  if len(codes) == 1:
+    return codes[0]
+  def run(scope):
+    for code in codes:
+      rv = code(scope)
+    return rv
+  return run
+
+class Compiler(object):
+  """
+  Turns forms into closures taking a scope, so a function body is
+  analysed once instead of on every call. Forms are compiled for an
+  Env, and the scope given to their code must be a frame of that
+  shape; local variables are then read straight from frame slots.
+
+  What a call site does depends on what its operator evaluates to,
+  which is only known at runtime: function calls evaluate their
+  compiled arguments, macro calls expand, and primitive calls are
+  specialised the first time each primitive is seen at the site.
+
+  Macro calls are expanded once per call site: the expansion is
+  compiled and cached with the macro it came from, and reused until the
+  operator evaluates to a different macro. macro_hits and macro_misses
+  count how often the cache was used.
+
+  Code compiled with tail set is in tail position of a function body.
+  Function calls there return a TailCall instead of calling, so only
+  code run through Compiler.call can be compiled that way.
+  """
+
+  def __init__(self, rt):
+    self.rt = rt
+    self.macro_hits = 0
+    self.macro_misses = 0
+
+  def compile(self, exp, env, tail = False):
+    if types.is_list(exp) and not types.is_nil(exp):
+      return self.compile_call(exp, env, tail)
+    elif types.is_symbol(exp):
+      return self.compile_symbol(exp, env)
+    elif types.is_collection(exp) and not is_literal(exp):
+      return self.compile_collection(exp, env)
+    else:
+      return constant(exp)
+
+  def compile_body(self, forms, env, tail = False):
+    forms = list(forms)
+    return sequence([self.compile(form, env, tail and i == len(forms) - 1)
+                     for (i, form) in enumerate(forms)])
+
+  def compile_symbol(self, symbol, env):
+    (depth, i) = resolve(env, symbol)
+    if depth is not None:
+      return local_ref(depth, i)
+
+    get = i.get
+    lookup = i.lookup
+    def global_ref(scope):
+      value = get(symbol)
+      if value is None:
+        value = lookup(symbol)
+        if value is None:
+          raise LispException("symbol \"%s\" is undefined" % symbol.value)
+      return value
+    return global_ref
+
+  def compile_collection(self, coll, env):
+    codes = coll.map_forms(lambda form: self.compile(form, env))
+    return lambda scope: codes.map_forms(lambda code: code(scope))
+
+  def compile_args(self, forms, env):
+    codes = [self.compile(form, env) for form in forms]
+    return lambda scope: [code(scope) for code in codes]
+
+  def compile_primitive(self, func, forms, env, tail):
+    if func.value in special_forms:
+      return special_forms[func.value](self, func, forms, env, tail)
+    if func.apply:
+      apply = func.apply
+      args = self.compile_args(forms, env)
+      return lambda scope: apply(scope, args(scope))
+    invoke = func.invoke
+    return lambda scope: invoke(scope, forms)
+
+  def compile_call(self, sexp, env, tail):
+    rt = self.rt
+    call_func = self.call
+    op = self.compile(sexp.car, env)
+    forms = list(sexp.cdr)
+    # Argument code is compiled on first use, since the arguments of
+    # primitives and macros are not necessarily expressions.
+    compiled = [None]
+    # The primitive or macro last seen at this site, and its specialised
+    # code or compiled expansion.
+    site = [(None, None)]
+
+    def call(scope):
+      func = op(scope)
+
+      if types.is_function(func):
+        args = compiled[0]
+        if args is None:
+          args = compiled[0] = self.compile_args(forms, env)
+        if tail:
+          return TailCall(func, args(scope))
+        return call_func(func, args(scope))
+
+      if types.is_primitive(func):
+        (prim, code) = site[0]
+        if prim is not func:
+          code = self.compile_primitive(func, forms, env, tail)
+          site[0] = (func, code)
+        return code(scope)
+
+      if types.is_macro(func):
+        (macro, code) = site[0]
+        if macro is func:
+          self.macro_hits += 1
+        else:
+          self.macro_misses += 1
+          code = self.compile(rt.invoke(scope, func, forms), env, tail)
+          site[0] = (func, code)
+        return code(scope)
+
+      raise LispException("%s is not callable" % repr(func), sexp)
+
+    return call
+
+  def run(self, func, frame):
+    """
+    Run the body of func in frame, compiling it on first use, and then
+    any tail calls it returns.
+    """
+    while True:
+      try:
+        code = func.code
+      except AttributeError:
+        code = self.compile_function(func)
+      rv = code(frame)
+      if rv.__class__ is not TailCall:
+        return rv
+      func = rv.func
+      frame = bind(func, rv.args)
+
+  def compile_function(self, func):
+    "Compile the body of func, keeping the code with it."
+    env = Env(params(func).index, scope_env(func.scope))
+    code = func.code = self.compile_body(func.value, env, True)
+    return code
+
+  def call(self, func, args):
+    "Call func with a list of evaluated args."
+    return self.run(func, bind(func, args))
+
+def check(compiler, prim, forms):
+  return compiler.rt.prims.parse_sig(None, prim.value, forms,
+                                     prim.signature, evaluated = True)
+
+def has_unquote(sexp):
+  if types.is_list(sexp) and not types.is_nil(sexp):
+    if types.is_symbol(sexp.car) and sexp.car.value in ("unquote", "unquote-splice"):
+      return True
+    return any(has_unquote(el) for el in sexp)
+  return False
+
+def compile_template(compiler, sexp, env):
+  "Compile a quoted form, evaluating its unquotes like Primitives._unquote."
+  if not has_unquote(sexp):
+    return constant(sexp)
+  if types.is_symbol(sexp.car) and sexp.car.value == "unquote":
+    return compiler.compile(sexp.cdr.car, env)
+
+  parts = []
+  for el in sexp:
+    if types.is_list(el) and not types.is_nil(el) and \
+          types.is_symbol(el.car) and el.car.value == "unquote-splice":
+      parts.append((True, compiler.compile(el.cdr.car, env)))
+    else:
+      parts.append((False, compile_template(compiler, el, env)))
+
+  def build(scope):
+    out = []
+    for (splice, code) in parts:
+      if splice:
+        out.extend(code(scope))
+      else:
+        out.append(code(scope))
+    return types.mklist(out)
+  return build
+
+@special("quote")
+def compile_quote(compiler, prim, forms, env, tail):
+  (sexp,) = check(compiler, prim, forms)
+  return compile_template(compiler, sexp, env)
+
+@special("cond")
+def compile_cond(compiler, prim, forms, env, tail):
+  for i in xrange(len(forms)):
+    sexp = forms[i]
+    if not types.is_list(sexp):
+      raise LispException("argument %d of cond must be list, is %s" %
+                          (i + 1, types.type_name(sexp)))
+    if types.is_nil(sexp) or types.is_nil(sexp.cdr):
+      raise LispException("argument %d of cond must have a length of >= 2" % (i + 1))
+
+  rules = [(compiler.compile(rule.car, env),
+            compiler.compile_body(rule.cdr, env, tail),
+            rule.car) for rule in forms]
+  true = types.true
+  false = types.false
+
+  def cond(scope):
+    for (test, body, form) in rules:
+      rv = test(scope)
+      if rv == true:
+        return body(scope)
+      if rv != false:
+        raise LispException("expr %s does not evaluate to a boolean" % repr(form))
+    return types.nil
+  return cond
+
+def compile_closure(compiler, prim, forms, env, make):
+  (sig, body) = check(compiler, prim, forms)
+  sig = list(sig)
+  for arg in sig:
+    if not types.is_symbol(arg):
+      raise LispException("argument 1 of lambda must be a list of symbols, found %s" % types.type_name(arg))
+  p = Params(sig)
+  code = compiler.compile_body(body, Env(p.index, env), True)
+  body = types.mklist(body)
+
+  def closure(scope):
+    func = make(sig, body, scope)
+    func.params = p
+    func.code = code
+    return func
+  return closure
+
+@special("lambda")
+def compile_lambda(compiler, prim, forms, env, tail):
+  return compile_closure(compiler, prim, forms, env, types.mkfunc)
+
+@special("macro")
+def compile_macro(compiler, prim, forms, env, tail):
+  return compile_closure(compiler, prim, forms, env, types.mkmacro)
+
+@special("define")
+def compile_define(compiler, prim, forms, env, tail):
+  (symbol, value) = check(compiler, prim, forms)
+  value = compiler.compile(value, env)
+  rt = compiler.rt
+  return lambda scope: rt.define(symbol, value(scope), scope)
+
+@special("recur")
+def compile_recur(compiler, prim, forms, env, tail):
+  # Unlike the tree walker, which rebinds the current frame, recur is
+  # compiled as a plain call, which is a loop when in tail position.
+  args = compiler.compile_args(forms, env)
+  if tail:
+    return lambda scope: TailCall(scope.callable, args(scope))
+  call = compiler.call
+  return lambda scope: call(scope.callable, args(scope))
@@ -0,0 +1,31 @@
+## conftest.py -- Helpers shared by the tests
+
+import sys, os.path
+from load import load
+from rt import RT
+
+def bootstrapped(*files, **engine):
+  """
+  A runtime on the engine selected by the keyword arguments, as for
+  rt.RT, with rt.loli loaded in it and then each of files.
+  """
+  rt = RT(**engine)
+  for name in ("rt.loli",) + files:
+    rt.load_file(rt.ns, os.path.join(os.path.dirname(__file__), name))
+  return rt
+
+def run(rt, source):
+  "Execute the forms in source in rt's namespace, returning the last value."
+  rv = None
+  for form in load(source):
+    rv = rt.execute(rt.ns, form)
+  return rv
+
+def with_recursion_limit(limit, func):
+  "Call func with Python's recursion limit set to limit."
+  old = sys.getrecursionlimit()
+  sys.setrecursionlimit(limit)
+  try:
+    return func()
+  finally:
+    sys.setrecursionlimit(old)
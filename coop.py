@@ -0,0 +1,390 @@
+## coop.py -- Cooperative tasks on an event loop
+
+# An alternative evaluator, for programs that spend their time waiting
+# rather than computing. Forms are evaluated by generators, one per
+# call, which yield the evaluations they need to a Task's trampoline
+# instead of calling them, so a task's whole evaluation can be set
+# aside at any point and resumed later. Inside a task, sleep and deref
+# suspend the task instead of blocking, and future starts another task
+# on the same loop instead of a thread, so one thread can hold tens of
+# thousands of them.
+#
+# Only code this evaluator runs can suspend. Lisp called back from a
+# primitive, a function passed to map say, is run to completion by the
+# runtime as usual, and a sleep there blocks the loop; a deref there of
+# a task's result runs the loop until it arrives.
+
+import heapq, itertools, threading, time
+from collections import deque
+import lisptypes as types
+from errors import LispException
+from compiler import TailCall
+from scope import bind
+from primitives.concurrent import Ref, realised, failed
+
+class Return(object):
+  "Yielded by an evaluation generator as its last act, with its result."
+  __slots__ = ("value",)
+
+  def __init__(self, value):
+    self.value = value
+
+class Sleep(object):
+  "Yielded to suspend the task for a number of seconds."
+  __slots__ = ("seconds",)
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+
+class Wait(object):
+  "Yielded to suspend the task until ref settles, or timeout seconds pass."
+  __slots__ = ("ref", "timeout", "default")
+
+  def __init__(self, ref, timeout = None, default = types.nil):
+    self.ref = ref
+    self.timeout = timeout
+    self.default = default
+
+def is_call(exp):
+  return exp.__class__ is types.ConsCell and exp is not types.nil
+
+handlers = {}
+
+def cooperative(name):
+  "Register an evaluator for calls to the primitive called name."
+  def decorate(func):
+    handlers[name] = func
+    return func
+  return decorate
+
+def evaluate(task, scope, exp, tail = False):
+  """
+  Evaluate exp in scope. In tail position, a call of a function is
+  returned as a TailCall for the enclosing call to make.
+  """
+  rt = task.rt
+  if not is_call(exp):
+    yield Return(rt.eval(scope, exp))
+    return
+  head = exp.car
+  func = (yield evaluate(task, scope, head)) if is_call(head) \
+      else rt.eval(scope, head)
+  forms = list(exp.cdr)
+
+  if types.is_primitive(func):
+    handler = handlers.get(func.value)
+    if handler is not None and rt.prims.get(func.value) is func:
+      yield Return((yield handler(task, scope, func, forms, tail)))
+      return
+    if func.apply is None:
+      yield Return(func.invoke(scope, forms))
+      return
+    args = []
+    for form in forms:
+      args.append((yield evaluate(task, scope, form)) if is_call(form)
+                  else rt.eval(scope, form))
+    yield Return(func.apply(scope, args))
+    return
+
+  if types.is_macro(func):
+    expansion = rt.invoke(scope, func, forms)
+    yield Return((yield evaluate(task, scope, expansion, tail)))
+    return
+
+  if types.is_function(func):
+    args = []
+    for form in forms:
+      args.append((yield evaluate(task, scope, form)) if is_call(form)
+                  else rt.eval(scope, form))
+    if tail:
+      yield Return(TailCall(func, args))
+    else:
+      yield Return((yield call(task, func, args)))
+    return
+
+  raise LispException("%s is not callable" % repr(func), exp)
+
+def body(task, scope, forms, tail = False):
+  "Evaluate forms in turn, returning the value of the last."
+  rt = task.rt
+  rv = types.nil
+  last = len(forms) - 1
+  for (i, form) in enumerate(forms):
+    rv = (yield evaluate(task, scope, form, tail and i == last)) \
+        if is_call(form) else rt.eval(scope, form)
+  yield Return(rv)
+
+def call(task, func, args):
+  "Call func, and then the tail calls it returns."
+  while True:
+    rv = yield body(task, bind(func, list(args)), list(func.value), True)
+    if rv.__class__ is not TailCall:
+      yield Return(rv)
+      return
+    (func, args) = (rv.func, rv.args)
+
+def evaluate_args(task, scope, prim, forms):
+  check = task.rt.prims.parse_sig
+  args = []
+  for form in forms:
+    args.append((yield evaluate(task, scope, form)) if is_call(form)
+                else task.rt.eval(scope, form))
+  yield Return(check(scope, prim.value, args, prim.signature, evaluated = True))
+
+@cooperative("cond")
+def cond(task, scope, prim, forms, tail):
+  for (i, sexp) in enumerate(forms):
+    if not types.is_list(sexp):
+      raise LispException("argument %d of cond must be list, is %s" %
+                          (i + 1, types.type_name(sexp)))
+    if types.is_nil(sexp) or types.is_nil(sexp.cdr):
+      raise LispException("argument %d of cond must have a length of >= 2" % (i + 1))
+  for rule in forms:
+    test = (yield evaluate(task, scope, rule.car)) if is_call(rule.car) \
+        else task.rt.eval(scope, rule.car)
+    if test is types.true:
+      yield Return((yield body(task, scope, list(rule.cdr), tail)))
+      return
+    if test is not types.false:
+      raise LispException("expr %s does not evaluate to a boolean" % repr(rule.car))
+  yield Return(types.nil)
+
+@cooperative("define")
+def define(task, scope, prim, forms, tail):
+  (symbol, form) = task.rt.prims.parse_sig(scope, prim.value, forms,
+                                           prim.signature, evaluated = True)
+  value = yield evaluate(task, scope, form)
+  yield Return(task.rt.define(symbol, value, scope))
+
+@cooperative("recur")
+def recur(task, scope, prim, forms, tail):
+  args = yield evaluate_args(task, scope, prim, forms)
+  if tail:
+    yield Return(TailCall(scope.callable, args))
+  else:
+    yield Return((yield call(task, scope.callable, args)))
+
+@cooperative("sleep")
+def sleep(task, scope, prim, forms, tail):
+  (seconds,) = yield evaluate_args(task, scope, prim, forms)
+  yield Sleep(float(seconds.value))
+  yield Return(types.nil)
+
+@cooperative("deref")
+def deref(task, scope, prim, forms, tail):
+  args = []
+  for form in forms:
+    args.append((yield evaluate(task, scope, form)) if is_call(form)
+                else task.rt.eval(scope, form))
+  if len(args) == 1 and args[0].__class__ is Ref:
+    yield Return((yield Wait(args[0])))
+  elif len(args) == 3 and args[0].__class__ is Ref and types.is_number(args[1]):
+    yield Return((yield Wait(args[0], float(args[1].value), args[2])))
+  else:
+    yield Return(prim.apply(scope, args))
+
+@cooperative("future")
+def future(task, scope, prim, forms, tail):
+  (forms,) = task.rt.prims.parse_sig(scope, prim.value, forms, prim.signature,
+                                     evaluated = True)
+  yield Return(task.loop.spawn(scope, forms))
+
+class Task(object):
+  """
+  An evaluation on a Loop: a stack of evaluation generators, the
+  innermost of which is running. Its result is delivered to ref.
+  """
+
+  def __init__(self, loop, evaluation):
+    self.loop = loop
+    self.rt = loop.rt
+    self.stack = [evaluation]
+    self.ref = Ref(task = self)
+    self.started = False
+    self.cancelled = False
+    # What to resume the innermost generator with.
+    self.value = None
+    self.error = None
+    # The wait the task is suspended in, so a wakeup from a wait that
+    # has already ended, by timing out say, can be told apart, and
+    # whether it's waiting on a ref from outside the loop.
+    self.waiting = None
+    self.external = False
+
+  def step(self):
+    """
+    Run the task until it finishes or suspends, returning the Sleep or
+    Wait it suspended on, or None if it finished.
+    """
+    self.started = True
+    stack = self.stack
+    (value, error) = (self.value, self.error)
+    (self.value, self.error) = (None, None)
+    while stack:
+      gen = stack[-1]
+      try:
+        if error is not None:
+          (e, error) = (error, None)
+          item = gen.throw(e)
+        else:
+          item = gen.send(value)
+      except StopIteration:
+        stack.pop()
+        value = types.nil
+        continue
+      except Exception as e:
+        stack.pop()
+        (value, error) = (None, e)
+        continue
+      cls = item.__class__
+      if cls is Return:
+        stack.pop()
+        value = item.value
+      elif cls is Sleep or cls is Wait:
+        return item
+      else:
+        stack.append(item)
+        value = None
+    if error is not None:
+      self.ref.fail(error)
+    else:
+      self.ref.realise(value)
+    return None
+
+  def resume(self, token, value = None, error = None):
+    "Resume the task from the wait token, unless it has ended already."
+    if self.waiting is not token:
+      return
+    self.waiting = None
+    if self.external:
+      self.external = False
+      self.loop.external -= 1
+    (self.value, self.error) = (value, error)
+    self.loop.ready.append(self)
+
+  def cancel(self):
+    if self.started:
+      return False
+    self.cancelled = True
+    return True
+
+  def run(self):
+    """
+    Called by Ref.deref from code the loop isn't suspending: runs the
+    loop until the task is done, if this is the loop's thread.
+    """
+    if self.loop.thread is threading.current_thread():
+      self.loop.run_until(self.ref)
+
+class Loop(object):
+  """
+  Runs Tasks on one thread, each until it finishes or suspends, and
+  resumes them when what they wait for arrives.
+  """
+
+  def __init__(self, rt):
+    self.rt = rt
+    self.ready = deque()
+    self.timers = []
+    self.sequence = itertools.count()
+    self.condition = threading.Condition()
+    self.incoming = deque()
+    # Tasks waiting on refs this loop won't settle itself: futures on
+    # other threads, pfutures, or promises.
+    self.external = 0
+    self.thread = None
+    self.spawned = 0
+    self.switches = 0
+
+  def spawn(self, scope, forms):
+    "Start a task evaluating forms in scope, returning the Ref of its result."
+    task = Task(self, None)
+    task.stack[0] = body(task, scope, list(forms))
+    self.ready.append(task)
+    self.spawned += 1
+    return task.ref
+
+  def call_soon_threadsafe(self, func):
+    "Call func on the loop's thread, from any thread."
+    with self.condition:
+      self.incoming.append(func)
+      self.condition.notify()
+
+  def suspend(self, task, request):
+    token = task.waiting = object()
+    if request.__class__ is Sleep:
+      self.at(time.time() + request.seconds, task, token, types.nil)
+      return
+    ref = request.ref
+    if request.timeout is not None:
+      self.at(time.time() + request.timeout, task, token, request.default)
+    if not (isinstance(ref.task, Task) and ref.task.loop is self):
+      task.external = True
+      self.external += 1
+    def settled(ref):
+      def wake():
+        if ref.state is realised:
+          task.resume(token, ref.refval)
+        elif ref.state is failed:
+          task.resume(token, error = ref.refval)
+        else:
+          task.resume(token, error = LispException("can't deref a cancelled ref"))
+      self.call_soon_threadsafe(wake)
+    ref.on_settle(settled)
+
+  def at(self, when, task, token, value):
+    heapq.heappush(self.timers, (when, next(self.sequence), task, token, value))
+
+  def run_once(self, patient = False):
+    """
+    Run every task that is ready, or else wait for one to be. With
+    nothing ready, sleeping or waiting on another thread the loop is
+    deadlocked, unless it is patient: waiting for work posted with
+    call_soon_threadsafe.
+    """
+    with self.condition:
+      while self.incoming:
+        self.incoming.popleft()()
+    now = time.time()
+    while self.timers and self.timers[0][0] <= now:
+      (when, n, task, token, value) = heapq.heappop(self.timers)
+      task.resume(token, value)
+    if self.ready:
+      for i in xrange(len(self.ready)):
+        task = self.ready.popleft()
+        if task.cancelled:
+          continue
+        self.switches += 1
+        request = task.step()
+        if request is not None:
+          self.suspend(task, request)
+      return
+    timeout = self.timers[0][0] - now if self.timers else None
+    if timeout is None and not self.external and not patient:
+      raise LispException("every task is waiting on another: deadlock")
+    with self.condition:
+      if not self.incoming:
+        self.condition.wait(timeout)
+
+  def run_until(self, ref):
+    """
+    Run the loop until ref settles, and return its value. A ref that
+    isn't a task's here, a promise say, may be waited on indefinitely.
+    """
+    patient = not (isinstance(ref.task, Task) and ref.task.loop is self)
+    (outer, self.thread) = (self.thread, threading.current_thread())
+    try:
+      while not ref.realised():
+        self.run_once(patient)
+    finally:
+      self.thread = outer
+    return ref.deref()
+
+  def run(self, scope, forms):
+    "Evaluate forms as a task, running the loop until it finishes."
+    return self.run_until(self.spawn(scope, forms))
+
+  def stats(self):
+    return {"spawned": self.spawned, "switches": self.switches,
+            "ready": len(self.ready), "sleeping": len(self.timers),
+            "external": self.external}
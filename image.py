@@ -0,0 +1,220 @@
+## image.py -- Saving a runtime's definitions, and starting new runtimes from them
+
+# A new runtime has to make its primitives and run all of rt.loli
+# before it can do anything. An image is the global definitions of a
+# runtime that has done that (and whatever else), saved to a file by
+# save, from which restore makes a new runtime without running any
+# Lisp. Images are encoded as wire messages are, so functions, macros
+# and closures are saved with the variables they close over, and
+# primitives by name, to be bound to those of the restoring runtime.
+#
+# Within one process, fork copies a runtime's definitions to a new
+# runtime directly, leaving the original as it was, which makes it
+# cheap to keep one bootstrapped runtime as a base to fork others off.
+# Functions and the frames they close over are copied, to close over
+# the new runtime's namespace instead, wherever they are found: in
+# lists and collections, and in the frames and thunks of delays, which
+# are copied along with them. Atoms are copied too, with their current
+# values, validators and watches, so a fork's state is its own.
+# Everything else is immutable and shared, but for refs, which belong
+# to the tasks completing them, and the streams of the logic engine,
+# whose thunks are Python closures.
+# A fork has the modules its base has loaded, with their namespaces
+# copied; a restored runtime has none loaded, as images don't record
+# modules, and loads them again if they're required.
+
+import os, marshal, tempfile
+import lisptypes as types
+from errors import LispException
+from scope import Scope, Namespace, Frame
+from primitives.lazy import Delay, Thunk
+from primitives.concurrent import Atom
+import wire
+from modules import Module
+
+magic = "LOLI"
+version = 1
+
+def save(rt, path):
+  "Save the global definitions of rt to an image file at path."
+  encoder = wire.Encoder(wire.Standard(rt.ns))
+  definitions = []
+  for (symbol, value) in sorted(rt.ns.items()):
+    if value is rt.prims.get(symbol.value):
+      continue
+    try:
+      definitions.append((symbol.value, encoder.encode(value)))
+    except LispException as e:
+      raise LispException("can't save %s in an image: %s" % (symbol.value, e))
+  data = marshal.dumps((magic, version, encoder.functions, definitions))
+  (fd, temp) = tempfile.mkstemp(prefix = ".loli",
+                                dir = os.path.dirname(os.path.abspath(path)))
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    os.rename(temp, path)
+  except:
+    os.unlink(temp)
+    raise
+
+def restore(path, **engine):
+  """
+  A new runtime with the definitions saved in the image at path, on the
+  engine selected by the keyword arguments, as for rt.RT. No modules
+  are loaded in it yet.
+  """
+  from rt import RT
+  with open(path, "rb") as f:
+    try:
+      image = marshal.load(f)
+    except (ValueError, EOFError, TypeError):
+      image = None
+  if not (isinstance(image, tuple) and image[:2] == (magic, version)):
+    raise LispException("%s is not a lolisp image" % path)
+  (functions, definitions) = image[2:]
+  rt = RT(**engine)
+  wire.define(wire.Decoder(rt.prims), functions, definitions, rt.ns)
+  return rt
+
+class Copier(object):
+  "Copies of functions and scopes of one runtime, for another."
+
+  def __init__(self, base, rt):
+    self.base = base
+    self.rt = rt
+    self.copies = { id(base.ns): rt.ns }
+
+  def value(self, value):
+    "A copy of value for the new runtime, or value itself if it will do."
+    cls = value.__class__
+    if cls is types.Primitive:
+      if self.base.prims.get(value.value) is value:
+        return self.rt.prims[value.value]
+      return value
+    if cls is types.ConsCell:
+      return value if value is types.nil else self.copy(value, self.list)
+    if cls is types.Function or cls is types.Macro:
+      return self.copy(value, self.function)
+    if types.is_collection(value):
+      return self.copy(value, self.collection)
+    if isinstance(value, Delay):
+      return self.copy(value, self.delay)
+    if cls is Atom:
+      return self.copy(value, self.atom)
+    return value
+
+  def copy(self, value, make):
+    copy = self.copies.get(id(value))
+    if copy is None:
+      copy = make(value)
+    return copy
+
+  def function(self, func):
+    copy = self.copies[id(func)] = func.__class__(func.value, func.sig)
+    try:
+      copy.params = func.params
+    except AttributeError:
+      pass
+    copy.scope = self.scope(func.scope)
+    return copy
+
+  def list(self, l):
+    items = []
+    tail = l
+    while tail.__class__ is types.ConsCell and tail is not types.nil:
+      items.append(tail.car)
+      tail = tail.cdr
+    copies = [self.value(item) for item in items]
+    end = self.value(tail)
+    if end is tail and all(a is b for (a, b) in zip(copies, items)):
+      copy = l
+    else:
+      out = types.ListBuilder()
+      for item in copies:
+        out.append(item)
+      copy = out.build(end)
+    self.copies[id(l)] = copy
+    return copy
+
+  def collection(self, coll):
+    if all(self.value(form) is form for form in list(coll.forms())):
+      copy = coll
+    else:
+      copy = coll.map_forms(self.value)
+    self.copies[id(coll)] = copy
+    return copy
+
+  def delay(self, d):
+    with d.lock:
+      (thunk, value) = (d.thunk, d.value)
+    if thunk is not None and thunk.__class__ is not Thunk:
+      self.copies[id(d)] = d
+      return d
+    copy = self.copies[id(d)] = d.__class__(None)
+    if thunk is None:
+      copy.thunk = None
+      copy.value = self.value(value)
+    else:
+      copy.thunk = Thunk(self.rt, self.scope(thunk.scope), thunk.forms)
+    return copy
+
+  def atom(self, a):
+    with a.lock:
+      (value, validator, watches) = (a.atom, a.validator, a.watches)
+    copy = self.copies[id(a)] = Atom(None)
+    copy.atom = self.value(value)
+    copy.validator = None if validator is None else self.value(validator)
+    for (key, func) in watches.items():
+      copy.watches = copy.watches.assoc(self.value(key), self.value(func))
+    return copy
+
+  def module(self, module):
+    copy = self.copies.get(id(module))
+    if copy is None:
+      copy = self.copies[id(module)] = Module(module.path)
+      copy.exports = module.exports
+      copy.seconds = module.seconds
+    return copy
+
+  def scope(self, scope):
+    copy = self.copies.get(id(scope))
+    if copy is not None:
+      return copy
+    if scope.__class__ is Frame:
+      copy = self.copies[id(scope)] = Frame(None, None, scope.index, None)
+      copy.callable = self.value(scope.callable)
+      copy.parent = self.scope(scope.parent)
+      copy.slots = [self.value(slot) for slot in scope.slots]
+      return copy
+    if scope is None or scope.parent is None:
+      # Another runtime's namespace, which stays as it is.
+      return scope
+    if scope.__class__ is Namespace:
+      module = self.module(scope.module)
+      copy = module.ns = Namespace(module, None)
+    else:
+      copy = Scope(parent = None)
+    self.copies[id(scope)] = copy
+    copy.callable = self.value(scope.callable)
+    copy.parent = self.scope(scope.parent)
+    for (symbol, value) in scope.items():
+      copy[symbol] = self.value(value)
+    return copy
+
+def fork(base, **engine):
+  """
+  A new runtime with a copy of the definitions of base, on the engine
+  selected by the keyword arguments, or on base's if there are none.
+  """
+  from rt import RT
+  rt = RT(**(engine or base.engine()))
+  copier = Copier(base, rt)
+  for (symbol, value) in base.ns.items():
+    copy = copier.value(value)
+    if rt.ns.get(symbol) is not copy:
+      rt.ns.define(symbol, copy)
+  rt.modules.path = list(base.modules.path)
+  for module in base.modules.loaded():
+    copier.scope(module.ns)
+    rt.modules.add(copier.module(module))
+  return rt
@@ -0,0 +1,482 @@
+## jit.py -- Translating hot functions to Python
+
+# Code from the closure compiler still pays for a Python call per form,
+# and for checking the signature of every primitive it calls. The JIT
+# counts the calls of each function, and once one has been called
+# threshold times translates its body to the source of a Python
+# function, which Python compiles once. Parameters become Python
+# locals, cond becomes if and elif, a tail call of the function itself
+# becomes a loop, immediately applied lambdas (let) become assignments,
+# and the commonest primitives are inlined behind type tests that fall
+# back to calling the primitive.
+#
+# Global definitions are looked up once, when translating, and the
+# function is deoptimised, going back to the closure compiler to be
+# counted again, as soon as one of the definitions it used changes
+# (see Scope.watch). Functions with forms it doesn't translate, lambdas
+# or definitions for instance, stay with the closure compiler.
+
+import weakref
+import lisptypes as types
+from errors import LispException
+from compiler import Compiler, TailCall, is_literal, check, has_unquote
+from scope import Frame, params, bind
+
+class Unsupported(Exception):
+  "Raised by a Translator for a form it won't translate."
+
+def not_boolean(form):
+  raise LispException("expr %s does not evaluate to a boolean" % repr(form))
+
+number_test = "{0}.__class__ is Number and {1}.__class__ is Number"
+
+def arithmetic(op):
+  # Numbers of the same class need no promotion first, so only those
+  # are computed here; the primitive sorts out the rest.
+  return (2, "(Number({0}.value %s {1}.value) if %s and "
+          "{0}.value.__class__ is {1}.value.__class__ else {p}(frame, [{0}, {1}]))"
+          % (op, number_test), None)
+
+def comparison(op):
+  return (2, "((true if {0}.value %s {1}.value else false) if %s "
+          "else {p}(frame, [{0}, {1}]))" % (op, number_test),
+          "({0}.value %s {1}.value if %s else {p}(frame, [{0}, {1}]) is true)"
+          % (op, number_test))
+
+def accessor(field):
+  return (1, "({0}.%s if {0}.__class__ is ConsCell and {0} is not nil "
+          "else {p}(frame, [{0}]))" % field, None)
+
+# The primitives inlined, by name: how many arguments they take, the
+# Python expression of their value, and of its truth where there is a
+# quicker way to it. {0} and {1} are the arguments, and {p} the
+# primitive's apply, to fall back on.
+inline = {
+  "=": (2, "(true if {0} is {1} or {0} == {1} else false)", "({0} is {1} or {0} == {1})"),
+  "cons": (2, "cons({0}, {1})", None),
+  "car": accessor("car"),
+  "cdr": accessor("cdr"),
+  "+": arithmetic("+"),
+  "-": arithmetic("-"),
+  "*": arithmetic("*"),
+  "rem": arithmetic("%"),
+  "<": comparison("<"),
+  "<=": comparison("<="),
+  ">": comparison(">"),
+  ">=": comparison(">="),
+}
+
+class Translator(object):
+  """
+  Translates the body of a function to the source of a Python function
+  of its frame. Every expression is reduced to an atom, a local, a
+  constant or a frame slot, with statements computing the parts that
+  aren't, so evaluation order is the order of the statements.
+  """
+
+  def __init__(self, jit, func):
+    self.rt = jit.rt
+    self.func = func
+    self.params = params(func)
+    self.names = dict((name, "v%d" % i) for (i, name) in enumerate(self.params.names))
+    # The locals of the lets being translated, innermost last.
+    self.lets = []
+    self.consts = []
+    self.const_names = {}
+    # The definitions read from global scopes, as (scope, symbol, value),
+    # with a value of None where the symbol is looked for but not found.
+    self.deps = []
+    self.lines = []
+    self.depth = 3
+    self.temps = 0
+    self.uses_frame = False
+    self.ns = func.scope
+    while self.ns.__class__ is Frame:
+      self.ns = self.ns.parent
+
+  def emit(self, line):
+    if self.depth > 80:
+      raise Unsupported("nested too deeply")
+    self.lines.append("  " * self.depth + line)
+
+  def const(self, value):
+    name = self.const_names.get(id(value))
+    if name is None:
+      name = self.const_names[id(value)] = "k%d" % len(self.consts)
+      self.consts.append(value)
+    return name
+
+  def temp(self):
+    self.temps += 1
+    return "t%d" % self.temps
+
+  def lookup(self, symbol):
+    """
+    Where symbol is bound: ("local", expression reading it) for locals,
+    or ("global", value) for global definitions.
+    """
+    for let in reversed(self.lets):
+      if symbol in let:
+        return ("local", let[symbol])
+    if symbol in self.names:
+      return ("local", self.names[symbol])
+    (scope, ref) = (self.func.scope, "frame.parent")
+    while scope.__class__ is Frame:
+      i = scope.index.get(symbol)
+      if i is not None:
+        return ("local", "%s.slots[%d]" % (ref, i))
+      (scope, ref) = (scope.parent, ref + ".parent")
+    while scope is not None:
+      value = scope.get(symbol)
+      self.deps.append((scope, symbol, value))
+      if value is not None:
+        return ("global", value)
+      scope = scope.parent
+    raise Unsupported("%s is undefined" % symbol.value)
+
+  def translate(self):
+    self.sequence(list(self.func.value), None)
+    names = ["k%d" % i for i in xrange(len(self.consts))]
+    slots = ["v%d" % i for i in xrange(len(self.params.names))]
+    lines = ["def make(k):"]
+    if names:
+      lines.append("  (%s,) = k" % ", ".join(names))
+    lines.append("  def native(frame):")
+    if slots:
+      lines.append("    (%s,) = frame.slots" % ", ".join(slots))
+    lines.append("    while True:")
+    for line in self.lines:
+      if line.__class__ is tuple:
+        # A new frame for each time round a loop, for the code that
+        # reads locals from it: a delay or a future made on an earlier
+        # iteration keeps the frame it was made with.
+        if not self.uses_frame:
+          continue
+        line = "%sframe = Frame(frame.callable, frame.parent, frame.index, [%s])" % \
+            (line[0], ", ".join(slots))
+      lines.append(line)
+    lines.append("  return native")
+    return "\n".join(lines) + "\n"
+
+  def result(self, target, expression):
+    if target is None:
+      self.emit("return %s" % expression)
+    else:
+      self.emit("%s = %s" % (target, expression))
+
+  def sequence(self, forms, target):
+    if not forms:
+      self.result(target, self.const(types.nil))
+    for form in forms[:-1]:
+      self.expr(form)
+    if forms:
+      self.into(forms[-1], target)
+
+  def expr(self, form):
+    "The atom holding the value of form, after any statements computing it."
+    if form.__class__ is types.ConsCell and form is not types.nil:
+      target = self.temp()
+      self.into(form, target)
+      return target
+    if form.__class__ is types.Symbol:
+      (kind, value) = self.lookup(form)
+      return value if kind == "local" else self.const(value)
+    if types.is_collection(form) and not is_literal(form):
+      raise Unsupported("collection")
+    return self.const(form)
+
+  def into(self, form, target):
+    """
+    Translate form, assigning its value to target, or returning it if
+    target is None, form then being in tail position.
+    """
+    if form.__class__ is not types.ConsCell or form is types.nil:
+      self.result(target, self.expr(form))
+      return
+    (head, forms) = (form.car, list(form.cdr))
+    if head.__class__ is types.ConsCell and self.is_lambda(head):
+      self.let(head, forms, target)
+      return
+    if head.__class__ is not types.Symbol:
+      self.dynamic(form, self.expr(head), forms, target)
+      return
+    (kind, value) = self.lookup(head)
+    if kind == "local":
+      self.dynamic(form, value, forms, target)
+    elif types.is_primitive(value):
+      self.primitive(form, value, forms, target)
+    elif types.is_macro(value):
+      self.into(self.rt.invoke(self.ns, value, forms), target)
+    elif types.is_function(value):
+      self.call(value, forms, target)
+    else:
+      self.dynamic(form, self.const(value), forms, target)
+
+  def call(self, func, forms, target):
+    args = [self.expr(form) for form in forms]
+    p = self.params
+    if target is None and func is self.func and p.rest < 0 and len(args) == p.arity:
+      if args:
+        self.emit("(%s,) = (%s,)" % (", ".join(self.names[name] for name in p.names),
+                                     ", ".join(args)))
+        self.lines.append(("  " * self.depth,))
+      self.emit("continue")
+    elif target is None:
+      self.emit("return TailCall(%s, [%s])" % (self.const(func), ", ".join(args)))
+    else:
+      self.emit("%s = call(%s, [%s])" % (target, self.const(func), ", ".join(args)))
+
+  def primitive(self, form, prim, forms, target):
+    name = prim.value
+    if self.rt.prims.get(name) is not prim:
+      name = None
+    if name == "cond":
+      self.cond(forms, target)
+    elif name == "quote":
+      (sexp,) = check(self, prim, forms)
+      if has_unquote(sexp):
+        raise Unsupported("quasiquote")
+      self.result(target, self.const(sexp))
+    elif name == "recur":
+      if self.lets:
+        raise Unsupported("recur in let")
+      self.call(self.func, forms, target)
+    elif name in ("eval", "lambda", "macro", "define"):
+      raise Unsupported(name)
+    elif name in inline and len(forms) == inline[name][0]:
+      args = [self.expr(f) for f in forms]
+      self.result(target, inline[name][1].format(*args, p = self.const(prim.apply)))
+    elif prim.apply is not None:
+      args = [self.expr(f) for f in forms]
+      self.result(target, "%s(frame, [%s])" % (self.const(prim.apply), ", ".join(args)))
+    else:
+      if self.lets:
+        raise Unsupported("%s in let" % prim.value)
+      self.uses_frame = True
+      self.result(target, "%s(frame, %s)" % (self.const(prim.invoke), self.const(forms)))
+
+  def condition(self, form):
+    "A Python expression of the truth of form, raising if it isn't a boolean."
+    if form.__class__ is types.ConsCell and form is not types.nil and \
+          form.car.__class__ is types.Symbol:
+      (kind, prim) = self.lookup(form.car)
+      forms = list(form.cdr)
+      if kind == "global" and types.is_primitive(prim) and \
+            self.rt.prims.get(prim.value) is prim and prim.value in inline:
+        (arity, value, truth) = inline[prim.value]
+        if truth is not None and len(forms) == arity:
+          args = [self.expr(f) for f in forms]
+          return truth.format(*args, p = self.const(prim.apply))
+    elif form.__class__ is types.Symbol:
+      (kind, value) = self.lookup(form)
+      if kind == "global" and value is types.true:
+        return "True"
+      if kind == "global" and value is types.false:
+        return "False"
+    value = self.expr(form)
+    return "(%s is true or (%s is not false and not_boolean(%s)))" % \
+        (value, value, self.const(form))
+
+  def cond(self, forms, target):
+    for (i, sexp) in enumerate(forms):
+      if not types.is_list(sexp):
+        raise Unsupported("argument %d of cond must be list" % (i + 1))
+      if types.is_nil(sexp) or types.is_nil(sexp.cdr):
+        raise Unsupported("argument %d of cond is too short" % (i + 1))
+    depth = self.depth
+    for (i, rule) in enumerate(forms):
+      if i:
+        self.emit("else:")
+        self.depth += 1
+        mark = len(self.lines)
+      test = self.condition(rule.car)
+      if test == "True":
+        self.sequence(list(rule.cdr), target)
+        break
+      if i and len(self.lines) == mark:
+        # Nothing had to be computed for the test: an elif will do.
+        self.lines.pop()
+        self.depth -= 1
+        self.emit("elif %s:" % test)
+      else:
+        self.emit("if %s:" % test)
+      self.depth += 1
+      self.sequence(list(rule.cdr), target)
+      self.depth -= 1
+    else:
+      self.emit("else:")
+      self.depth += 1
+      self.result(target, self.const(types.nil))
+    self.depth = depth
+
+  def is_lambda(self, form):
+    if form.car.__class__ is not types.Symbol:
+      return False
+    (kind, value) = self.lookup(form.car)
+    return kind == "global" and types.is_primitive(value) and \
+        self.rt.prims.get("lambda") is value
+
+  def let(self, head, forms, target):
+    "An immediately applied lambda, its parameters assigned as locals."
+    (sig, body) = self.rt.prims.parse_sig(None, "lambda", list(head.cdr),
+                                          "list &", evaluated = True)
+    sig = list(sig)
+    if len(sig) != len(forms) or \
+          any(name.__class__ is not types.Symbol or name.value == "&" for name in sig):
+      raise Unsupported("lambda parameters")
+    args = [self.expr(form) for form in forms]
+    names = {}
+    for (name, arg) in zip(sig, args):
+      names[name] = self.temp()
+      self.emit("%s = %s" % (names[name], arg))
+    self.lets.append(names)
+    self.sequence(list(body), target)
+    self.lets.pop()
+
+  def dynamic(self, form, func, forms, target):
+    "A call of whatever func turns out to be at runtime."
+    if self.lets:
+      raise Unsupported("call of a local in let")
+    self.uses_frame = True
+    self.emit("if %s.__class__ is Function or (%s.__class__ is Primitive and "
+              "%s.apply is not None):" % (func, func, func))
+    self.depth += 1
+    args = ", ".join(self.expr(f) for f in forms)
+    if target is None:
+      self.emit("return tail_call(frame, %s, [%s])" % (func, args))
+    else:
+      self.emit("%s = apply_value(frame, %s, [%s])" % (target, func, args))
+    self.depth -= 1
+    self.emit("else:")
+    self.depth += 1
+    self.result(target, "slow(frame, %s, %s)" % (func, self.const(form)))
+    self.depth -= 1
+
+class JIT(Compiler):
+  """
+  The closure compiler, with functions called threshold times
+  translated to Python. translated, failed and deopts count the
+  functions translated, those that couldn't be, and the translations
+  thrown away since.
+  """
+
+  threshold = 50
+
+  def __init__(self, rt):
+    Compiler.__init__(self, rt)
+    self.translated = 0
+    self.failed = 0
+    self.deopts = 0
+    self.namespace = {
+      "Number": types.Number, "ConsCell": types.ConsCell,
+      "Function": types.Function, "Primitive": types.Primitive,
+      "nil": types.nil, "true": types.true, "false": types.false,
+      "cons": types.cons, "TailCall": TailCall, "not_boolean": not_boolean,
+      "Frame": Frame,
+      "call": self.call, "apply_value": self.apply_value,
+      "tail_call": self.tail_call, "slow": self.slow,
+      }
+
+  def apply_value(self, frame, func, args):
+    if func.__class__ is types.Function:
+      return self.call(func, args)
+    return func.apply(frame, args)
+
+  def tail_call(self, frame, func, args):
+    if func.__class__ is types.Function:
+      return TailCall(func, args)
+    return func.apply(frame, args)
+
+  def slow(self, frame, func, sexp):
+    "Call the primitive or macro func with the forms of sexp, like RT.execute."
+    rt = self.rt
+    forms = list(sexp.cdr)
+    if types.is_primitive(func):
+      return func.invoke(frame, forms)
+    if types.is_macro(func):
+      return rt.eval(frame, rt.invoke(frame, func, forms))
+    raise LispException("%s is not callable" % repr(func), sexp)
+
+  def translate(self, func):
+    "Translate func to Python, returning the result, or False if it can't be."
+    try:
+      if not types.is_function(func):
+        raise Unsupported("macro")
+      translator = Translator(self, func)
+      source = translator.translate()
+      code = compile(source, "<jit %s>" % repr(func)[:60], "exec")
+    except (Unsupported, LispException, SyntaxError):
+      self.failed += 1
+      func.native = False
+      return False
+    namespace = dict(self.namespace)
+    exec code in namespace
+    native = namespace["make"](translator.consts)
+    native.source = source
+    self.translated += 1
+    func.native = native
+    self.watch(func, native, translator.deps)
+    return native
+
+  def watch(self, func, native, deps):
+    """
+    Deoptimise func when any of the definitions native assumed, deps,
+    changes. The watches hold func only weakly, so it can still be
+    collected, and they are all dropped when one fires or when it is.
+    """
+    seen = set()
+    watched = []
+    for (scope, symbol, value) in deps:
+      if (id(scope), symbol) not in seen:
+        seen.add((id(scope), symbol))
+        watched.append((scope, symbol))
+
+    def unwatch(ref = None):
+      for (scope, symbol) in watched:
+        scope.unwatch(symbol, deoptimise)
+    func = weakref.ref(func, unwatch)
+    native = weakref.ref(native)
+
+    def deoptimise(symbol):
+      unwatch()
+      f = func()
+      if f is not None and f.native is native():
+        f.native = 0
+        self.deopts += 1
+    for (scope, symbol) in watched:
+      scope.watch(symbol, deoptimise)
+    # Anything redefined before the watches were set is caught here.
+    for (scope, symbol, value) in deps:
+      if scope.get(symbol) is not value:
+        deoptimise(symbol)
+        break
+
+  def run(self, func, frame):
+    """
+    Run the body of func in frame, as Python if it has been translated
+    and as closures if not, and then any tail calls it returns.
+    """
+    threshold = self.threshold
+    while True:
+      try:
+        native = func.native
+      except AttributeError:
+        native = 0
+      if native.__class__ is int:
+        if native < threshold:
+          func.native = native + 1
+          native = None
+        else:
+          native = self.translate(func)
+      if native:
+        rv = native(frame)
+      else:
+        try:
+          code = func.code
+        except AttributeError:
+          code = self.compile_function(func)
+        rv = code(frame)
+      if rv.__class__ is not TailCall:
+        return rv
+      func = rv.func
+      frame = bind(func, rv.args)
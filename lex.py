@@ -1,4 +1,5 @@
 from shlex import shlex
+from cStringIO import StringIO
 import re
 
 class ParserError(Exception):
@@ -6,15 +7,39 @@ class ParserError(Exception):
     self.value = value
     self.token = token
   def __str__(self):
+    if self.token and self.token.col:
+      return "%s:%d:%d: %s" % (self.token.infile,
+                               self.token.lineno,
+                               self.token.col,
+                               self.value)
     if self.token:
-      return "%s:%d: %s" % (self.token["infile"],
-                            self.token["lineno"],
+      return "%s:%d: %s" % (self.token.infile,
+                            self.token.lineno,
                             self.value)
     return self.value
 
+class Token(object):
+  __slots__ = ("type", "value", "lineno", "col", "infile")
+
+  def __init__(self, type, value, lineno, col = None, infile = None):
+    self.type = type
+    self.value = value
+    self.lineno = lineno
+    self.col = col
+    self.infile = infile
+
+  def __repr__(self):
+    return "<%s %r at %s:%d:%s>" % (self.type, self.value, self.infile,
+                                   self.lineno, self.col)
+
 classifiers = (
   ("lparen", re.compile(r"\(")),
   ("rparen", re.compile(r"\)")),
+  ("lbracket", re.compile(r"\[")),
+  ("rbracket", re.compile(r"\]")),
+  ("lbrace", re.compile(r"\{")),
+  ("rbrace", re.compile(r"\}")),
+  ("hash", re.compile(r"#")),
   ("string", re.compile(r"\".*")),
   ("quote", re.compile(r"'")),
   ("unquote", re.compile(r"~")),
@@ -29,10 +54,16 @@ def classify(token):
       return t
   raise ParserError("Unclassifiable token \"%s\"" % token)
 
+def stream_name(stream, filename):
+  if not filename and isinstance(stream, file):
+    return stream.name
+  return filename
+
 class Lexer(object):
+  "The original shlex based lexer, kept for differential testing."
+
   def __init__(self, stream, filename = None):
-    if not filename and isinstance(stream, file):
-      filename = stream.name
+    filename = stream_name(stream, filename)
     l = shlex(stream, filename, posix = False)
     l.commenters = ";"
     l.wordchars = l.wordchars + "+-*/=<>&|?.!"
@@ -43,7 +74,95 @@ class Lexer(object):
 
   def __iter__(self):
     for token in self.lexer:
-      yield { "type": classify(token),
-              "value": token,
-              "lineno": self.lexer.lineno,
-              "infile": self.lexer.infile }
+      yield Token(classify(token), token,
+                  self.lexer.lineno, None, self.lexer.infile)
+
+wordchars = r"a-zA-Z0-9_+*/=<>&|?.!\-"
+
+# Token boundaries and classes follow the shlex configuration of Lexer:
+# words run until whitespace, a paren, a reader macro character or a
+# comment, and a word is a number if it would match the number
+# classifier above.
+scanner = re.compile(r"""
+  (?P<space>[, \t\r]+)
+| (?P<newline>\n)
+| (?P<comment>;[^\n]*)
+| (?P<lparen>\()
+| (?P<rparen>\))
+| (?P<lbracket>\[)
+| (?P<rbracket>\])
+| (?P<lbrace>\{)
+| (?P<rbrace>\})
+| (?P<hash>\#)
+| (?P<quote>')
+| (?P<unquote>~)
+| (?P<deref>@)
+| (?P<string>"[^"]*")
+| (?P<number>[1-9-]*[0-9][%(w)s"]*)
+| (?P<symbol>[%(w)s][%(w)s"]*)
+| (?P<open>"[^"]*\Z)
+| (?P<other>.)
+""" % { "w": wordchars }, re.X | re.S)
+
+skip = frozenset(("space", "newline", "comment"))
+
+class Scanner(object):
+  """
+  Single pass tokeniser driven by one compiled regex.
+
+  Input is consumed a line at a time, so tokens are produced without
+  reading the whole stream first. Tokens carry the line and column
+  (both 1-based) they start at.
+  """
+
+  def __init__(self, stream, filename = None):
+    self.infile = stream_name(stream, filename)
+    if isinstance(stream, basestring):
+      stream = StringIO(stream)
+    self.stream = stream
+
+  def __iter__(self):
+    readline = self.stream.readline
+    infile = self.infile
+    match = scanner.match
+    buf = ""
+    pos = 0
+    lineno = 1
+    linestart = 0
+
+    while True:
+      if pos >= len(buf):
+        buf = readline()
+        if not buf:
+          return
+        pos = 0
+        linestart = 0
+
+      m = match(buf, pos)
+      kind = m.lastgroup
+
+      if kind == "open":
+        more = readline()
+        if not more:
+          raise ParserError("No closing quotation",
+                            Token("string", m.group(), lineno,
+                                  pos - linestart + 1, infile))
+        buf = buf[pos:] + more
+        linestart -= pos
+        pos = 0
+        continue
+
+      end = m.end()
+      if kind == "newline":
+        lineno += 1
+        linestart = end
+      elif kind not in skip:
+        value = m.group()
+        token = Token(kind, value, lineno, pos - linestart + 1, infile)
+        if kind == "other":
+          raise ParserError("Unclassifiable token \"%s\"" % value, token)
+        if kind == "string" and "\n" in value:
+          lineno += value.count("\n")
+          linestart = pos + value.rindex("\n") + 1
+        yield token
+      pos = end
@@ -1,110 +1,386 @@
 ## types.py -- Constructing and checking typed entities
 
-from numbers import Number
+import numbers, threading
 from lispmath import str2number
+import persistent
 
 class ConsCell(object):
+  __slots__ = ("car", "cdr")
+
   def __init__(self, car, cdr):
     self.car = car
     self.cdr = cdr
 
   def __iter__(self):
     el = self
-    while el != nil:
+    while el is not nil:
       yield el.car
       el = el.cdr
 
+  def __reduce__(self):
+    if self is nil:
+      return "nil"
+    return (ConsCell, (self.car, self.cdr))
+
   def is_nil(self):
-    return self.car == None and self.cdr == None
+    return self is nil
 
   def is_regular_list(self):
-    return self.is_nil() or (isinstance(self.cdr, ConsCell) and self.cdr.is_regular_list(self))
+    el = self
+    while el.__class__ is ConsCell:
+      if el is nil:
+        return True
+      el = el.cdr
+    return False
 
   def __repr__(self):
-    if self.is_nil():
-      return "nil"
-    if isinstance(self.cdr, ConsCell):
-      return "(%s)" % " ".join((repr(el) for el in self))
-    else:
-      return "(%s . %s)" % (repr(self.car), repr(self.cdr))
+    out = []
+    write(self, out.append)
+    return "".join(out)
 
   def __eq__(self, other):
-    if not isinstance(other, ConsCell):
-      return False
-    return self.car == other.car and self.cdr == other.cdr
+    return equal(self, other)
+
+  def __hash__(self):
+    h = 0x345678
+    stack = [self]
+    while stack:
+      x = stack.pop()
+      if x is nil:
+        h = (h * 1000003) & 0xffffffff
+      elif x.__class__ is ConsCell:
+        stack.append(x.cdr)
+        stack.append(x.car)
+      else:
+        h = ((h * 1000003) ^ hash(x)) & 0xffffffff
+    return h
 
 cons = ConsCell
 
 nil = cons(None, None)
 
-def conj(l, e):
-  if is_nil(l):
-    return cons(e, nil)
-  def rec(l):
-    if l.cdr == nil:
-      return cons(l.car, cons(e, nil))
+# Entries on the stack of write: a value to print, the rest of a list
+# after its first element, or a literal string.
+(VALUE, REST, LITERAL) = range(3)
+
+def write(value, out):
+  """
+  Print value by calling out with successive chunks of its
+  representation. Lists are walked with an explicit stack rather than
+  by recursion, so there is no limit on their length or depth, and the
+  output can be streamed without building it all in memory.
+  """
+  stack = [(VALUE, value)]
+  while stack:
+    (kind, x) = stack.pop()
+    if kind is VALUE:
+      if isinstance(x, Collection):
+        out(x.opener)
+        stack.append((LITERAL, x.closer))
+        stack.extend(reversed(x.printed()))
+      elif x.__class__ is not ConsCell:
+        out(repr(x))
+      elif x is nil:
+        out("nil")
+      else:
+        out("(")
+        stack.append((REST, x.cdr))
+        stack.append((VALUE, x.car))
+    elif kind is REST:
+      if x is nil:
+        out(")")
+      elif x.__class__ is ConsCell:
+        out(" ")
+        stack.append((REST, x.cdr))
+        stack.append((VALUE, x.car))
+      else:
+        out(" . ")
+        stack.append((LITERAL, ")"))
+        stack.append((VALUE, x))
     else:
-      return cons(l.car, rec(l.cdr))
-  return rec(l)
+      out(x)
+
+def equal(a, b):
+  """
+  Compare two values structurally, walking lists with an explicit stack
+  and returning as soon as a difference is found. Past the first
+  thousand pairs of cells, the pairs already compared are remembered
+  and not compared again, so cyclic structures terminate.
+  """
+  stack = [(a, b)]
+  seen = None
+  steps = 0
+  while stack:
+    (a, b) = stack.pop()
+    if a is b:
+      continue
+    if a.__class__ is not ConsCell or b.__class__ is not ConsCell:
+      if a.__class__ is ConsCell or b.__class__ is ConsCell or not a == b:
+        return False
+      continue
+    if a is nil or b is nil:
+      return False
+    if seen is not None:
+      pair = (id(a), id(b))
+      if pair in seen:
+        continue
+      seen.add(pair)
+    else:
+      steps += 1
+      if steps > 1000:
+        seen = set()
+    stack.append((a.cdr, b.cdr))
+    stack.append((a.car, b.car))
+  return True
+
+class ListBuilder(object):
+  "Builds a list front to back by keeping a pointer to its last cell."
+
+  def __init__(self):
+    self.head = self.last = cons(None, nil)
+
+  def append(self, value):
+    cell = cons(value, nil)
+    self.last.cdr = cell
+    self.last = cell
+
+  def build(self, tail = nil):
+    self.last.cdr = tail
+    return self.head.cdr
+
+def conj(l, e):
+  out = ListBuilder()
+  for el in l:
+    out.append(el)
+  out.append(e)
+  return out.build()
 
 class Type(object):
-  def __init__(self, type, value, sig = None, scope = None, token = None):
-    self.type = type
-    self.value = value
-    if sig != None:
-      self.sig = sig
-    if scope != None:
-      self.scope = scope
+  """
+  A Lisp value other than a list. Each kind of value is a subclass of
+  Type, named by its type attribute; Type(type, value) makes a value
+  of the subclass registered for type.
+  """
+  __slots__ = ("value",)
+  type = "unknown"
+
+  def __new__(cls, *args, **kwargs):
+    if cls is Type:
+      return type_classes[args[0]](*args[1:], **kwargs)
+    self = object.__new__(cls)
+    self.value = args[0] if args else None
+    return self
 
   def __repr__(self):
-    if self.type == "number":
-      return str(self.value)
-    elif self.type == "string":
-      return '"%s"' % self.value
-    elif self.type == "symbol":
-      return self.value
-    elif self.type == "primitive":
-      return "<primitive %s>" % self.value
-    elif self.type == "function":
-      return "(lambda %s %s)" % (repr(mklist(self.sig)),
-                                 " ".join(list(repr(i) for i in self.value)))
-    elif self.type == "macro":
-      return "(macro %s %s)" % (repr(mklist(self.sig)),
-                                 " ".join(list(repr(i) for i in self.value)))
-    else:
-      return "<UNREPRESENTABLE LISPTYPE \"%s\">" % self.value
+    return "<UNREPRESENTABLE LISPTYPE \"%s\">" % self.value
 
   def __eq__(self, other):
-    if not isinstance(other, Type):
-      return False
-    return self.type == other.type and self.value == other.value
+    return self.__class__ is other.__class__ and self.value == other.value
+
+  def __hash__(self):
+    return hash(self.value)
+
+class Number(Type):
+  __slots__ = ()
+  type = "number"
+
+  def __repr__(self):
+    return str(self.value)
+
+class String(Type):
+  __slots__ = ()
+  type = "string"
+
+  def __repr__(self):
+    return '"%s"' % self.value
+
+symbols = {}
+symbols_lock = threading.Lock()
+
+class Symbol(Type):
+  """
+  Symbols are interned: there is only ever one symbol of each name, so
+  symbols are equal only if they are the same object. Symbols are
+  never freed, as the names a program uses are bounded by its source.
+  """
+  __slots__ = ()
+  type = "symbol"
+
+  def __new__(cls, name):
+    symbol = symbols.get(name)
+    if symbol is None:
+      with symbols_lock:
+        symbol = symbols.get(name)
+        if symbol is None:
+          symbol = symbols[name] = Type.__new__(cls, name)
+    return symbol
+
+  def __reduce__(self):
+    return (Symbol, (self.value,))
+
+  def __eq__(self, other):
+    return self is other
+
+  __hash__ = object.__hash__
+
+  def __repr__(self):
+    return self.value
+
+class Primitive(Type):
+  __slots__ = ("invoke", "apply", "signature")
+  type = "primitive"
+
+  def __new__(cls, name, invoke = None, apply = None, signature = "*"):
+    self = Type.__new__(cls, name)
+    self.invoke = invoke
+    self.apply = apply
+    self.signature = signature
+    return self
+
+  def __repr__(self):
+    return "<primitive %s>" % self.value
+
+class Function(Type):
+  "A lambda: a body of forms, its parameter list and the scope it closes over."
+  __slots__ = ("sig", "scope", "params", "code", "bytecode", "native",
+               "__weakref__")
+  type = "function"
+  keyword = "lambda"
+
+  def __new__(cls, value, sig = None, scope = None):
+    self = Type.__new__(cls, value)
+    self.sig = sig
+    self.scope = scope
+    return self
+
+  def __repr__(self):
+    return "(%s %s %s)" % (self.keyword, repr(mklist(self.sig)),
+                           " ".join(list(repr(i) for i in self.value)))
+
+class Macro(Function):
+  __slots__ = ()
+  type = "macro"
+  keyword = "macro"
+
+class Collection(Type):
+  """
+  A map, set or vector, holding the persistent structure from the
+  persistent module as its value. Collections are immutable, so they
+  can be shared between threads.
+  """
+  __slots__ = ()
+
+  def __iter__(self):
+    return iter(self.value)
+
+  def __len__(self):
+    return len(self.value)
+
+  def __nonzero__(self):
+    # Like every other value, even an empty collection is true to Python.
+    return True
+
+  def forms(self):
+    "Every element of the collection; the keys and values of a map."
+    return iter(self.value)
+
+  def printed(self):
+    "The entries for write to print between opener and closer."
+    entries = []
+    for el in self.value:
+      if entries:
+        entries.append((LITERAL, " "))
+      entries.append((VALUE, el))
+    return entries
+
+  def __repr__(self):
+    out = []
+    write(self, out.append)
+    return "".join(out)
+
+class Vector(Collection):
+  __slots__ = ()
+  type = "vector"
+  (opener, closer) = ("[", "]")
+
+  def map_forms(self, f):
+    "A vector of f applied to each element."
+    return Vector(persistent.vector(f(el) for el in self.value))
+
+class Set(Collection):
+  __slots__ = ()
+  type = "set"
+  (opener, closer) = ("#{", "}")
+
+  def map_forms(self, f):
+    "A set of f applied to each element."
+    return Set(persistent.hash_set(f(el) for el in self.value))
+
+class Map(Collection):
+  __slots__ = ()
+  type = "map"
+  (opener, closer) = ("{", "}")
+
+  def forms(self):
+    for (key, value) in self.value.items():
+      yield key
+      yield value
+
+  def printed(self):
+    entries = []
+    for (key, value) in self.value.items():
+      if entries:
+        entries.append((LITERAL, ", "))
+      entries.extend(((VALUE, key), (LITERAL, " "), (VALUE, value)))
+    return entries
+
+  def map_forms(self, f):
+    "A map of f applied to each key and each value."
+    return Map(persistent.hash_map((f(key), f(value))
+                                   for (key, value) in self.value.items()))
+
+type_classes = dict((cls.type, cls) for cls in
+                    (Number, String, Symbol, Primitive, Function, Macro,
+                     Vector, Set, Map))
 
 def is_list(i):
   return isinstance(i, ConsCell)
 
 def is_nil(i):
-  return is_list(i) and i.is_nil()
+  return i is nil
 
 def is_atomic(i):
   return is_nil(i) or isinstance(i, Type)
 
 def is_symbol(i):
-  return isinstance(i, Type) and i.type == "symbol"
+  return i.__class__ is Symbol
 
 def is_number(i):
-  return isinstance(i, Type) and i.type == "number"
+  return i.__class__ is Number
 
 def is_string(i):
-  return isinstance(i, Type) and i.type == "string"
+  return i.__class__ is String
 
 def is_function(i):
-  return isinstance(i, Type) and i.type == "function"
+  return i.__class__ is Function
 
 def is_primitive(i):
-  return isinstance(i, Type) and i.type == "primitive"
+  return i.__class__ is Primitive
 
 def is_macro(i):
-  return isinstance(i, Type) and i.type == "macro"
+  return i.__class__ is Macro
+
+def is_vector(i):
+  return i.__class__ is Vector
+
+def is_set(i):
+  return i.__class__ is Set
+
+def is_map(i):
+  return i.__class__ is Map
+
+def is_collection(i):
+  return isinstance(i, Collection)
 
 def type_name(i):
   if is_nil(i):
@@ -117,29 +393,45 @@ def type_name(i):
     return "unknown"
 
 def token_to_type(token):
-  if token["type"] == "string":
-    return Type("string", token["value"][1:-1], token = token)
-  elif token["type"] == "number":
-    return Type("number", str2number(token["value"]), token = token)
+  if token.type == "string":
+    return String(token.value[1:-1])
+  elif token.type == "number":
+    return Number(str2number(token.value))
   else:
-    return Type(token["type"], token["value"], token = token)
+    return Type(token.type, token.value)
 
 def mksymbol(name):
-  return Type("symbol", name)
+  "The symbol called name, or name itself if it is a symbol already."
+  if name.__class__ is Symbol:
+    return name
+  return Symbol(name)
 
 true = mksymbol("true")
 false = mksymbol("false")
 
-def mkprimitive(name, func):
-  p = Type("primitive", name)
-  p.invoke = func
-  return p
+def mkprimitive(name, func, apply = None, signature = "*"):
+  """
+  Make a primitive called name. func is called with the scope and the
+  unevaluated arguments; apply, if given, is an alternative entry point
+  taking arguments that have already been evaluated.
+  """
+  return Primitive(name, func, apply, signature)
 
 def mkfunc(sig, body, scope):
-  return Type("function", body, sig = sig, scope = scope)
+  return Function(body, sig, scope)
 
 def mkmacro(sig, body, scope):
-  return Type("macro", body, sig = sig, scope = scope)
+  return Macro(body, sig, scope)
+
+def mkvector(items):
+  return Vector(persistent.vector(items))
+
+def mkset(items):
+  return Set(persistent.hash_set(items))
+
+def mkmap(pairs):
+  "Make a map of a sequence of (key, value) pairs."
+  return Map(persistent.hash_map(pairs))
 
 def mklist(a):
   l = nil
@@ -153,9 +445,9 @@ def py_to_type(obj):
   if isinstance(obj, bool):
     return true if obj else false
   elif isinstance(obj, str):
-    return Type("string", obj)
-  elif isinstance(obj, Number):
-    return Type("number", obj)
+    return String(obj)
+  elif isinstance(obj, numbers.Number):
+    return Number(obj)
   elif isinstance(obj, list):
     return mklist(map(py_to_type, obj))
   else:
@@ -1,43 +1,82 @@
-from lex import Lexer, ParserError
+from lex import Scanner, ParserError
 import lisptypes as types
 
-def load(stream):
+prefixes = ("quote", "unquote", "unquote-splice", "deref")
+
+closers = { "lparen": "rparen", "lbracket": "rbracket", "lbrace": "rbrace" }
+openers = dict((closer, opener) for (opener, closer) in closers.items())
+
+def build(opener, hashed, top, token):
+  "Make the form for the forms in top, read between opener and token."
+  if opener == "lparen":
+    return types.mklist(top)
+  if opener == "lbracket":
+    return types.mkvector(top)
+  if hashed:
+    return types.mkset(top)
+  if len(top) % 2:
+    raise ParserError("map literal must contain an even number of forms", token)
+  return types.mkmap(zip(top[0::2], top[1::2]))
+
+def load(stream, lexer = Scanner):
+  """
+  Read every form in stream and return them as a list.
+
+  Lists are collected into Python lists while they are open and
+  linked into cons cells once, when their closing paren is read, so
+  reading a form is linear in its number of elements. Brackets read
+  as vectors, braces as maps and #{} as sets in the same way.
+
+  lexer is the tokeniser class to read stream with; lex.Lexer can be
+  passed to read with the original shlex based lexer.
+  """
   stack = []
-  top = types.nil
+  top = []
+  prefix = None
+  opener = None
+  hashed = None
   last = None
-  lexer = Lexer(stream)
+  lexer = lexer(stream)
 
   for token in lexer:
-    if token["type"] == "lparen":
-      stack.append(top)
-      if last and last["type"] in ["quote", "unquote", "unquote-splice", "deref"]:
-        top = types.cons(last["type"], types.nil)
-      else:
-        top = types.nil
-    elif token["type"] == "rparen":
-      if len(stack) == 0:
-        raise ParserError("rparen without matching lparen", token)
-      if not types.is_nil(top) and top.car in ["quote", "unquote", "unquote-splice", "deref"]:
-        func = types.mksymbol(top.car)
-        sym = top.cdr
-        sym = types.cons(sym, types.nil)
-        top = types.cons(func, sym)
-      top = types.conj(stack.pop(), top)
-    elif token["type"] in ["quote", "unquote"]:
+    if hashed and token.type != "lbrace":
+      raise ParserError("# must be followed by {", hashed)
+    if token.type == "hash":
+      hashed = token
+      continue
+    if token.type in closers:
+      stack.append((top, prefix, opener, hashed))
+      top = []
+      prefix = last.type if last and last.type in prefixes else None
+      opener = token.type
+      hashed = None
+    elif token.type in openers:
+      if openers[token.type] != opener:
+        raise ParserError("%s without matching %s" %
+                          (token.type, openers[token.type]), token)
+      sexp = build(opener, stack[-1][3], top, token)
+      if prefix:
+        sexp = types.cons(types.mksymbol(prefix), types.cons(sexp, types.nil))
+      (top, prefix, opener, hashed) = stack.pop()
+      hashed = None
+      top.append(sexp)
+    elif token.type in ["quote", "unquote"]:
       pass
-    elif token["type"] == "deref":
-      if last and last["type"] == "unquote":
-        token["type"] = "unquote-splice"
+    elif token.type == "deref":
+      if last and last.type == "unquote":
+        token.type = "unquote-splice"
     else:
-      if last and last["type"] in ["quote", "unquote", "unquote-splice", "deref"]:
+      if last and last.type in prefixes:
         sexp = types.cons(types.token_to_type(token), types.nil)
-        sexp = types.cons(types.mksymbol(last["type"]), sexp)
-        top = types.conj(top, sexp)
+        sexp = types.cons(types.mksymbol(last.type), sexp)
+        top.append(sexp)
       else:
-        top = types.conj(top, types.token_to_type(token))
+        top.append(types.token_to_type(token))
     last = token
 
+  if hashed:
+    raise ParserError("# must be followed by {", hashed)
   if len(stack):
-    raise ParserError("lparen without matching rparen", last)
+    raise ParserError("%s without matching %s" % (opener, closers[opener]), last)
 
-  return top
+  return types.mklist(top)
@@ -2,21 +2,95 @@
 
 from load import load
 from rt import RT, LispException
+from lisptypes import write
+import workers, processes, coop, cache, image
 
-import sys, os.path
+import sys, os.path, threading
 from argparse import ArgumentParser
 
+def print_result(rv):
+  sys.stdout.write("=> ")
+  write(rv, sys.stdout.write)
+  sys.stdout.write("\n")
+
+def cooperative_repl(rt, loop):
+  """
+  The REPL with the loop on this thread, so futures started at the
+  prompt run between lines. Lines are read on another thread, and
+  each form is evaluated as a task of its own.
+  """
+  finished = coop.Ref()
+
+  def evaluate(sexps, done):
+    if not sexps:
+      done.set()
+      return
+    def settled(ref):
+      if ref.state is coop.realised:
+        print_result(ref.refval)
+      elif isinstance(ref.refval, LispException):
+        print "***", str(ref.refval)
+      else:
+        print "***", "%s: %s" % (ref.refval.__class__.__name__, ref.refval)
+      evaluate(sexps[1:], done)
+    loop.spawn(rt.ns, [sexps[0]]).on_settle(settled)
+
+  def read():
+    while 1:
+      print ">>> ",
+      s = sys.stdin.readline()
+      if not s:
+        loop.call_soon_threadsafe(lambda: finished.realise(None))
+        return
+      done = threading.Event()
+      sexps = list(load(s))
+      loop.call_soon_threadsafe(lambda: evaluate(sexps, done))
+      done.wait()
+
+  reader = threading.Thread(target = read)
+  reader.daemon = True
+  reader.start()
+  loop.run_until(finished)
+
 if __name__ == "__main__":
 
   arg_parser = ArgumentParser(description = "Run you a lisp!")
   arg_parser.add_argument("file", nargs = "?", help = "Lolisp source file to run")
+  arg_parser.add_argument("--pool-size", type = int,
+                          help = "Threads to run futures on (default $LOLISP_POOL_SIZE, or CPUs + 4)")
+  arg_parser.add_argument("--processes", type = int,
+                          help = "Processes to run pfuture and ppmap on (default $LOLISP_PROCESSES, or CPUs)")
+  arg_parser.add_argument("--bytecode", action = "store_true",
+                          help = "Run functions on the bytecode VM instead of compiled closures")
+  arg_parser.add_argument("--jit", action = "store_true",
+                          help = "Translate hot functions to Python")
+  arg_parser.add_argument("--cooperative", action = "store_true",
+                          help = "Run futures as tasks on an event loop on this thread")
+  arg_parser.add_argument("--image",
+                          help = "Start from the definitions saved in an image instead of running rt.loli")
+  arg_parser.add_argument("--save-image", metavar = "IMAGE",
+                          help = "Save the runtime's definitions to an image before exiting")
   args = arg_parser.parse_args()
 
-  rt = RT()
-  rt.load(rt.ns, file(os.path.join(sys.path[0], "rt.loli")))
+  if args.pool_size:
+    workers.configure(args.pool_size)
+  if args.processes:
+    processes.configure(args.processes)
 
-  if args.file:
-    rt.load(rt.ns, file(args.file))
+  if args.image:
+    rt = image.restore(args.image, bytecode = args.bytecode, jit = args.jit)
+  else:
+    rt = RT(bytecode = args.bytecode, jit = args.jit)
+    rt.load_file(rt.ns, os.path.join(sys.path[0], "rt.loli"))
+
+  if args.cooperative:
+    loop = coop.Loop(rt)
+    if args.file:
+      loop.run(rt.ns, list(cache.read(args.file)))
+    else:
+      cooperative_repl(rt, loop)
+  elif args.file:
+    rt.load_file(rt.ns, args.file)
   else:
     while 1:
       print ">>> ",
@@ -26,6 +100,9 @@ if __name__ == "__main__":
       sexps = load(s)
       for sexp in sexps:
         try:
-          print "=> %s" % repr(rt.execute(rt.ns, sexp))
+          print_result(rt.execute(rt.ns, sexp))
         except LispException as e:
           print "***", str(e)
+
+  if args.save_image:
+    image.save(rt, args.save_image)
@@ -0,0 +1,140 @@
+## modules.py -- Source files loaded once, as modules with namespaces
+
+# (require "name") finds name.loli, or name, in the directory of the
+# module requiring it or else on the search path, and loads it as a
+# module the first time: its definitions are made in a namespace of its
+# own, over the runtime's globals. It then defines the names the module
+# exports in the namespace of the code requiring it, or, given a prefix
+# symbol as well, as prefix/name. A module exports the names listed by
+# the (export ...) forms in it, or if there are none, everything it
+# defines.
+#
+# A runtime's modules are kept in a Registry, shared by its clones, so
+# however many threads require a module at once it is loaded once, and
+# the others wait for it. How long each took to load is recorded.
+
+import os, threading, time
+import lisptypes as types
+from errors import LispException
+from scope import Namespace, namespace
+
+def default_path():
+  """
+  The search path: the current directory, the directories in
+  $LOLISP_PATH and the directory rt.loli is in.
+  """
+  path = ["."]
+  path.extend(p for p in os.environ.get("LOLISP_PATH", "").split(os.pathsep)
+              if p)
+  path.append(os.path.dirname(os.path.abspath(__file__)))
+  return path
+
+class Module(object):
+  def __init__(self, path):
+    self.path = path
+    self.ns = None
+    self.exports = None
+    self.seconds = None
+    self.error = None
+    self.thread = threading.current_thread()
+    self.loaded = threading.Event()
+
+  def exported(self):
+    "The (symbol, value) pairs the module exports."
+    if self.exports is None:
+      return sorted(self.ns.items())
+    rv = []
+    for symbol in self.exports:
+      value = self.ns.get(symbol)
+      if value is None:
+        raise LispException("module %s exports %s, which it doesn't define" %
+                            (self.path, symbol.value))
+      rv.append((symbol, value))
+    return rv
+
+class Registry(object):
+  def __init__(self, rt, path = None):
+    self.rt = rt
+    self.path = default_path() if path is None else path
+    self.modules = {}
+    self.order = []
+    self.lock = threading.Lock()
+
+  def resolve(self, name, directory = None):
+    "The path of the module called name, searching directory first."
+    names = [name] if name.endswith(".loli") else [name + ".loli", name]
+    if os.path.isabs(name):
+      dirs = [""]
+    else:
+      dirs = ([directory] if directory else []) + self.path
+    for d in dirs:
+      for n in names:
+        path = os.path.join(d, n)
+        if os.path.isfile(path):
+          return os.path.realpath(path)
+    raise LispException("module %s not found in %s" % (name, ":".join(dirs)))
+
+  def require(self, name, directory = None):
+    "The module called name, loading it if no thread has yet."
+    path = self.resolve(name, directory)
+    with self.lock:
+      module = self.modules.get(path)
+      loading = module is None
+      if loading:
+        module = self.modules[path] = Module(path)
+    if loading:
+      self.load(module)
+    elif not module.loaded.is_set():
+      if module.thread is threading.current_thread():
+        raise LispException("module %s is required while it is loading" % path)
+      module.loaded.wait()
+      if module.error is not None:
+        raise module.error
+    return module
+
+  def load(self, module):
+    module.ns = Namespace(module, self.rt.ns)
+    start = time.time()
+    try:
+      self.rt.load_file(module.ns, module.path)
+    except Exception as e:
+      # Left to be tried again by the next require.
+      module.error = e
+      with self.lock:
+        del self.modules[module.path]
+      raise
+    finally:
+      module.seconds = time.time() - start
+      module.loaded.set()
+    with self.lock:
+      self.order.append(module)
+
+  def loaded(self):
+    "The modules loaded so far, in the order they loaded."
+    with self.lock:
+      return list(self.order)
+
+  def add(self, module):
+    "Take module, loaded by another runtime, as loaded here."
+    module.loaded.set()
+    with self.lock:
+      self.modules[module.path] = module
+      self.order.append(module)
+
+  def stats(self):
+    "(path, seconds) for each module loaded, in the order they loaded."
+    return [(module.path, module.seconds) for module in self.loaded()]
+
+def require(rt, scope, name, prefix = None):
+  """
+  Require the module called name from code running in scope, and
+  define what it exports in scope's namespace.
+  """
+  ns = namespace(scope)
+  directory = os.path.dirname(ns.module.path) if ns is not None else None
+  module = rt.modules.require(name, directory)
+  for (symbol, value) in module.exported():
+    if prefix is not None:
+      symbol = types.mksymbol("%s/%s" % (prefix.value, symbol.value))
+    (rt.ns if ns is None else ns).define(symbol, value)
+  return module
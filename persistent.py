@@ -0,0 +1,369 @@
+## persistent.py -- Immutable hash maps, hash sets and vectors
+
+# All of these structures are immutable: every update returns a new
+# structure sharing all but the path it changed with the old one, so
+# they can be handed between threads freely.
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+missing = object()
+
+def popcount(n):
+  return bin(n).count("1")
+
+def hash32(key):
+  return hash(key) & 0xffffffff
+
+def bitpos(h, shift):
+  return 1 << ((h >> shift) & MASK)
+
+class BitmapNode(object):
+  """
+  A node of a hash array mapped trie, with an entry for each distinct
+  five bit slice of the hashes below it. bitmap marks the slices that
+  are present; array holds a key and value for each of them in order,
+  or None and a subnode where more than one key shares the slice.
+  """
+  __slots__ = ("bitmap", "array")
+
+  def __init__(self, bitmap, array):
+    self.bitmap = bitmap
+    self.array = array
+
+  def find(self, shift, h, key, default):
+    bit = bitpos(h, shift)
+    if not self.bitmap & bit:
+      return default
+    i = 2 * popcount(self.bitmap & (bit - 1))
+    k = self.array[i]
+    if k is None:
+      return self.array[i + 1].find(shift + BITS, h, key, default)
+    if k is key or k == key:
+      return self.array[i + 1]
+    return default
+
+  def assoc(self, shift, h, key, value, added):
+    bit = bitpos(h, shift)
+    i = 2 * popcount(self.bitmap & (bit - 1))
+    array = self.array
+    if not self.bitmap & bit:
+      added.append(key)
+      return BitmapNode(self.bitmap | bit, array[:i] + (key, value) + array[i:])
+    (k, v) = (array[i], array[i + 1])
+    if k is None:
+      node = v.assoc(shift + BITS, h, key, value, added)
+      if node is v:
+        return self
+      return BitmapNode(self.bitmap, array[:i + 1] + (node,) + array[i + 2:])
+    if k is key or k == key:
+      if v is value:
+        return self
+      return BitmapNode(self.bitmap, array[:i + 1] + (value,) + array[i + 2:])
+    added.append(key)
+    node = make_node(shift + BITS, k, v, h, key, value)
+    return BitmapNode(self.bitmap, array[:i] + (None, node) + array[i + 2:])
+
+  def without(self, shift, h, key):
+    bit = bitpos(h, shift)
+    if not self.bitmap & bit:
+      return self
+    i = 2 * popcount(self.bitmap & (bit - 1))
+    array = self.array
+    (k, v) = (array[i], array[i + 1])
+    if k is None:
+      node = v.without(shift + BITS, h, key)
+      if node is v:
+        return self
+      if node is not None:
+        return BitmapNode(self.bitmap, array[:i + 1] + (node,) + array[i + 2:])
+    elif not (k is key or k == key):
+      return self
+    if self.bitmap == bit:
+      return None
+    return BitmapNode(self.bitmap ^ bit, array[:i] + array[i + 2:])
+
+  def items(self):
+    array = self.array
+    for i in xrange(0, len(array), 2):
+      if array[i] is None:
+        for item in array[i + 1].items():
+          yield item
+      else:
+        yield (array[i], array[i + 1])
+
+class CollisionNode(object):
+  "The keys and values of a trie whose keys all have the same hash."
+  __slots__ = ("hash", "array")
+
+  def __init__(self, hash, array):
+    self.hash = hash
+    self.array = array
+
+  def index(self, key):
+    array = self.array
+    for i in xrange(0, len(array), 2):
+      if array[i] is key or array[i] == key:
+        return i
+    return -1
+
+  def find(self, shift, h, key, default):
+    i = self.index(key)
+    return default if i < 0 else self.array[i + 1]
+
+  def assoc(self, shift, h, key, value, added):
+    if h != self.hash:
+      node = BitmapNode(bitpos(self.hash, shift), (None, self))
+      return node.assoc(shift, h, key, value, added)
+    i = self.index(key)
+    array = self.array
+    if i < 0:
+      added.append(key)
+      return CollisionNode(h, array + (key, value))
+    if array[i + 1] is value:
+      return self
+    return CollisionNode(h, array[:i + 1] + (value,) + array[i + 2:])
+
+  def without(self, shift, h, key):
+    i = self.index(key)
+    if i < 0:
+      return self
+    if len(self.array) == 2:
+      return None
+    return CollisionNode(self.hash, self.array[:i] + self.array[i + 2:])
+
+  def items(self):
+    array = self.array
+    for i in xrange(0, len(array), 2):
+      yield (array[i], array[i + 1])
+
+def make_node(shift, k1, v1, h2, k2, v2):
+  "A node holding two keys which agree on the hash slices above shift."
+  h1 = hash32(k1)
+  if h1 == h2:
+    return CollisionNode(h1, (k1, v1, k2, v2))
+  node = BitmapNode(0, ()).assoc(shift, h1, k1, v1, [])
+  return node.assoc(shift, h2, k2, v2, [])
+
+class HashMap(object):
+  "A persistent hash map, a hash array mapped trie of 32-way nodes."
+  __slots__ = ("count", "root")
+
+  def __init__(self, count = 0, root = None):
+    self.count = count
+    self.root = root
+
+  def get(self, key, default = None):
+    if self.root is None:
+      return default
+    return self.root.find(0, hash32(key), key, default)
+
+  def __contains__(self, key):
+    return self.get(key, missing) is not missing
+
+  def assoc(self, key, value):
+    added = []
+    root = self.root or BitmapNode(0, ())
+    root = root.assoc(0, hash32(key), key, value, added)
+    if root is self.root:
+      return self
+    return HashMap(self.count + len(added), root)
+
+  def dissoc(self, key):
+    if self.root is None:
+      return self
+    root = self.root.without(0, hash32(key), key)
+    if root is self.root:
+      return self
+    return HashMap(self.count - 1, root)
+
+  def items(self):
+    if self.root is None:
+      return iter(())
+    return self.root.items()
+
+  def __iter__(self):
+    for (key, value) in self.items():
+      yield key
+
+  def __len__(self):
+    return self.count
+
+  def __eq__(self, other):
+    if not isinstance(other, HashMap) or self.count != other.count:
+      return False
+    for (key, value) in self.items():
+      v = other.get(key, missing)
+      if v is missing or not (v is value or v == value):
+        return False
+    return True
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    h = 0
+    for (key, value) in self.items():
+      h ^= hash((key, value))
+    return h
+
+class HashSet(object):
+  "A persistent hash set, a HashMap of its elements to themselves."
+  __slots__ = ("map",)
+
+  def __init__(self, map = HashMap()):
+    self.map = map
+
+  def __contains__(self, key):
+    return key in self.map
+
+  def get(self, key, default = None):
+    return self.map.get(key, default)
+
+  def conj(self, key):
+    m = self.map.assoc(key, key)
+    return self if m is self.map else HashSet(m)
+
+  def disj(self, key):
+    m = self.map.dissoc(key)
+    return self if m is self.map else HashSet(m)
+
+  def __iter__(self):
+    return iter(self.map)
+
+  def __len__(self):
+    return len(self.map)
+
+  def __eq__(self, other):
+    return isinstance(other, HashSet) and self.map == other.map
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    h = 0
+    for key in self:
+      h ^= hash(key)
+    return h
+
+def new_path(level, node):
+  while level > 0:
+    node = (node,)
+    level -= BITS
+  return node
+
+class Vector(object):
+  """
+  A persistent vector: a 32-way trie of tuples indexed by the bits of
+  an element's position, five at a time, with the last 32 elements
+  kept in a separate tail so appending is usually a single copy.
+  """
+  __slots__ = ("count", "shift", "root", "tail")
+
+  def __init__(self, count = 0, shift = BITS, root = (), tail = ()):
+    self.count = count
+    self.shift = shift
+    self.root = root
+    self.tail = tail
+
+  def tailoff(self):
+    if self.count < WIDTH:
+      return 0
+    return ((self.count - 1) >> BITS) << BITS
+
+  def leaf(self, i):
+    "The tuple holding the element at i."
+    if i >= self.tailoff():
+      return self.tail
+    node = self.root
+    level = self.shift
+    while level > 0:
+      node = node[(i >> level) & MASK]
+      level -= BITS
+    return node
+
+  def nth(self, i):
+    if not 0 <= i < self.count:
+      raise IndexError(i)
+    return self.leaf(i)[i & MASK]
+
+  def conj(self, value):
+    count = self.count
+    if count - self.tailoff() < WIDTH:
+      return Vector(count + 1, self.shift, self.root, self.tail + (value,))
+    shift = self.shift
+    if (count >> BITS) > (1 << shift):
+      root = (self.root, new_path(shift, self.tail))
+      shift += BITS
+    else:
+      root = self.push_tail(shift, self.root)
+    return Vector(count + 1, shift, root, (value,))
+
+  def push_tail(self, level, node):
+    i = ((self.count - 1) >> level) & MASK
+    if level == BITS:
+      child = self.tail
+    elif i < len(node):
+      child = self.push_tail(level - BITS, node[i])
+    else:
+      child = new_path(level - BITS, self.tail)
+    return node[:i] + (child,) + node[i + 1:]
+
+  def assoc(self, i, value):
+    if i == self.count:
+      return self.conj(value)
+    if not 0 <= i < self.count:
+      raise IndexError(i)
+    if i >= self.tailoff():
+      j = i & MASK
+      tail = self.tail[:j] + (value,) + self.tail[j + 1:]
+      return Vector(self.count, self.shift, self.root, tail)
+    return Vector(self.count, self.shift,
+                  assoc_path(self.shift, self.root, i, value), self.tail)
+
+  def __iter__(self):
+    for i in xrange(0, self.count, WIDTH):
+      for value in self.leaf(i):
+        yield value
+
+  def __len__(self):
+    return self.count
+
+  def __eq__(self, other):
+    if not isinstance(other, Vector) or self.count != other.count:
+      return False
+    for (a, b) in zip(self, other):
+      if not (a is b or a == b):
+        return False
+    return True
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(tuple(self))
+
+def assoc_path(level, node, i, value):
+  j = (i >> level) & MASK
+  if level == 0:
+    return node[:j] + (value,) + node[j + 1:]
+  return node[:j] + (assoc_path(level - BITS, node[j], i, value),) + node[j + 1:]
+
+def hash_map(pairs):
+  m = HashMap()
+  for (key, value) in pairs:
+    m = m.assoc(key, value)
+  return m
+
+def hash_set(items):
+  s = HashSet()
+  for item in items:
+    s = s.conj(item)
+  return s
+
+def vector(items):
+  v = Vector()
+  for item in items:
+    v = v.conj(item)
+  return v
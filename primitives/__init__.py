@@ -1,3 +1,4 @@
+import inspect
 import lisptypes as types
 from load import load
 from errors import LispException
@@ -12,10 +13,14 @@ def signature(*params):
     else:
       name = func.__name__.replace("_", "-")
       sig = params[0]
+    check = compile_sig(name, sig)
     def wrap(self, scope, args):
-      args = self.parse_sig(scope, name, args, sig)
-      return func(self, scope, args)
+      return func(self, scope, check(self.rt.eval, scope, args))
+    def apply(self, scope, args):
+      return func(self, scope, check(None, scope, args))
     wrap.primitive_name = name
+    wrap.signature = sig
+    wrap.apply = apply
     wrap.__name__ = func.__name__
     return wrap
   return decorate
@@ -27,10 +32,14 @@ def extend(*params):
     else:
       name = func.__name__.replace("_", "-")
       sig = params[0]
+    check = compile_sig(name, sig)
     def wrap(primitives, scope, args):
-      args = primitives.parse_sig(scope, name, args, sig)
-      return func(primitives, scope, args)
+      return func(primitives, scope, check(primitives.rt.eval, scope, args))
+    def apply(primitives, scope, args):
+      return func(primitives, scope, check(None, scope, args))
     wrap.primitive_name = name
+    wrap.signature = sig
+    wrap.apply = apply
     wrap.external = True
     wrap.__name__ = func.__name__
     return wrap
@@ -39,15 +48,111 @@ def extend(*params):
 def wrap_external(primitives, fn):
   return lambda scope, args: fn(primitives, scope, args)
 
+def is_strict(signature):
+  "True if every argument in signature is evaluated before the call."
+  return all(sig.startswith("@") for sig in signature.split())
+
 def match_class(classes, name):
   for c in classes:
     if name == c.__name__ or match_class(c.__bases__, name):
       return True
   return False
 
+def class_test(name):
+  "A test for instances of a class called name, or of its subclasses."
+  cache = {}
+  def test(arg):
+    cls = arg.__class__
+    rv = cache.get(cls)
+    if rv is None:
+      rv = cache[cls] = match_class([cls], name)
+    return rv
+  return test
+
+def type_test(sig):
+  "Compile the alternatives in a type signature like number|Atom to a test."
+  tests = [getattr(types, "is_%s" % t) if t.islower() else class_test(t)
+           for t in sig.split("|")]
+  if len(tests) == 1:
+    return tests[0]
+  return lambda arg: any(test(arg) for test in tests)
+
+def compile_sig(fn, signature):
+  """
+  Compile the signature of the primitive fn to a function
+  check(evaluate, scope, args), which checks args against it and
+  returns them. The arguments marked with @ are evaluated with
+  evaluate(scope, arg), or taken to have been evaluated by the caller
+  already if evaluate is None. A signature of * passes any arguments
+  through unevaluated and @* evaluates any number of arguments. An
+  empty signature takes no arguments.
+  """
+  if signature == "*":
+    return lambda evaluate, scope, args: args
+  if signature == "@*":
+    return lambda evaluate, scope, args: \
+      args if evaluate is None else [evaluate(scope, arg) for arg in args]
+
+  sigs = signature.split()
+  rest = sigs.pop() if sigs and sigs[-1] in ("&", "@&") else None
+  params = []
+  for sig in sigs:
+    sig = sig.replace("callable", "function|macro|primitive")
+    strict = sig[0] == "@"
+    if strict:
+      sig = sig[1:]
+    params.append((strict, None if sig == "any" else type_test(sig), sig))
+  arity = len(params)
+
+  def check(evaluate, scope, args):
+    if rest is None and len(args) != arity:
+      raise LispException("%s takes %d arguments, %d given" %
+                          (fn, arity, len(args)))
+    out = []
+    for (i, (strict, test, sig)) in enumerate(params):
+      if i == len(args):
+        raise LispException("%s takes at least %d arguments, %d given" %
+                            (fn, arity + 1, i))
+      arg = args[i]
+      if strict and evaluate is not None:
+        arg = evaluate(scope, arg)
+      if test is not None and not test(arg):
+        raise LispException("argument %d of %s must be %s, was %s" %
+                            (i + 1, fn, sig, types.type_name(arg)))
+      out.append(arg)
+    if rest is not None:
+      if len(args) == arity:
+        raise LispException("%s takes at least %d arguments, %d given" %
+                            (fn, arity + 1, arity))
+      args = args[arity:]
+      if rest == "@&" and evaluate is not None:
+        args = [evaluate(scope, arg) for arg in args]
+      out.append(args)
+    return out
+
+  return check
+
+# The primitives of each package extended with, as a list of (attribute,
+# name, signature) for each, keyed by module or by class for objects,
+# so only the first runtime has to search the package for them.
+exported = {}
+
+def exports(package):
+  key = package if inspect.ismodule(package) else package.__class__
+  rv = exported.get(key)
+  if rv is None:
+    rv = []
+    for attr in dir(package):
+      fn = getattr(package, attr)
+      if hasattr(fn, "primitive_name"):
+        rv.append((attr, fn.primitive_name, fn.signature))
+    exported[key] = rv
+  return rv
+
 class Primitives(dict):
   def __init__(self, rt):
     self.rt = rt
+    self.checks = {}
     self["nil"] = types.nil
     self["true"] = types.true
     self["false"] = types.false
@@ -55,82 +160,47 @@ class Primitives(dict):
     self.extend(self)
 
   def extend(self, package):
-    for key in dir(package):
-      fn = getattr(package, key)
-      if hasattr(fn, "primitive_name"):
-        name = fn.primitive_name
-        if hasattr(fn, "external"):
-          fn = wrap_external(self, fn)
-        self[name] = types.mkprimitive(name, fn)
-
-  def parse_sig(self, scope, fn, args, signature):
-    if signature == "*":
-      return args
-
-    out = []
-    rest = False
-    sigs = signature.split(" ")
-    if sigs[-1] in ["&", "@&"]:
-      rest = sigs[-1]
-      sigs = sigs[:-1]
-    else:
-      if len(sigs) != len(args):
-        raise LispException("%s takes %d arguments, %d given" %
-                            (fn, len(sigs), len(args)))
-    for sig in sigs:
-      if not len(args):
-        raise LispException("%s takes %s%d arguments, %d given" %
-                            (fn, "at least " if rest else "",
-                             len(sigs) + 1, len(out)))
-      if "callable" in sig:
-        sig = sig.replace("callable", "function|macro|primitive")
-      arg = args[0]
-      args = args[1:]
-      if sig[0] == "@":
-        sig = sig[1:]
-        arg = self.rt.eval(scope, arg)
-
-      if sig != "any":
-        matched = False
-        for t in sig.split("|"):
-          if t.islower():
-            test = getattr(types, "is_%s" % t)
-            if test(arg):
-              matched = True
-          else:
-            if match_class([arg.__class__], t):
-              matched = True
-        if not matched:
-          raise LispException("argument %d of %s must be %s, was %s" %
-                              (len(out) + 1, fn, sig,
-                               types.type_name(arg)))
-
-      out.append(arg)
-
-    if rest and not len(args):
-      raise LispException("%s takes %s%d arguments, %d given" %
-                          (fn, "at least " if rest else "",
-                           len(sigs) + 1, len(out)))
-    if rest == "@&":
-      out.append(map(lambda x: self.rt.eval(scope, x), args))
-    elif rest == "&":
-      out.append(args)
-
-    return out
+    for (attr, name, sig) in exports(package):
+      fn = getattr(package, attr)
+      apply = wrap_external(self, fn.apply) if is_strict(sig) else None
+      if hasattr(fn, "external"):
+        fn = wrap_external(self, fn)
+      self[name] = types.mkprimitive(name, fn, apply, sig)
+
+  def parse_sig(self, scope, fn, args, signature, evaluated = False):
+    """
+    Check args against signature and return them, evaluating the
+    arguments marked with @ unless evaluated is set, in which case
+    they are taken to have been evaluated by the caller already.
+    """
+    check = self.checks.get((fn, signature))
+    if check is None:
+      check = self.checks[(fn, signature)] = compile_sig(fn, signature)
+    return check(None if evaluated else self.rt.eval, scope, args)
+
+  def call(self, scope, func, args):
+    """
+    Call func with a list of evaluated args. Primitives are given them
+    through their apply entry point where they have one, so they are
+    not evaluated a second time.
+    """
+    if types.is_primitive(func) and func.apply:
+      return func.apply(scope, args)
+    return self.rt.invoke(scope, func, args)
 
   def _unquote(self, scope, sexp):
     if types.is_list(sexp) and not types.is_nil(sexp):
       if types.is_symbol(sexp.car) and sexp.car.value == "unquote":
         return self.rt.eval(scope, sexp.cdr.car)
 
-      out = types.nil
+      out = types.ListBuilder()
       for el in sexp:
         if is_splice(el):
           for splice in self.rt.eval(scope, el.cdr.car):
-            out = types.conj(out, splice)
+            out.append(splice)
         else:
-          out = types.conj(out, self._unquote(scope, el))
-      return out
+          out.append(self._unquote(scope, el))
+      return out.build()
     else:
       return sexp
 
@@ -169,11 +239,12 @@ class Primitives(dict):
 
   @signature("symbol @any")
   def define(self, scope, args):
-    return self.rt.define(args[0], args[1])
+    return self.rt.define(args[0], args[1], scope)
 
   @signature("=", "@any @any")
   def equals(self, scope, args):
-    return types.py_to_type(args[0] == args[1])
+    (a, b) = args
+    return types.py_to_type(a is b or a == b)
 
   @signature("*")
   def cond(self, scope, args):
@@ -195,9 +266,8 @@ class Primitives(dict):
 
     return types.nil
 
-  @signature("print", "*")
+  @signature("print", "@*")
   def print_args(self, scope, args):
-    args = map(lambda x: self.rt.eval(scope, x), args)
     args = (i.value if types.is_string(i) else repr(i) for i in args)
     print " ".join(args)
     return types.nil
@@ -210,16 +280,19 @@ class Primitives(dict):
   def eval(self, scope, args):
     return self.rt.eval(scope, args[0])
 
-  @signature("require", "@string")
-  def require(self, scope, args):
-    self.rt.load(self.rt.ns, file(args[0].value))
-    return types.nil
+  @signature("*")
+  def macro_cache_stats(self, scope, args):
+    compiler = self.rt.compiler
+    (hits, misses) = (compiler.macro_hits, compiler.macro_misses) \
+        if compiler else (0, 0)
+    return types.mklist([types.cons(types.mksymbol("hits"), types.py_to_type(hits)),
+                         types.cons(types.mksymbol("misses"), types.py_to_type(misses))])
 
   @signature("@function|primitive @list")
   def apply(self, scope, args):
     # quoted = (types.cons(types.mksymbol("quote"), types.cons(i, types.nil)) for i in args[1])
     quoted = args[1]
-    return self.rt.invoke(scope, args[0], list(quoted))
+    return self.call(scope, args[0], list(quoted))
 
   @signature("lambda", "list &")
   def lambda_func(self, scope, args):
@@ -247,14 +320,14 @@ class Primitives(dict):
   def foldr(self, scope, args):
     (func, acc, l) = args
     for el in l:
-      acc = self.rt.invoke(scope, func, [acc, el])
+      acc = self.call(scope, func, [acc, el])
     return acc
 
   @signature("@callable @any @list")
   def foldl(self, scope, args):
     (func, acc, l) = args
     for el in reversed(list(l)):
-      acc = self.rt.invoke(scope, func, [acc, el])
+      acc = self.call(scope, func, [acc, el])
     return acc
 
   @signature("*")
@@ -1,91 +1,222 @@
 import lisptypes as types
 from errors import LispException
 from primitives import extend
-import threading, time
+import workers, processes, persistent
+import threading, time, weakref
+
+# The states of a Ref. A Ref leaves pending once, for one of the others,
+# and never changes again.
+pending = "pending"
+realised = "realised"
+failed = "failed"
+cancelled = "cancelled"
 
 class Ref(types.Type):
-  def __init__(self):
-    types.Type.__init__(self, "ref", None)
+  """
+  A value that arrives later: the result of a future, or whatever is
+  delivered to a promise. A Ref that fails holds the exception, which
+  deref raises again in whoever asks for the value.
+  """
+  __slots__ = ("state", "refval", "condition", "task", "callbacks")
+  type = "ref"
+
+  def __init__(self, task = None):
+    self.state = pending
     self.refval = None
     self.condition = threading.Condition()
+    self.task = task
+    self.callbacks = None
 
   def __eq__(self, other):
     return self is other
 
+  __hash__ = object.__hash__
+
+  def settle(self, state, value):
+    "Move from pending to state, returning False if it had already moved."
+    with self.condition:
+      if self.state is not pending:
+        return False
+      self.state = state
+      self.refval = value
+      self.condition.notifyAll()
+      (callbacks, self.callbacks) = (self.callbacks, None)
+    for callback in callbacks or ():
+      callback(self)
+    return True
+
+  def on_settle(self, callback):
+    "Call callback with the Ref once it has settled, at once if it has."
+    with self.condition:
+      if self.state is pending:
+        if self.callbacks is None:
+          self.callbacks = []
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
   def realise(self, value):
-    self.condition.acquire()
-    self.refval = value
-    self.condition.notifyAll()
-    self.condition.release()
+    return self.settle(realised, value)
 
-  def fail(self):
-    self.realise(False)
+  def fail(self, exc):
+    return self.settle(failed, exc)
+
+  def cancel(self):
+    """
+    Cancel the Ref if it's pending and its task, if any, hasn't started.
+    A task in another process can't be stopped, but its result is
+    dropped.
+    """
+    if self.task is not None and not self.task.cancel():
+      return False
+    return self.settle(cancelled, None)
 
   def realised(self):
-    self.condition.acquire()
-    rv = not self.refval is None
-    self.condition.release()
-    return rv
+    return self.state is not pending
 
-  def failed(self):
-    self.condition.acquire()
-    rv = self.refval is False
-    self.condition.release()
-    return rv
+  def wait(self, timeout = None):
+    "Wait up to timeout seconds, or forever, for the Ref to settle."
+    if timeout is None and self.task is not None:
+      self.task.run()
+    deadline = None if timeout is None else time.time() + timeout
+    with self.condition:
+      while self.state is pending:
+        if deadline is None:
+          self.condition.wait()
+        else:
+          left = deadline - time.time()
+          if left <= 0:
+            return False
+          self.condition.wait(left)
+    return True
 
-  def deref(self):
-    self.condition.acquire()
-    if self.refval == None:
-      self.condition.wait()
-    rv = self.refval
-    self.condition.release()
-    if rv is False:
-      return types.mksymbol("failed")
-    return rv
+  def deref(self, timeout = None, default = types.nil):
+    if not self.wait(timeout):
+      return default
+    if self.state is failed:
+      raise self.refval
+    if self.state is cancelled:
+      raise LispException("can't deref a cancelled ref")
+    return self.refval
 
   def __repr__(self):
-    if self.realised():
-      return "<ref=%s>" % repr(self.deref())
-    else:
-      return "<ref=unrealised>"
+    if self.state is realised:
+      return "<ref=%s>" % repr(self.refval)
+    if self.state is failed:
+      return "<ref failed: %s>" % self.refval
+    return "<ref=%s>" % ("unrealised" if self.state is pending else self.state)
 
 class Atom(types.Type):
+  """
+  A value changed atomically. Reads take no lock. swap computes the new
+  value outside the lock and commits it only if the atom still holds
+  the value it was computed from, retrying otherwise, so a slow update
+  never blocks readers or other writers, though it may run more than
+  once. Watches are called after each change, on the changing thread.
+  """
+  __slots__ = ("lock", "atom", "validator", "watches", "swaps", "retries")
+  type = "atom"
+
   def __init__(self, value):
-    types.Type.__init__(self, "atom", None)
     self.lock = threading.Lock()
     self.atom = value
+    self.validator = None
+    self.watches = persistent.HashMap()
+    self.swaps = 0
+    self.retries = 0
 
   def __eq__(self, other):
     return self is other
 
-  def swap(self, rt, scope, func):
-    # FIXME: Lock should be acquired in request order
-    self.lock.acquire()
-    try:
-      self.atom = rt.invoke(scope, func, [self.atom])
-    except:
-      import traceback
-      traceback.print_exc()
-    finally:
-      rv = self.atom
-      self.lock.release()
-      return rv
+  __hash__ = object.__hash__
+
+  def validate(self, call, value):
+    if self.validator is not None and \
+          call(self.validator, [value]) is not types.true:
+      raise LispException("validator rejected new value %s of atom" %
+                          repr(value))
+
+  def commit(self, old, new):
+    "Set the atom to new if it still holds old, which must be identical."
+    with self.lock:
+      if self.atom is not old:
+        self.retries += 1
+        return False
+      self.atom = new
+      self.swaps += 1
+      return True
+
+  def notify(self, call, old, new):
+    for (key, func) in self.watches.items():
+      call(func, [key, self, old, new])
+
+  def swap(self, call, func):
+    while True:
+      old = self.atom
+      new = call(func, [old])
+      self.validate(call, new)
+      if self.commit(old, new):
+        self.notify(call, old, new)
+        return new
+
+  def compare_and_set(self, call, old, new):
+    "Set the atom to new if it holds a value equal to old."
+    current = self.atom
+    if not (current is old or current == old):
+      return False
+    self.validate(call, new)
+    if not self.commit(current, new):
+      return False
+    self.notify(call, current, new)
+    return True
+
+  def reset(self, call, new):
+    self.validate(call, new)
+    with self.lock:
+      old = self.atom
+      self.atom = new
+      self.swaps += 1
+    self.notify(call, old, new)
+    return new
+
+  def set_validator(self, call, func):
+    "Check the current value with func, and then every new value."
+    if func is not None and call(func, [self.atom]) is not types.true:
+      raise LispException("validator rejected current value %s of atom" %
+                          repr(self.atom))
+    self.validator = func
+
+  def watch(self, key, func):
+    with self.lock:
+      if func is None:
+        self.watches = self.watches.dissoc(key)
+      else:
+        self.watches = self.watches.assoc(key, func)
 
   def deref(self):
-    self.lock.acquire()
-    rv = self.atom
-    self.lock.release()
-    return rv
+    return self.atom
 
   def __repr__(self):
     return "<atom=%s>" % repr(self.deref())
 
-class LispWorker(threading.Thread):
-  "Executes a series of forms in a separate thread."
+# Each pool thread evaluates with its own clone of the runtime, made
+# the first time it runs forms for that runtime.
+clones = threading.local()
+
+def thread_rt(rt):
+  rts = getattr(clones, "rts", None)
+  if rts is None:
+    rts = clones.rts = weakref.WeakKeyDictionary()
+  clone = rts.get(rt)
+  if clone is None:
+    clone = rts[rt] = rt.clone()
+  return clone
+
+class LispWorker(object):
+  "Executes a series of forms on whichever thread calls it."
 
   def __init__(self, rt, scope, forms):
-    threading.Thread.__init__(self)
-    self.rt = rt.clone()
+    self.rt = rt
     self.scope = scope
     self.forms = forms
 
@@ -95,11 +226,12 @@ class LispWorker(threading.Thread):
   def failed(self, exc):
     raise NotImplementedError()
 
-  def run(self):
+  def __call__(self):
+    rt = thread_rt(self.rt)
     rv = types.nil
     try:
       for form in self.forms:
-        rv = self.rt.eval(self.scope, form)
+        rv = rt.eval(self.scope, form)
       self.done(rv)
     except Exception as e:
       self.failed(e)
@@ -115,32 +247,137 @@ class Future(LispWorker):
     self.ref.realise(result)
 
   def failed(self, exc):
-    self.ref.fail()
+    self.ref.fail(exc)
 
-@extend("@Ref|Atom")
+@extend("@&")
 def deref(self, scope, args):
+  args = args[0]
+  if len(args) not in (1, 3):
+    raise LispException("deref takes 1 or 3 arguments, %d given" % len(args))
   ref = args[0]
-  return ref.deref()
+  if isinstance(ref, Atom):
+    return ref.deref()
+  if not isinstance(ref, Ref):
+    raise LispException("argument 1 of deref must be Ref|Atom, was %s" %
+                        types.type_name(ref))
+  if len(args) == 1:
+    return ref.deref()
+  timeout = args[1]
+  if not types.is_number(timeout):
+    raise LispException("argument 2 of deref must be number, was %s" %
+                        types.type_name(timeout))
+  return ref.deref(float(timeout.value), args[2])
+
+@extend("realized?", "@Ref|Delay")
+def is_realized(self, scope, args):
+  return types.py_to_type(args[0].realised())
+
+# Spelt as the rest of this module spells it.
+@extend("realised?", "@Ref|Delay")
+def is_realised(self, scope, args):
+  return types.py_to_type(args[0].realised())
+
+@extend("")
+def promise(self, scope, args):
+  return Ref()
+
+@extend("@Ref @any")
+def deliver(self, scope, args):
+  return types.py_to_type(args[0].realise(args[1]))
+
+@extend("future-cancel", "@Ref")
+def future_cancel(self, scope, args):
+  return types.py_to_type(args[0].cancel())
+
+@extend("future-cancelled?", "@Ref")
+def future_cancelled(self, scope, args):
+  return types.py_to_type(args[0].state is cancelled)
 
 @extend("@any")
 def atom(self, scope, args):
   return Atom(args[0])
 
+def caller(primitives, scope):
+  return lambda func, args: primitives.call(scope, func, args)
+
 @extend("swap!", "@Atom @callable")
 def atom_swap(self, scope, args):
-  return args[0].swap(self.rt, scope, args[1])
+  return args[0].swap(caller(self, scope), args[1])
 
 @extend("reset!", "@Atom @any")
 def atom_reset(self, scope, args):
-  fn = types.mkprimitive("reset!", lambda x1, x2: args[1])
-  return args[0].swap(self.rt, scope, fn)
+  return args[0].reset(caller(self, scope), args[1])
+
+@extend("compare-and-set!", "@Atom @any @any")
+def compare_and_set(self, scope, args):
+  (a, old, new) = args
+  return types.py_to_type(a.compare_and_set(caller(self, scope), old, new))
+
+@extend("set-validator!", "@Atom @callable|nil")
+def set_validator(self, scope, args):
+  (a, func) = args
+  a.set_validator(caller(self, scope), None if types.is_nil(func) else func)
+  return types.nil
+
+@extend("add-watch", "@Atom @any @callable")
+def add_watch(self, scope, args):
+  (a, key, func) = args
+  a.watch(key, func)
+  return a
+
+@extend("remove-watch", "@Atom @any")
+def remove_watch(self, scope, args):
+  (a, key) = args
+  a.watch(key, None)
+  return a
+
+@extend("atom-stats", "@Atom")
+def atom_stats(self, scope, args):
+  a = args[0]
+  return types.mkmap([(types.mksymbol("swaps"), types.py_to_type(a.swaps)),
+                      (types.mksymbol("retries"), types.py_to_type(a.retries)),
+                      (types.mksymbol("watches"), types.py_to_type(len(a.watches)))])
 
 @extend("&")
 def future(self, scope, args):
   f = Future(self.rt, scope, args[0])
-  f.start()
+  f.ref.task = workers.shared().submit(f)
   return f.ref
 
+@extend("pmap", "@callable @list")
+def pmap(self, scope, args):
+  (func, l) = args
+  pool = workers.shared()
+  tasks = [pool.submit(lambda el = el: self.call(scope, func, [el])) for el in l]
+  out = types.ListBuilder()
+  for task in tasks:
+    out.append(task.result())
+  return out.build()
+
+@extend("&")
+def pfuture(self, scope, args):
+  ref = Ref()
+  def done(result):
+    (status, rv) = result
+    if status == "ok":
+      ref.realise(rv[0])
+    else:
+      ref.fail(LispException(rv))
+  thunk = types.mkfunc([], types.mklist(args[0]), scope)
+  processes.shared().submit(self.rt, "call", [thunk], done)
+  return ref
+
+@extend("ppmap", "@callable @list")
+def ppmap(self, scope, args):
+  (func, l) = args
+  return types.mklist(processes.shared().map(self.rt, func, list(l)))
+
+@extend("pool-stats", "")
+def pool_stats(self, scope, args):
+  stats = workers.shared().stats()
+  return types.mkmap([(types.mksymbol(key), types.py_to_type(value))
+                      for (key, value) in sorted(stats.items())])
+
 @extend("@number")
 def sleep(self, scope, args):
   time.sleep(args[0].value)
@@ -0,0 +1,169 @@
+import lisptypes as types
+from errors import LispException
+from primitives import extend, compile_sig
+from primitives.lazy import Delay
+
+class Var(types.Type):
+  """
+  A logic variable, named for printing. Every variable is distinct
+  from every other, whatever its name.
+  """
+  __slots__ = ()
+  type = "var"
+
+  def __eq__(self, other):
+    return self is other
+
+  __hash__ = object.__hash__
+
+  def __repr__(self):
+    return "<var %s>" % repr(self.value)
+
+# Substitutions are persistent maps from variables to values. They are
+# triangular: a variable may be bound to another variable, or to a
+# structure holding variables bound elsewhere in the map, so a value is
+# found by walking from binding to binding.
+
+def walk(v, s):
+  while v.__class__ is Var:
+    bound = s.get(v)
+    if bound is None:
+      return v
+    v = bound
+  return v
+
+def walk_all(v, s):
+  "v with every variable in it replaced by its value in s, if bound."
+  v = walk(v, s)
+  if types.is_vector(v):
+    return v.map_forms(lambda el: walk_all(el, s))
+  if v.__class__ is not types.ConsCell or v is types.nil:
+    return v
+  out = types.ListBuilder()
+  while v.__class__ is types.ConsCell and v is not types.nil:
+    out.append(walk_all(v.car, s))
+    v = walk(v.cdr, s)
+  return out.build(walk_all(v, s))
+
+def occurs(x, v, s):
+  "True if the variable x occurs in v under s."
+  stack = [v]
+  while stack:
+    v = walk(stack.pop(), s)
+    if v is x:
+      return True
+    if v.__class__ is types.ConsCell and v is not types.nil:
+      stack.append(v.cdr)
+      stack.append(v.car)
+    elif types.is_vector(v):
+      stack.extend(v)
+  return False
+
+def unify(u, v, s, occurs_check = False):
+  """
+  Extend the substitution s so that u and v are equal, or return None
+  if they can't be. With occurs_check, a variable is never bound to a
+  structure containing itself.
+  """
+  stack = [(u, v)]
+  while stack:
+    (u, v) = stack.pop()
+    u = walk(u, s)
+    v = walk(v, s)
+    if u is v:
+      continue
+    if u.__class__ is Var:
+      if occurs_check and occurs(u, v, s):
+        return None
+      s = s.assoc(u, v)
+    elif v.__class__ is Var:
+      if occurs_check and occurs(v, u, s):
+        return None
+      s = s.assoc(v, u)
+    elif u.__class__ is types.ConsCell and v.__class__ is types.ConsCell:
+      if u is types.nil or v is types.nil:
+        return None
+      stack.append((u.cdr, v.cdr))
+      stack.append((u.car, v.car))
+    elif types.is_vector(u) and types.is_vector(v):
+      if len(u) != len(v):
+        return None
+      stack.extend(zip(u, v))
+    elif not u == v:
+      return None
+  return s
+
+def unify_result(u, v, s, occurs_check):
+  rv = unify(u, v, s.value, occurs_check)
+  return types.false if rv is None else types.Map(rv)
+
+@extend("var", "@any")
+def make_var(self, scope, args):
+  return Var(args[0])
+
+@extend("var?", "@any")
+def is_var(self, scope, args):
+  return types.py_to_type(args[0].__class__ is Var)
+
+@extend("walk", "@any @map")
+def walk_var(self, scope, args):
+  return walk(args[0], args[1].value)
+
+@extend("walk*", "@any @map")
+def walk_var_all(self, scope, args):
+  return walk_all(args[0], args[1].value)
+
+@extend("unify", "@any @any @map")
+def unify_terms(self, scope, args):
+  return unify_result(args[0], args[1], args[2], False)
+
+@extend("unify-check", "@any @any @map")
+def unify_terms_check(self, scope, args):
+  return unify_result(args[0], args[1], args[2], True)
+
+def mkgoal(primitives, name, run):
+  "A goal: a primitive taking a substitution and returning a stream of them."
+  check = compile_sig(name, "@map")
+  invoke = lambda scope, args: run(scope, check(primitives.rt.eval, scope, args)[0])
+  apply = lambda scope, args: run(scope, check(None, scope, args)[0])
+  return types.mkprimitive(name, invoke, apply, "@map")
+
+# Goals return streams of substitutions: nil, a list of substitutions
+# whose tail may be a Delay, or a Delay of a stream still to be
+# searched. The combinators below never force more of a stream than
+# it takes to find its next answer, and alternate between streams
+# whenever one of them is delayed, so a branch with no end can't
+# starve the others of their answers.
+
+def mplus(s1, s2):
+  "The substitutions of two streams, interleaved."
+  if s1 is types.nil:
+    return s2
+  if isinstance(s1, Delay):
+    return Delay(lambda: mplus(s2, s1.realise()))
+  return types.cons(s1.car, Delay(lambda: mplus(s1.cdr, s2)))
+
+def bind(call, stream, goal):
+  "The substitutions of goal applied to every substitution in stream."
+  if stream is types.nil:
+    return types.nil
+  if isinstance(stream, Delay):
+    return Delay(lambda: bind(call, stream.realise(), goal))
+  return mplus(call(goal, stream.car),
+               Delay(lambda: bind(call, stream.cdr, goal)))
+
+@extend("goal-disj", "@callable @callable")
+def goal_disj(self, scope, args):
+  (g1, g2) = args
+  def run(scope, s):
+    return mplus(self.call(scope, g1, [s]),
+                 Delay(lambda: self.call(scope, g2, [s])))
+  return mkgoal(self, "goal-disj", run)
+
+@extend("goal-conj", "@callable @callable")
+def goal_conj(self, scope, args):
+  (g1, g2) = args
+  def run(scope, s):
+    call = lambda goal, s: self.call(scope, goal, [s])
+    return bind(call, call(g1, s), g2)
+  return mkgoal(self, "goal-conj", run)
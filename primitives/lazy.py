@@ -0,0 +1,111 @@
+import lisptypes as types
+from errors import LispException
+from primitives import extend
+import threading
+
+class Delay(types.Type):
+  """
+  A value computed by calling thunk the first time it is forced, and
+  remembered after that. Forcing is serialised by a lock, so the thunk
+  runs only once however many threads force it.
+  """
+  __slots__ = ("thunk", "lock")
+  type = "delay"
+
+  def __init__(self, thunk):
+    self.thunk = thunk
+    self.lock = threading.RLock()
+
+  def __eq__(self, other):
+    return self is other
+
+  __hash__ = object.__hash__
+
+  def realised(self):
+    return self.thunk is None
+
+  def realise(self):
+    "Run the thunk if it hasn't been run yet, and return its result."
+    with self.lock:
+      if self.thunk is not None:
+        self.value = self.thunk()
+        self.thunk = None
+      return self.value
+
+  def __repr__(self):
+    if self.realised():
+      return "<%s=%s>" % (self.type, repr(self.value))
+    return "<%s=unrealised>" % self.type
+
+class LazySeq(Delay):
+  "A Delay of a list, whose own tail may be lazy in turn."
+  __slots__ = ()
+  type = "lazy-seq"
+
+def force(value):
+  "Realise value, and whatever it realises to, until it isn't a Delay."
+  while isinstance(value, Delay):
+    value = value.realise()
+  return value
+
+def take(n, seq):
+  """
+  The first n elements of seq, or all of them if n is None, as a
+  list. Delays are forced as they are reached, in seq and in the tail
+  of each of its cells.
+  """
+  out = types.ListBuilder()
+  count = 0
+  while n is None or count < n:
+    seq = force(seq)
+    if not types.is_list(seq) or types.is_nil(seq):
+      break
+    out.append(seq.car)
+    count += 1
+    seq = seq.cdr
+  return out.build()
+
+class Thunk(object):
+  """
+  The forms of a delay or lazy-seq, evaluated in scope when called.
+  They are kept as attributes, so image.fork can copy the thunk.
+  """
+  __slots__ = ("rt", "scope", "forms")
+
+  def __init__(self, rt, scope, forms):
+    self.rt = rt
+    self.scope = scope
+    self.forms = forms
+
+  def __call__(self):
+    rv = types.nil
+    for form in self.forms:
+      rv = self.rt.eval(self.scope, form)
+    return rv
+
+@extend("delay", "&")
+def delay(self, scope, args):
+  return Delay(Thunk(self.rt, scope, args[0]))
+
+@extend("lazy-seq", "&")
+def lazy_seq(self, scope, args):
+  return LazySeq(Thunk(self.rt, scope, args[0]))
+
+@extend("force", "@any")
+def force_value(self, scope, args):
+  return force(args[0])
+
+@extend("delay?", "@any")
+def is_delay(self, scope, args):
+  return types.py_to_type(isinstance(args[0], Delay))
+
+@extend("take", "@number @any")
+def take_seq(self, scope, args):
+  (n, seq) = args
+  if not isinstance(n.value, (int, long)) or n.value < 0:
+    raise LispException("argument 1 of take must be a count, was %s" % n)
+  return take(n.value, seq)
+
+@extend("force-all", "@any")
+def force_all(self, scope, args):
+  return take(None, args[0])
@@ -0,0 +1,87 @@
+import lisptypes as types
+from errors import LispException
+from primitives import extend
+
+def car(l):
+  return types.nil if types.is_nil(l) else l.car
+
+def cdr(l):
+  return types.nil if types.is_nil(l) else l.cdr
+
+def predicate(name, value):
+  if value == types.true:
+    return True
+  if value == types.false:
+    return False
+  raise LispException("predicate of %s returned %s, not a boolean" %
+                      (name, types.type_name(value)))
+
+@extend("map", "@callable @list")
+def map_list(self, scope, args):
+  (func, l) = args
+  out = types.ListBuilder()
+  for el in l:
+    out.append(self.call(scope, func, [el]))
+  return out.build()
+
+@extend("filter", "@callable @list")
+def filter_list(self, scope, args):
+  (func, l) = args
+  out = types.ListBuilder()
+  for el in l:
+    if predicate("filter", self.call(scope, func, [el])):
+      out.append(el)
+  return out.build()
+
+@extend("reduce", "@&")
+def reduce_list(self, scope, args):
+  args = args[0]
+  if len(args) not in (2, 3):
+    raise LispException("reduce takes 2 or 3 arguments, %d given" % len(args))
+  func = args[0]
+  if not (types.is_function(func) or types.is_macro(func) or types.is_primitive(func)):
+    raise LispException("argument 1 of reduce must be callable, was %s" %
+                        types.type_name(func))
+  l = args[1]
+  if not types.is_list(l):
+    raise LispException("argument 2 of reduce must be list, was %s" %
+                        types.type_name(l))
+  if len(args) == 3:
+    acc = args[2]
+  else:
+    acc = self.call(scope, func, [car(l), car(cdr(l))])
+    l = cdr(cdr(l))
+  for el in l:
+    acc = self.call(scope, func, [acc, el])
+  return acc
+
+@extend("append", "@*")
+def append_lists(self, scope, args):
+  lists = args
+  if not lists:
+    return types.nil
+  out = types.ListBuilder()
+  for i in xrange(len(lists) - 1):
+    if not types.is_list(lists[i]):
+      raise LispException("argument %d of append must be list, was %s" %
+                          (i + 1, types.type_name(lists[i])))
+    for el in lists[i]:
+      out.append(el)
+  return out.build(lists[-1])
+
+@extend("reverse", "@list")
+def reverse_list(self, scope, args):
+  out = types.nil
+  for el in args[0]:
+    out = types.cons(el, out)
+  return out
+
+@extend("assq", "@any @any")
+def assq(self, scope, args):
+  (key, alist) = args
+  while types.is_list(alist) and not types.is_nil(alist):
+    el = alist.car
+    if types.is_list(el) and key == car(el):
+      return el
+    alist = alist.cdr
+  return types.nil
@@ -0,0 +1,37 @@
+import lisptypes as types
+from errors import LispException
+from primitives import extend
+from scope import namespace
+import modules
+
+@extend("require", "@&")
+def require(self, scope, args):
+  args = args[0]
+  if len(args) not in (1, 2):
+    raise LispException("require takes 1 or 2 arguments, %d given" % len(args))
+  if not types.is_string(args[0]):
+    raise LispException("argument 1 of require must be string, was %s" %
+                        types.type_name(args[0]))
+  if len(args) == 2 and not types.is_symbol(args[1]):
+    raise LispException("argument 2 of require must be symbol, was %s" %
+                        types.type_name(args[1]))
+  modules.require(self.rt, scope, args[0].value, *args[1:])
+  return types.nil
+
+@extend("export", "&")
+def export(self, scope, args):
+  ns = namespace(scope)
+  if ns is None:
+    raise LispException("export used outside of a module")
+  symbols = args[0]
+  for (i, symbol) in enumerate(symbols):
+    if not types.is_symbol(symbol):
+      raise LispException("argument %d of export must be symbol, was %s" %
+                          (i + 1, types.type_name(symbol)))
+  ns.module.exports = (ns.module.exports or []) + symbols
+  return types.nil
+
+@extend("module-stats", "")
+def module_stats(self, scope, args):
+  return types.mkmap([(types.String(path), types.py_to_type(seconds))
+                      for (path, seconds) in self.rt.modules.stats()])
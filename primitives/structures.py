@@ -0,0 +1,125 @@
+import lisptypes as types
+from errors import LispException
+from primitives import extend
+
+def index(name, n):
+  if not isinstance(n.value, (int, long)):
+    raise LispException("index of %s must be an integer, was %s" % (name, n))
+  return n.value
+
+def pair(name, value):
+  "The key and value of a (key . value) pair or [key value] vector."
+  if types.is_vector(value) and len(value) == 2:
+    return (value.value.nth(0), value.value.nth(1))
+  if types.is_list(value) and not types.is_nil(value):
+    return (value.car, value.cdr)
+  raise LispException("%s of a map takes a pair or a vector of two, was %s" %
+                      (name, types.type_name(value)))
+
+@extend("hash-map", "@*")
+def hash_map(self, scope, args):
+  if len(args) % 2:
+    raise LispException("hash-map takes an even number of arguments, %d given" %
+                        len(args))
+  return types.mkmap(zip(args[0::2], args[1::2]))
+
+@extend("hash-set", "@*")
+def hash_set(self, scope, args):
+  return types.mkset(args)
+
+@extend("vector", "@*")
+def vector(self, scope, args):
+  return types.mkvector(args)
+
+@extend("map?", "@any")
+def is_map(self, scope, args):
+  return types.py_to_type(types.is_map(args[0]))
+
+@extend("set?", "@any")
+def is_set(self, scope, args):
+  return types.py_to_type(types.is_set(args[0]))
+
+@extend("vector?", "@any")
+def is_vector(self, scope, args):
+  return types.py_to_type(types.is_vector(args[0]))
+
+@extend("assoc", "@map|vector @any @any")
+def assoc(self, scope, args):
+  (coll, key, value) = args
+  if types.is_map(coll):
+    return types.Map(coll.value.assoc(key, value))
+  if not types.is_number(key):
+    raise LispException("argument 2 of assoc on a vector must be number, was %s" %
+                        types.type_name(key))
+  i = index("assoc", key)
+  if not 0 <= i <= len(coll):
+    raise LispException("index %d out of range for assoc" % i)
+  return types.Vector(coll.value.assoc(i, value))
+
+@extend("dissoc", "@map|set @any")
+def dissoc(self, scope, args):
+  (coll, key) = args
+  if types.is_map(coll):
+    return types.Map(coll.value.dissoc(key))
+  return types.Set(coll.value.disj(key))
+
+@extend("get", "@&")
+def get(self, scope, args):
+  args = args[0]
+  if len(args) not in (2, 3):
+    raise LispException("get takes 2 or 3 arguments, %d given" % len(args))
+  (coll, key) = args[:2]
+  default = args[2] if len(args) == 3 else types.nil
+  if types.is_map(coll) or types.is_set(coll):
+    return coll.value.get(key, default)
+  if types.is_vector(coll):
+    if types.is_number(key) and isinstance(key.value, (int, long)) and \
+          0 <= key.value < len(coll):
+      return coll.value.nth(key.value)
+    return default
+  raise LispException("argument 1 of get must be map|set|vector, was %s" %
+                      types.type_name(coll))
+
+@extend("nth", "@vector|list @number")
+def nth(self, scope, args):
+  (coll, n) = args
+  i = index("nth", n)
+  if types.is_vector(coll):
+    if 0 <= i < len(coll):
+      return coll.value.nth(i)
+  elif i >= 0:
+    for el in coll:
+      if i == 0:
+        return el
+      i -= 1
+  raise LispException("index %d out of range for nth" % n.value)
+
+@extend("conj", "@list|vector|set|map @any")
+def conj(self, scope, args):
+  (coll, value) = args
+  if types.is_vector(coll):
+    return types.Vector(coll.value.conj(value))
+  if types.is_set(coll):
+    return types.Set(coll.value.conj(value))
+  if types.is_map(coll):
+    (key, value) = pair("conj", value)
+    return types.Map(coll.value.assoc(key, value))
+  return types.cons(value, coll)
+
+@extend("count", "@list|vector|set|map")
+def count(self, scope, args):
+  coll = args[0]
+  if types.is_list(coll):
+    n = 0
+    for el in coll:
+      n += 1
+    return types.py_to_type(n)
+  return types.py_to_type(len(coll))
+
+@extend("keys", "@map")
+def keys(self, scope, args):
+  return types.mklist(list(args[0].value))
+
+@extend("vals", "@map")
+def vals(self, scope, args):
+  return types.mklist([value for (key, value) in args[0].value.items()])
@@ -0,0 +1,136 @@
+## processes.py -- A pool of runtimes in other processes
+
+# Threads in one interpreter share its lock, so Lisp code that spends
+# its time computing runs no faster on several of them. The pool here
+# runs it in worker processes instead, each with a runtime of its own
+# loaded with rt.loli when the worker starts. Work is sent to them with
+# the wire module, along with whatever definitions it needs that
+# rt.loli doesn't provide.
+
+import os, atexit, threading
+import multiprocessing
+import wire
+import lisptypes as types
+from errors import LispException
+
+prelude = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rt.loli")
+
+def default_size():
+  "The pool size given by $LOLISP_PROCESSES, or else the number of CPUs."
+  size = os.environ.get("LOLISP_PROCESSES")
+  if size:
+    return int(size)
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 2
+
+def standard_rt():
+  from rt import RT
+  rt = RT()
+  rt.load_file(rt.ns, prelude)
+  return rt
+
+# The runtime of a worker process, and what it has defined.
+worker_rt = None
+worker_standard = None
+
+def init_worker():
+  global worker_rt, worker_standard
+  worker_rt = standard_rt()
+  worker_standard = wire.Standard(worker_rt.ns)
+
+def run_task(mode, data):
+  """
+  Run a task in a worker. For "call", data holds a function and its
+  arguments; for "map", a function and a list to map it over. Returns
+  ("ok", packed result) or ("error", message).
+  """
+  try:
+    rt = worker_rt
+    values = wire.unpack(data, rt)
+    if mode == "call":
+      rv = rt.prims.call(rt.ns, values[0], values[1:])
+    else:
+      rv = [rt.prims.call(rt.ns, values[0], [el]) for el in values[1]]
+    return ("ok", wire.pack(rv if mode == "map" else [rv], worker_standard))
+  except LispException as e:
+    return ("error", str(e))
+  except Exception as e:
+    return ("error", "%s: %s" % (e.__class__.__name__, e))
+
+class Pool(object):
+  "Worker processes running tasks sent from this one."
+
+  def __init__(self, size = None):
+    self.size = size or default_size()
+    if self.size < 1:
+      raise ValueError("process pool size must be at least 1, was %d" % self.size)
+    self.pool = multiprocessing.Pool(self.size, init_worker)
+    self.standard = wire.Standard(standard_rt().ns)
+
+  def submit(self, rt, mode, values, callback):
+    """
+    Send values to a worker, and call callback with ("ok", values) or
+    ("error", message) from a pool thread when it's done.
+    """
+    data = wire.pack(values, self.standard)
+    def done(result):
+      try:
+        (status, rv) = result
+        if status == "ok":
+          rv = wire.unpack(rv, rt)
+        callback((status, rv))
+      except Exception as e:
+        callback(("error", str(e)))
+    self.pool.apply_async(run_task, (mode, data), callback = done)
+
+  def map(self, rt, func, items, chunks = None):
+    """
+    func applied to each of items in the workers, split into chunks
+    to send, returning a list of the results.
+    """
+    if not items:
+      return []
+    chunks = chunks or self.size * 4
+    n = -(-len(items) // chunks)
+    data = [wire.pack([func, types.mklist(items[i:i + n])], self.standard)
+            for i in xrange(0, len(items), n)]
+    out = []
+    for (status, rv) in self.pool.map(run_task_map, data, 1):
+      if status != "ok":
+        raise LispException(rv)
+      out.extend(wire.unpack(rv, rt))
+    return out
+
+  def shutdown(self):
+    self.pool.terminate()
+
+def run_task_map(data):
+  return run_task("map", data)
+
+shared_pool = None
+shared_lock = threading.Lock()
+
+def configure(size = None):
+  "Replace the shared pool, for tasks submitted from now on."
+  global shared_pool
+  with shared_lock:
+    if shared_pool is not None:
+      shared_pool.shutdown()
+    shared_pool = Pool(size)
+  return shared_pool
+
+def shared():
+  "The pool pfuture and ppmap run on, started on first use."
+  global shared_pool
+  with shared_lock:
+    if shared_pool is None:
+      shared_pool = Pool()
+    return shared_pool
+
+@atexit.register
+def shutdown():
+  with shared_lock:
+    if shared_pool is not None:
+      shared_pool.shutdown()
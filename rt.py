@@ -1,43 +1,35 @@
 import lisptypes as types
 from load import load
+import cache, image
 from primitives import Primitives
 from errors import LispException
-import threading
-
-class Scope(dict):
-  def __init__(self, callable = None, parent = None, extend = {}):
-    dict.__init__(self)
-    self.callable = callable
-    self.parent = parent
-    self.lock = threading.Lock()
-    self.extend(extend)
-
-  def define(self, symbol, value):
-    if types.is_symbol(symbol):
-      symbol = symbol.value
-    self.lock.acquire()
-    self[symbol] = value
-    self.lock.release()
-    return value
-
-  def extend(self, d):
-    for key in d:
-      self.define(key, d[key])
-
-  def lookup(self, key):
-    rv = None
-    self.lock.acquire()
-    if self.has_key(key):
-      rv = self[key]
-    elif self.parent:
-      rv = self.parent.lookup(key)
-    self.lock.release()
-    return rv
+from compiler import Compiler
+from vm import VM
+from jit import JIT
+from scope import Scope, namespace, bind
+import modules
 
 class RT(object):
-  def __init__(self, ns = None):
+  """
+  The runtime. Function bodies are compiled to closures by a
+  compiler.Compiler on first use, unless compiled is false, in which
+  case they are interpreted by walking their forms on every call. With
+  bytecode set, they are compiled to bytecode for a vm.VM instead, and
+  with jit set, hot functions are translated to Python by a jit.JIT.
+  """
+
+  def __init__(self, ns = None, prims = None, compiled = True, bytecode = False,
+               jit = False):
+    if bytecode:
+      self.compiler = VM(self)
+    elif jit:
+      self.compiler = JIT(self)
+    else:
+      self.compiler = Compiler(self) if compiled else None
     if ns:
       self.ns = ns
+      self.prims = prims
+      self.modules = prims.rt.modules
     else:
       prims = Primitives(self)
 
@@ -45,31 +37,64 @@ class RT(object):
       prims.extend(primitives.math)
       import primitives.concurrent
       prims.extend(primitives.concurrent)
-
+      import primitives.lists
+      prims.extend(primitives.lists)
+      import primitives.structures
+      prims.extend(primitives.structures)
+      import primitives.lazy
+      prims.extend(primitives.lazy)
+      import primitives.kanren
+      prims.extend(primitives.kanren)
+      import primitives.require
+      prims.extend(primitives.require)
+
+      self.prims = prims
       self.ns = Scope(extend = prims)
+      self.modules = modules.Registry(self)
+
+  def engine(self):
+    "The keyword arguments selecting this runtime's engine."
+    return { "compiled": self.compiler is not None,
+             "bytecode": isinstance(self.compiler, VM),
+             "jit": isinstance(self.compiler, JIT) }
 
   def clone(self):
-    return RT(ns = self.ns)
+    return RT(ns = self.ns, prims = self.prims, **self.engine())
+
+  def fork(self):
+    """
+    A new runtime with a copy of this one's definitions, which can be
+    changed without affecting this one. See image.fork.
+    """
+    return image.fork(self)
 
   def lookup(self, scope, symbol):
-    value = scope.lookup(symbol.value)
+    value = scope.lookup(symbol)
     if value:
       return value
     raise LispException("symbol \"%s\" is undefined" % symbol.value)
 
-  def define(self, symbol, value):
-    return self.ns.define(symbol, value)
+  def define(self, symbol, value, scope = None):
+    """
+    Define symbol globally, or in the namespace of the module scope
+    belongs to, if it belongs to one.
+    """
+    ns = namespace(scope)
+    return (self.ns if ns is None else ns).define(symbol, value)
 
   def eval(self, scope, exp):
     """
     If exp is a list, execute it as a function call.
     If exp is a symbol, resolve it.
+    If exp is a map, set or vector, evaluate its elements.
     Else, return it as is.
     """
     if types.is_list(exp) and not types.is_nil(exp):
       return self.execute(scope, exp)
     elif types.is_symbol(exp):
       return self.lookup(scope, exp)
+    elif types.is_collection(exp):
+      return exp.map_forms(lambda form: self.eval(scope, form))
     else:
       return exp
 
@@ -79,30 +104,10 @@ class RT(object):
     if types.is_primitive(func):
       return func.invoke(scope, args)
 
-    try:
-      rest = list((i.value for i in func.sig)).index("&")
-    except ValueError:
-      rest = -1
-      if len(args) != len(func.sig):
-        raise LispException("%s takes %d arguments, %d given" %
-                            (types.type_name(func),
-                             len(func.sig), len(args)))
-    else:
-      if len(args) < rest:
-        raise LispException("%s takes at least %d arguments, %d given" %
-                            (types.type_name(func), rest, len(args)))
-
-    closure = scope if tailrec else Scope(func, func.scope)
-    for i in xrange(len(args)):
-      if func.sig[i].value == "&":
-        closure.define(func.sig[rest+1].value,
-                       types.mklist(args[rest:]))
-        rest = -1
-        break
-      else:
-        closure.define(func.sig[i].value, args[i])
-    if rest >= 0:
-      closure.define(func.sig[rest+1].value, types.nil)
+    closure = bind(func, args, scope if tailrec else None)
+
+    if self.compiler:
+      return self.compiler.run(func, closure)
 
     rv = types.nil
     for sexp in func.value:
@@ -134,3 +139,8 @@ class RT(object):
   def load(self, scope, stream):
     for sexp in load(stream):
       self.execute(scope, sexp)
+
+  def load_file(self, scope, path):
+    "Like load, but reading the file at path through the cache."
+    for sexp in cache.read(path):
+      self.execute(scope, sexp)
@@ -0,0 +1,154 @@
+## scope.py -- Global namespaces and function call frames
+
+import lisptypes as types
+from errors import LispException
+import threading
+
+class Scope(dict):
+  """
+  A namespace of global definitions, keyed by symbol.
+
+  Namespaces are shared between threads. Reads take no lock, relying
+  on single dict operations being atomic; definitions are serialised
+  by a lock, so concurrent writers can't interleave.
+  """
+
+  def __init__(self, callable = None, parent = None, extend = {}):
+    dict.__init__(self)
+    self.callable = callable
+    self.parent = parent
+    self.lock = threading.Lock()
+    self.watchers = {}
+    self.extend(extend)
+
+  def define(self, symbol, value):
+    symbol = types.mksymbol(symbol)
+    with self.lock:
+      self[symbol] = value
+      watchers = self.watchers.pop(symbol, None) if self.watchers else None
+    for watcher in list(watchers or ()):
+      watcher(symbol)
+    return value
+
+  def watch(self, symbol, watcher):
+    """
+    Call watcher with symbol the next time symbol is defined here, for
+    code that has assumed the definition it had to learn it's changed.
+    """
+    with self.lock:
+      self.watchers.setdefault(symbol, []).append(watcher)
+
+  def unwatch(self, symbol, watcher):
+    """
+    Stop calling watcher for symbol. This takes no lock, so it can be
+    called from a weakref callback, which may run while it's held.
+    """
+    watchers = self.watchers.get(symbol)
+    try:
+      watchers.remove(watcher)
+    except (AttributeError, ValueError):
+      pass
+
+  def extend(self, d):
+    for key in d:
+      self.define(key, d[key])
+
+  def lookup(self, key):
+    if key.__class__ is not types.Symbol:
+      key = types.Symbol(key)
+    scope = self
+    while scope is not None:
+      rv = scope.get(key)
+      if rv is not None:
+        return rv
+      scope = scope.parent
+    return None
+
+class Namespace(Scope):
+  """
+  The namespace of a module, holding its own definitions, over the
+  global ones of its runtime as its parent.
+  """
+
+  def __init__(self, module, parent):
+    Scope.__init__(self, parent = parent)
+    self.module = module
+
+def namespace(scope):
+  "The namespace of the module scope belongs to, or None."
+  while scope is not None and scope.__class__ is not Namespace:
+    scope = scope.parent
+  return scope
+
+rest_marker = types.mksymbol("&")
+
+class Params(object):
+  """
+  The parameter list of a function: the symbols it binds, in slot
+  order, and the slot of its & rest parameter, or -1 if it has none.
+  """
+
+  def __init__(self, sig):
+    names = list(sig)
+    self.arity = len(names)
+    if rest_marker in names:
+      self.rest = names.index(rest_marker)
+      names = names[:self.rest] + names[self.rest + 1:self.rest + 2]
+    else:
+      self.rest = -1
+    self.names = names
+    self.index = dict((name, i) for (i, name) in enumerate(names))
+
+def params(func):
+  try:
+    return func.params
+  except AttributeError:
+    func.params = Params(func.sig)
+    return func.params
+
+class Frame(object):
+  """
+  The local variables of a function call, held in a list of slots in
+  the order of the function's Params. parent is the scope the function
+  was created in, so a chain of frames always ends in a Scope.
+  """
+  __slots__ = ("callable", "parent", "index", "slots")
+
+  def __init__(self, callable, parent, index, slots):
+    self.callable = callable
+    self.parent = parent
+    self.index = index
+    self.slots = slots
+
+  def lookup(self, key):
+    if key.__class__ is not types.Symbol:
+      key = types.Symbol(key)
+    scope = self
+    while scope.__class__ is Frame:
+      i = scope.index.get(key)
+      if i is not None:
+        return scope.slots[i]
+      scope = scope.parent
+    return scope.lookup(key)
+
+def bind(func, args, frame = None):
+  """
+  Bind args to the parameters of func in a new frame, or in frame if
+  given, which must be a frame of func.
+  """
+  p = params(func)
+  if p.rest < 0:
+    if len(args) != p.arity:
+      raise LispException("%s takes %d arguments, %d given" %
+                          (types.type_name(func), p.arity, len(args)))
+    slots = args
+  else:
+    if len(args) < p.rest:
+      raise LispException("%s takes at least %d arguments, %d given" %
+                          (types.type_name(func), p.rest, len(args)))
+    slots = args[:p.rest]
+    slots.append(types.mklist(args[p.rest:]))
+  if frame is None:
+    return Frame(func, func.scope, p.index, slots)
+  frame.slots = slots
+  return frame
@@ -0,0 +1,87 @@
+import os, time, zlib
+from random import Random
+import cache
+from load import load
+from rt import RT
+
+def write(path, source):
+  with open(path, "w") as f:
+    f.write(source)
+
+def forms(source):
+  return [repr(form) for form in load(source)]
+
+def test_round_trip(tmpdir):
+  path = str(tmpdir.join("a.loli"))
+  source = "(define x '(1 2.5 1/3 \"s\" [a {b c} #{d}])) (x . y)"
+  write(path, source)
+  assert [repr(form) for form in cache.read(path)] == forms(source)
+  assert os.path.exists(cache.cache_path(path))
+  assert [repr(form) for form in cache.read(path)] == forms(source)
+
+def test_changed_source_is_read_again(tmpdir):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(a)")
+  cache.read(path)
+  write(path, "(b c)")
+  os.utime(path, (time.time() + 10, time.time() + 10))
+  assert [repr(form) for form in cache.read(path)] == ["(b c)"]
+
+def test_touched_source_uses_hash(tmpdir, monkeypatch):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(a)")
+  cache.read(path)
+  os.utime(path, (time.time() + 10, time.time() + 10))
+  monkeypatch.setattr(cache, "load", None)
+  assert [repr(form) for form in cache.read(path)] == ["(a)"]
+  # And the new mtime is recorded.
+  assert cache.read_cache(path)[0] == os.stat(path).st_mtime
+
+def test_corrupt_cache_ignored(tmpdir):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(a 1.5 \"s\" [b])")
+  expected = forms("(a 1.5 \"s\" [b])")
+  cache.read(path)
+  with open(cache.cache_path(path), "rb") as f:
+    valid = f.read()
+  (head, payload) = (valid[:cache.header.size], valid[cache.header.size:])
+  random = Random(0)
+  garbled = []
+  for i in xrange(200):
+    data = bytearray(payload)
+    for j in xrange(random.randint(1, 4)):
+      data[random.randrange(len(data))] = random.randrange(256)
+    garbled.append(head + str(data))
+  fields = cache.header.unpack(head)
+  # Damage the CRC can't see, as the CRC is taken after it.
+  forged = [cache.header.pack(*(fields[:-1] + (zlib.crc32(p) & 0xffffffff,))) + p
+            for p in (payload[:-5], payload[:len(payload) / 2], "\x00" * 20)]
+  for junk in ["", "LOLC", "x" * 100, head + "junk", head + payload[:-5],
+               head + payload[:len(payload) / 2]] + garbled + forged:
+    with open(cache.cache_path(path), "wb") as f:
+      f.write(junk)
+    assert [repr(form) for form in cache.read(path)] == expected
+
+def test_disabled(tmpdir, monkeypatch):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(a)")
+  monkeypatch.setenv("LOLISP_NO_CACHE", "1")
+  assert [repr(form) for form in cache.read(path)] == ["(a)"]
+  assert not os.path.exists(cache.cache_path(path))
+
+def test_unwritable_directory(tmpdir, monkeypatch):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(a)")
+  def fail(*args, **kwargs):
+    raise OSError("read-only")
+  monkeypatch.setattr(cache.tempfile, "mkstemp", fail)
+  assert [repr(form) for form in cache.read(path)] == ["(a)"]
+  assert os.listdir(str(tmpdir)) == ["a.loli"]
+
+def test_require_uses_cache(tmpdir):
+  path = str(tmpdir.join("a.loli"))
+  write(path, "(define from-a 5)")
+  rt = RT()
+  rt.execute(rt.ns, load("(require \"%s\")" % path).car)
+  assert rt.ns.lookup(load("from-a").car).value == 5
+  assert os.path.exists(cache.cache_path(path))
@@ -0,0 +1,114 @@
+import pytest
+import lisptypes as types
+from errors import LispException
+from rt import RT
+from conftest import bootstrapped, run, with_recursion_limit
+
+def test_compiled_by_default():
+  assert RT().compiler
+  assert not RT(compiled = False).compiler
+
+def test_body_compiled_once():
+  rt = RT()
+  run(rt, "(define f (lambda (x) ((lambda (y) (cons x y)) 2)))")
+  f = rt.ns.lookup("f")
+  assert repr(run(rt, "(f 1)")) == "(1 . 2)"
+  code = f.code
+  run(rt, "(f 3)")
+  assert f.code is code
+
+def test_closures_share_code():
+  rt = RT()
+  run(rt, "(define mk (lambda (x) (lambda () x)))")
+  a = run(rt, "(mk 1)")
+  b = run(rt, "(mk 2)")
+  assert a.code is b.code
+  assert run(rt, "((mk 5))").value == 5
+
+def test_quasiquote():
+  rt = RT()
+  run(rt, "(define f (lambda (x & xs) '(a ~x (b ~@xs) c)))")
+  assert repr(run(rt, "(f 1 2 3)")) == "(a 1 (b 2 3) c)"
+
+def test_primitive_rebinding():
+  rt = RT()
+  run(rt, "(define f (lambda (op) (op 6 3)))")
+  assert run(rt, "(f +)").value == 9
+  assert run(rt, "(f -)").value == 3
+  assert run(rt, "(f cons)") == types.cons(types.py_to_type(6),
+                                           types.py_to_type(3))
+
+def test_same_errors():
+  for compiled in (True, False):
+    rt = RT(compiled = compiled)
+    run(rt, "(define f (lambda (x) (cond (x 1))))")
+    with pytest.raises(LispException) as e:
+      run(rt, "(f 5)")
+    assert str(e.value) == "expr x does not evaluate to a boolean"
+    run(rt, "(define g (lambda () (undefined-thing)))")
+    with pytest.raises(LispException) as e:
+      run(rt, "(g)")
+    assert str(e.value) == "symbol \"undefined-thing\" is undefined"
+
+def test_lexical_shadowing():
+  for compiled in (True, False):
+    rt = RT(compiled = compiled)
+    run(rt, "(define x 1)")
+    run(rt, "(define f (lambda (x) (lambda (y) (lambda (x) (cons x y)))))")
+    assert repr(run(rt, "(((f 1) 2) 3)")) == "(3 . 2)"
+    run(rt, "(define g (lambda (y) (cons x y)))")
+    assert repr(run(rt, "(g 2)")) == "(1 . 2)"
+    run(rt, "(define x 5)")
+    assert repr(run(rt, "(g 2)")) == "(5 . 2)"
+
+def test_deep_closure():
+  rt = RT()
+  run(rt, """(define f (lambda (a) (lambda (b) (lambda (c)
+               (lambda (d) (lambda (e) (cons a e)))))))""")
+  assert repr(run(rt, "(((((f 1) 2) 3) 4) 5)")) == "(1 . 5)"
+
+evens_and_odds = """
+  (define even-odd-rt? (lambda (n) (cond ((= n 0) true) (else (odd-rt? (- n 1))))))
+  (define odd-rt? (lambda (n) (cond ((= n 0) false) (else (even-odd-rt? (- n 1))))))
+"""
+
+def test_tail_calls_use_constant_stack():
+  rt = RT()
+  run(rt, evens_and_odds)
+  run(rt, "(define count (lambda (n acc) (cond ((= n 0) acc) (else (recur (- n 1) (+ acc 1))))))")
+  assert run(rt, "(even-odd-rt? 10)") == types.true
+  assert run(rt, "(count 10 0)").value == 10
+  assert with_recursion_limit(150, lambda: run(rt, "(even-odd-rt? 5001)")) == types.false
+  assert with_recursion_limit(150, lambda: run(rt, "(count 5000 0)")).value == 5000
+
+def test_tail_calls_through_macros():
+  rt = bootstrapped()
+  run(rt, """(defn loop (n acc)
+               (let ((m (- n 1)))
+                 (cond ((and (> n 0) true) (loop m (+ acc 1)))
+                       (else acc))))""")
+  assert with_recursion_limit(200, lambda: run(rt, "(loop 1000 0)")).value == 1000
+
+def test_million_tail_calls():
+  rt = RT()
+  run(rt, evens_and_odds)
+  assert run(rt, "(even-odd-rt? 1000000)") == types.true
+
+def test_macro_expansion_cached():
+  rt = RT()
+  run(rt, """
+    (define twice (macro (x) '(cons ~x ~x)))
+    (define f (lambda (n) (twice n)))""")
+  assert repr(run(rt, "(f 1)")) == "(1 . 1)"
+  assert repr(run(rt, "(f 2)")) == "(2 . 2)"
+  assert repr(run(rt, "(macro-cache-stats)")) == "((hits . 1) (misses . 1))"
+
+def test_macro_redefinition_invalidates():
+  rt = RT()
+  run(rt, """
+    (define twice (macro (x) '(cons ~x ~x)))
+    (define f (lambda (n) (twice n)))""")
+  assert repr(run(rt, "(f 1)")) == "(1 . 1)"
+  run(rt, "(define twice (macro (x) '(cons ~x nil)))")
+  assert repr(run(rt, "(f 1)")) == "(1)"
+  assert rt.compiler.macro_misses == 2
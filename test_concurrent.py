@@ -0,0 +1,111 @@
+import threading
+import pytest
+import lisptypes as types
+from errors import LispException
+from rt import RT
+from primitives.concurrent import Atom
+from conftest import run
+
+def call(func, args):
+  return func(*args)
+
+def test_swap_retries_on_conflict():
+  a = Atom(0)
+  raced = []
+  def inc(n):
+    # Change the atom underneath the first attempt.
+    if not raced:
+      raced.append(1)
+      a.reset(call, 10)
+    return n + 1
+  assert a.swap(call, inc) == 11
+  assert (a.swaps, a.retries) == (2, 1)
+
+def test_concurrent_swaps_lose_no_updates():
+  a = Atom(0)
+  def work():
+    for i in xrange(1000):
+      a.swap(call, lambda n: n + 1)
+  threads = [threading.Thread(target = work) for i in xrange(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert a.deref() == 8000
+  assert a.swaps == 8000
+
+def test_deref_does_not_wait_for_swap():
+  a = Atom(1)
+  entered = threading.Event()
+  release = threading.Event()
+  def slow(n):
+    entered.set()
+    release.wait()
+    return n + 1
+  t = threading.Thread(target = a.swap, args = (call, slow))
+  t.start()
+  entered.wait()
+  assert a.deref() == 1
+  release.set()
+  t.join()
+  assert a.deref() == 2
+
+def test_swap_errors_propagate():
+  rt = RT()
+  run(rt, "(define a (atom 1))")
+  with pytest.raises(LispException):
+    run(rt, "(swap! a (lambda (n) (nope n)))")
+  assert repr(run(rt, "@a")) == "1"
+
+def test_validator_rejects():
+  rt = RT()
+  run(rt, "(define a (atom 1))")
+  run(rt, "(set-validator! a (lambda (n) (< n 10)))")
+  with pytest.raises(LispException):
+    run(rt, "(reset! a 11)")
+  with pytest.raises(LispException):
+    run(rt, "(set-validator! a (lambda (n) (< n 0)))")
+  assert repr(run(rt, "@a")) == "1"
+
+def test_failed_future_raises_original_exception():
+  rt = RT()
+  run(rt, "(define f (future really-not-defined))")
+  with pytest.raises(LispException) as e:
+    run(rt, "@f")
+  assert "really-not-defined" in str(e.value)
+  with pytest.raises(LispException):
+    run(rt, "(deref f 1 'default)")
+
+def test_deref_times_out():
+  import time
+  rt = RT()
+  run(rt, "(define p (promise))")
+  started = time.time()
+  assert repr(run(rt, "(deref p 0.05 'none)")) == "none"
+  assert 0.05 <= time.time() - started < 1
+
+def test_cancel_unstarted_future():
+  import workers
+  pool = workers.configure(1)
+  try:
+    rt = RT()
+    run(rt, "(define gate (promise))")
+    run(rt, "(define blocker (future @gate))")
+    run(rt, "(define f (future 'ran))")
+    assert run(rt, "(future-cancel f)") is types.true
+    run(rt, "(deliver gate 1)")
+    assert repr(run(rt, "@blocker")) == "1"
+    with pytest.raises(LispException):
+      run(rt, "@f")
+    assert pool.stats()["cancelled"] == 1
+  finally:
+    workers.configure()
+
+def test_nil_is_a_value():
+  rt = RT()
+  run(rt, "(define p (promise))")
+  assert run(rt, "(realized? p)") is types.false
+  run(rt, "(deliver p nil)")
+  assert run(rt, "(realized? p)") is types.true
+  assert run(rt, "(realised? p)") is types.true
+  assert run(rt, "(deref p 0 'none)") is types.nil
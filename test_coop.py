@@ -0,0 +1,86 @@
+import os.path, threading, time
+import pytest
+import lisptypes as types
+from errors import LispException
+from load import load
+from rt import RT
+import coop
+from primitives.concurrent import Ref
+
+@pytest.fixture(scope = "module")
+def rt():
+  rt = RT()
+  rt.load(rt.ns, file(os.path.join(os.path.dirname(__file__), "rt.loli")))
+  return rt
+
+@pytest.fixture
+def loop(rt):
+  return coop.Loop(rt)
+
+def run(loop, source):
+  return loop.run(loop.rt.ns, list(load(source)))
+
+def test_evaluates_like_the_runtime(loop):
+  run(loop, """
+   (defn fib (n) (cond ((< n 2) n) (else (+ (fib (- n 1)) (fib (- n 2))))))""")
+  assert run(loop, "(fib 12)") == types.py_to_type(144)
+  assert run(loop, "(let ((a 1)) (+ a 2))") == types.py_to_type(3)
+
+def test_tail_calls_run_in_constant_space(loop):
+  run(loop, """
+   (defn count-down (n) (cond ((= n 0) 'done) (else (count-down (- n 1)))))""")
+  assert run(loop, "(count-down 50000)") == types.mksymbol("done")
+
+def test_sleeping_tasks_overlap(loop):
+  start = time.time()
+  rv = run(loop, """
+   (define a (future (sleep 0.2) 1))
+   (define b (future (sleep 0.2) 2))
+   (+ @a @b)""")
+  assert rv == types.py_to_type(3)
+  assert time.time() - start < 0.35
+  assert loop.stats()["spawned"] == 3
+
+def test_many_tasks_share_one_thread(loop):
+  before = threading.active_count()
+  run(loop, """
+   (defn spawn-n (n acc)
+     (cond ((= n 0) acc)
+           (else (spawn-n (- n 1) (cons (future (sleep 0.01) 1) acc)))))
+   (defn sum-refs (refs acc)
+     (cond ((nil? refs) acc)
+           (else (sum-refs (cdr refs) (+ acc @(car refs))))))""")
+  assert run(loop, "(sum-refs (spawn-n 10000 nil) 0)") == types.py_to_type(10000)
+  assert threading.active_count() == before
+
+def test_deref_of_promise_delivered_from_another_thread(loop):
+  rv = run(loop, """
+   (define p (promise))
+   (future (sleep 0.05) (deliver p 42))
+   @p""")
+  assert rv == types.py_to_type(42)
+
+def test_deref_of_ref_settled_by_another_thread(loop):
+  ref = Ref()
+  loop.rt.define(types.mksymbol("outside"), ref)
+  threading.Timer(0.05, lambda: ref.realise(types.py_to_type(7))).start()
+  assert run(loop, "@(future @outside)") == types.py_to_type(7)
+  assert loop.stats()["external"] == 0
+
+def test_deref_times_out(loop):
+  assert run(loop, "(deref (promise) 0.05 'late)") == types.mksymbol("late")
+
+def test_errors_propagate_to_deref(loop):
+  with pytest.raises(LispException):
+    run(loop, "@(future (car 5))")
+
+def test_deadlock_is_reported(loop):
+  with pytest.raises(LispException) as e:
+    run(loop, "(define f (future @f)) @f")
+  assert "deadlock" in str(e.value)
+
+def test_cancel_before_start(loop):
+  rv = run(loop, """
+   (define f (future (sleep 1) 1))
+   [(future-cancel f) (future-cancelled? f)]""")
+  assert list(rv) == [types.true, types.true]
@@ -0,0 +1,113 @@
+import pytest
+import lisptypes as types
+from errors import LispException
+from vm import VM
+import image
+from conftest import bootstrapped, run
+
+def base_rt(**engine):
+  rt = bootstrapped(**engine)
+  run(rt, """
+    (defn make-counter (n) (lambda () n))
+    (define five (make-counter 5))
+    (defn fact (n) (cond ((= n 0) 1) (else (* n (fact (- n 1))))))
+    (define head car)
+    (defmacro twice (x) '(cons ~x ~x))""")
+  return rt
+
+def check_definitions(rt):
+  assert run(rt, "(five)").value == 5
+  assert run(rt, "(fact 5)").value == 120
+  assert run(rt, "(head '(1 2))").value == 1
+  assert repr(run(rt, "(twice 1)")) == "(1 . 1)"
+  assert repr(run(rt, "(map (lambda (x) (* x x)) '(1 2 3))")) == "(1 4 9)"
+
+def test_fork_copies_definitions():
+  base = base_rt()
+  rt = base.fork()
+  check_definitions(rt)
+  assert rt.ns.lookup("fact") is not base.ns.lookup("fact")
+  assert rt.ns.lookup("fact").scope is rt.ns
+  assert rt.ns.lookup("five").scope.parent is rt.ns
+  assert rt.ns.lookup("head") is rt.prims["car"]
+
+def test_fork_is_independent():
+  base = base_rt()
+  rt = base.fork()
+  run(rt, "(define * +) (define only-in-fork 1)")
+  assert run(rt, "(fact 3)").value == 7
+  assert run(base, "(fact 3)").value == 6
+  assert base.ns.lookup("only-in-fork") is None
+  run(base, "(define only-in-base 1)")
+  assert rt.ns.lookup("only-in-base") is None
+
+def test_fork_copies_functions_in_values():
+  base = base_rt()
+  run(base, """
+    (define x 1)
+    (define fs (cons (lambda () x) nil))
+    (define v [(lambda () x)])
+    (define m {'f (lambda () x)})
+    (define d (delay (+ x 1)))
+    (define data '(1 2 3))""")
+  rt = base.fork()
+  run(rt, "(define x 2)")
+  run(base, "(define x 3)")
+  assert run(rt, "((car fs))").value == 2
+  assert run(rt, "((nth v 0))").value == 2
+  assert run(rt, "((get m 'f))").value == 2
+  assert run(rt, "(force d)").value == 3
+  assert run(base, "((car fs))").value == 3
+  assert run(base, "(force d)").value == 4
+  assert rt.ns.lookup("data") is base.ns.lookup("data")
+
+def test_fork_copies_atoms():
+  base = base_rt()
+  run(base, """
+    (define x 2)
+    (define seen (atom nil))
+    (define a (atom 1))
+    (set-validator! a (lambda (v) (< v x)))
+    (add-watch a 'w (lambda (k r old new) (reset! seen new)))
+    (define same (cons a a))""")
+  rt = base.fork()
+  run(rt, "(define x 10) (reset! a 5)")
+  assert run(rt, "@a").value == 5
+  assert run(rt, "@seen").value == 5
+  assert run(base, "@a").value == 1
+  assert run(base, "@seen") is types.nil
+  with pytest.raises(LispException):
+    run(base, "(reset! a 5)")
+  assert run(rt, "(car same)") is run(rt, "a")
+  assert run(rt, "(cdr same)") is run(rt, "a")
+
+def test_fork_keeps_engine():
+  base = base_rt(bytecode = True)
+  assert isinstance(base.fork().compiler, VM)
+  assert not isinstance(image.fork(base, compiled = True).compiler, VM)
+  check_definitions(base.fork())
+
+def test_save_and_restore(tmpdir):
+  path = str(tmpdir.join("base.image"))
+  image.save(base_rt(), path)
+  rt = image.restore(path)
+  check_definitions(rt)
+  assert rt.ns.lookup("five").scope.parent is rt.ns
+  assert rt.ns.lookup("head") is rt.prims["car"]
+  check_definitions(image.restore(path, bytecode = True))
+
+def test_unsaveable_definitions(tmpdir):
+  rt = base_rt()
+  run(rt, "(define counter (atom 0))")
+  with pytest.raises(LispException) as e:
+    image.save(rt, str(tmpdir.join("base.image")))
+  assert str(e.value).startswith("can't save counter in an image")
+  assert tmpdir.listdir() == []
+
+def test_not_an_image(tmpdir):
+  path = tmpdir.join("junk.image")
+  for junk in ("", "junk", "\x00" * 10):
+    path.write(junk)
+    with pytest.raises(LispException) as e:
+      image.restore(str(path))
+    assert str(e.value) == "%s is not a lolisp image" % path
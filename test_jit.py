@@ -0,0 +1,152 @@
+import pytest, gc, weakref
+import lisptypes as types
+from errors import LispException
+from rt import RT
+from jit import JIT
+from conftest import bootstrapped, run, with_recursion_limit
+
+def jit_rt(threshold = 2):
+  rt = bootstrapped(jit = True)
+  rt.compiler.threshold = threshold
+  return rt
+
+def native(rt, name):
+  return rt.ns.lookup(name).native
+
+fib = "(defn fib (n) (cond ((< n 2) n) (else (+ (fib (- n 1)) (fib (- n 2))))))"
+
+def test_selected_by_option():
+  assert isinstance(RT(jit = True).compiler, JIT)
+  assert isinstance(RT(jit = True).clone().compiler, JIT)
+
+def test_translated_past_threshold():
+  rt = jit_rt(threshold = 5)
+  run(rt, fib)
+  assert run(rt, "(fib 2)").value == 1
+  assert native(rt, "fib") == 3
+  assert run(rt, "(fib 15)").value == 610
+  assert callable(native(rt, "fib"))
+  assert "if " in native(rt, "fib").source
+  assert rt.compiler.translated == 1
+
+def test_cond_and_let():
+  rt = jit_rt()
+  run(rt, """
+   (defn classify (n)
+     (let ((m (* n 2)))
+       (cond ((< m 0) 'negative)
+             ((= m 0) 'zero)
+             (else (cons 'positive m)))))""")
+  for i in xrange(3):
+    assert [repr(run(rt, "(classify %d)" % n)) for n in (-1, 0, 2)] == \
+        ["negative", "zero", "(positive . 4)"]
+  assert "elif" in native(rt, "classify").source
+
+def test_self_tail_calls_loop():
+  rt = jit_rt()
+  run(rt, """(defn loop (n acc)
+               (let ((m (- n 1)))
+                 (cond ((and (> n 0) true) (loop m (+ acc 1)))
+                       (else acc))))""")
+  run(rt, "(defn count (n acc) (cond ((= n 0) acc) (else (recur (- n 1) (+ acc 1)))))")
+  run(rt, "(loop 3 0) (loop 3 0) (count 3 0) (count 3 0)")
+  assert "continue" in native(rt, "loop").source
+  assert with_recursion_limit(100, lambda: run(rt, "(loop 5000 0)")).value == 5000
+  assert with_recursion_limit(100, lambda: run(rt, "(count 5000 0)")).value == 5000
+
+def test_loop_frames_not_shared():
+  rt = jit_rt(threshold = 1)
+  run(rt, "(defn f (n acc) (cond ((= n 0) acc) (else (f (- n 1) (cons (delay n) acc)))))")
+  for i in xrange(2):
+    assert repr(run(rt, "(map force (f 3 nil))")) == "(1 2 3)"
+  assert callable(native(rt, "f"))
+
+def test_mixed_numbers_fall_back():
+  rt = jit_rt()
+  run(rt, "(defn add (a b) (+ a b))")
+  assert repr(run(rt, "(add 1 2)")) == "3"
+  assert repr(run(rt, "(add 1 2)")) == "3"
+  assert repr(run(rt, "(add 1/2 0.5)")) == "1"
+  assert repr(run(rt, "(add 1/2 1/4)")) == "3/4"
+
+def test_higher_order_calls():
+  rt = jit_rt()
+  run(rt, "(defn twice (f x) (f (f x)))")
+  run(rt, "(defn inc (x) (+ x 1))")
+  for i in xrange(3):
+    assert run(rt, "(twice inc 1)").value == 3
+    assert repr(run(rt, "(twice car '((1)))")) == "1"
+  assert callable(native(rt, "twice"))
+
+def test_same_errors():
+  rt = jit_rt(threshold = 0)
+  run(rt, "(defn f (x) (cond (x 1)))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(f 5)")
+  assert str(e.value) == "expr x does not evaluate to a boolean"
+  run(rt, "(defn g (x) (car x))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(g 5)")
+  assert str(e.value) == "argument 1 of car must be list, was number"
+  run(rt, "(defn h (x) (x 1))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(h 5)")
+  assert str(e.value) == "5 is not callable"
+
+def test_untranslatable_stays_compiled():
+  rt = jit_rt(threshold = 0)
+  run(rt, "(defn adder (n) (lambda (x) (+ x n)))")
+  assert run(rt, "((adder 1) 2)").value == 3
+  assert native(rt, "adder") is False
+  assert rt.compiler.failed >= 1
+
+def test_redefinition_deoptimises():
+  rt = jit_rt()
+  run(rt, fib)
+  run(rt, "(fib 10)")
+  assert callable(native(rt, "fib"))
+  run(rt, "(define + -)")
+  assert native(rt, "fib") == 0
+  assert rt.compiler.deopts == 1
+  assert run(rt, "(fib 3)").value == 0
+
+def watchers(scope):
+  return sum(len(w) for w in scope.watchers.values())
+
+def test_translated_closure_collected():
+  rt = jit_rt(threshold = 0)
+  run(rt, "(defn mk (n) (lambda (x) (+ x n)))")
+  before = watchers(rt.ns)
+  run(rt, "(define f (mk 1))")
+  assert run(rt, "(f 2)").value == 3
+  assert callable(native(rt, "f"))
+  assert watchers(rt.ns) > before
+  ref = weakref.ref(rt.ns.lookup("f"))
+  run(rt, "(define f nil)")
+  gc.collect()
+  assert ref() is None
+  assert watchers(rt.ns) == before
+  for i in xrange(200):
+    run(rt, "((mk %d) 1)" % i)
+  gc.collect()
+  assert watchers(rt.ns) == before
+
+def test_deopt_drops_all_watches():
+  rt = jit_rt()
+  run(rt, fib)
+  before = watchers(rt.ns)
+  run(rt, "(fib 10)")
+  assert watchers(rt.ns) > before
+  run(rt, "(define + -)")
+  assert watchers(rt.ns) == before
+  run(rt, "(fib 10) (fib 10)")
+  run(rt, "(define + -)")
+  assert rt.compiler.deopts == 2
+  assert watchers(rt.ns) == before
+
+def test_redefined_callee_is_called():
+  rt = jit_rt()
+  run(rt, "(defn g (x) (+ x 1)) (defn f (x) (g x))")
+  run(rt, "(f 1) (f 1) (f 1)")
+  run(rt, "(defn g (x) (* x 10))")
+  assert run(rt, "(f 2)").value == 20
@@ -0,0 +1,82 @@
+import pytest
+import lisptypes as types
+from primitives.kanren import Var, unify, walk, walk_all, mplus, bind
+from primitives.lazy import Delay, take
+from persistent import HashMap
+from conftest import bootstrapped, run
+
+def build_rt(**engine):
+  return bootstrapped("kanren.loli", **engine)
+
+queries = [
+  ("(run (== vq 5))", "(5)"),
+  ("(run (appendo '(1 2) '(3) vq))", "((1 2 3))"),
+  ("(run (appendo vq '(3) '(1 2 3)))", "((1 2))"),
+  ("""(run (let ((a (var 'a)) (b (var 'b)))
+             (conj* (appendo a b '(1 2)) (== vq (cons a (cons b nil))))))""",
+   "((nil (1 2)) ((1) (2)) ((1 2) nil))"),
+  ("(run (membero vq '(a b c)))", "(a b c)"),
+  ("(run (conj* (common-el '(1 2 3) '(3 4 1)) (== vq vx)))", "(1 3)"),
+  ("(run (==-check vq (cons 1 vq)))", "nil"),
+  ("(run (== [vq 2] [1 vx]))", "(1)"),
+  ("(run* (membero vq '(a b)))", "(a b)"),
+  ("(run 2 (membero vq '(a b c)))", "(a b)"),
+  ("(run 3 (membero 1 vq))",
+   "((1 . <var t>) (<var h> 1 . <var t>) (<var h> <var h> 1 . <var t>))"),
+  ("(run 2 (appendo vx vy vq))", "(<var q> (<var h> . <var l3p>))"),
+  ("(run 1 (disj (membero 1 vq) (== vq 'x)))", "((1 . <var t>))"),
+  ("(run 2 (disj (membero 1 vq) (== vq 'x)))", "((1 . <var t>) x)"),
+]
+
+@pytest.mark.parametrize("engine", ({}, {"compiled": False}, {"bytecode": True}))
+def test_queries(engine):
+  rt = build_rt(**engine)
+  for (query, expected) in queries:
+    assert repr(run(rt, query)) == expected, query
+
+def test_collection_conj_not_shadowed():
+  rt = build_rt()
+  assert repr(run(rt, "(conj [1 2] 3)")) == "[1 2 3]"
+  assert repr(run(rt, "(run (goal-conj (== vq 1) (== vx 2)))")) == "(1)"
+
+def test_vars_are_distinct():
+  (a, b) = (Var(types.mksymbol("x")), Var(types.mksymbol("x")))
+  assert not a == b
+  s = unify(a, types.py_to_type(1), HashMap())
+  assert walk(a, s) == types.py_to_type(1)
+  assert walk(b, s) is b
+
+def test_unify_triangular():
+  (x, y, z) = [Var(types.mksymbol(n)) for n in "xyz"]
+  s = unify(types.mklist([x, y]), types.mklist([y, z]), HashMap())
+  s = unify(z, types.py_to_type(7), s)
+  assert repr(walk_all(types.mklist([x, y, z]), s)) == "(7 7 7)"
+  assert unify(x, types.py_to_type(8), s) is None
+
+def test_occurs_check():
+  x = Var(types.mksymbol("x"))
+  term = types.cons(types.py_to_type(1), x)
+  assert unify(x, term, HashMap()) is not None
+  assert unify(x, term, HashMap(), occurs_check = True) is None
+
+def test_unify_long_lists():
+  n = 5000
+  vs = [Var(types.mksymbol("v")) for i in xrange(n)]
+  s = unify(types.mklist(vs), types.py_to_type(range(n)), HashMap())
+  assert walk_all(types.mklist(vs), s) == types.py_to_type(range(n))
+
+def test_streams_interleave():
+  def ones():
+    return types.cons(types.py_to_type(1), Delay(ones))
+  def twos():
+    return types.cons(types.py_to_type(2), Delay(twos))
+  assert repr(take(4, mplus(Delay(ones), twos()))) == "(2 1 2 1)"
+
+def test_bind_forces_only_what_is_taken():
+  forced = []
+  def numbers(n):
+    forced.append(n)
+    return types.cons(types.py_to_type(n), Delay(lambda: numbers(n + 1)))
+  call = lambda goal, s: types.mklist([s])
+  assert repr(take(3, bind(call, numbers(0), None))) == "(0 1 2)"
+  assert forced == [0, 1, 2]
@@ -0,0 +1,38 @@
+import threading
+import lisptypes as types
+from primitives.lazy import Delay, LazySeq, force, take
+
+def test_delay_runs_once():
+  calls = []
+  d = Delay(lambda: calls.append(1) or types.py_to_type(len(calls)))
+  assert repr(d) == "<delay=unrealised>"
+  assert force(d) == types.py_to_type(1)
+  assert force(d) == types.py_to_type(1)
+  assert calls == [1]
+  assert repr(d) == "<delay=1>"
+
+def test_delay_runs_once_across_threads():
+  calls = []
+  start = threading.Event()
+  d = Delay(lambda: calls.append(1) or types.nil)
+  def worker():
+    start.wait()
+    force(d)
+  threads = [threading.Thread(target = worker) for i in xrange(8)]
+  for t in threads:
+    t.start()
+  start.set()
+  for t in threads:
+    t.join()
+  assert calls == [1]
+
+def test_force_chains():
+  d = Delay(lambda: Delay(lambda: types.py_to_type(3)))
+  assert force(d) == types.py_to_type(3)
+
+def test_take_long_lazy_seq():
+  def from_n(n):
+    return LazySeq(lambda: types.cons(types.py_to_type(n), from_n(n + 1)))
+  assert take(10000, from_n(0)) == types.py_to_type(range(10000))
+  assert take(None, types.mklist([types.py_to_type(1)])) == \
+      types.py_to_type([1])
@@ -0,0 +1,61 @@
+import pytest, sys, os.path, glob
+from lex import *
+from load import load
+
+sources = [
+  "(a b c (1 2 3) \"foo\")",
+  "(define x '(1 ~y ~@z @w))",
+  "(+ -5 1.5 3/4 a-b? c! <= &)",
+  "; comment\n(a ; trailing\n b)\n",
+  "(\"multi\nline\" \"semi;colon\" x\"y)",
+  "(a,b, c)\r\n(d\te)",
+  "",
+]
+
+source_files = glob.glob(os.path.join(sys.path[0], "*.loli")) + \
+    glob.glob(os.path.join(sys.path[0], "test-loli", "*.loli"))
+
+def tokens(lexer, source):
+  return [(t.type, t.value) for t in lexer(source)]
+
+def test_scanner_matches_lexer():
+  for source in sources:
+    assert tokens(Scanner, source) == tokens(Lexer, source)
+
+def test_scanner_matches_lexer_on_files():
+  for path in source_files:
+    assert tokens(Scanner, file(path)) == tokens(Lexer, file(path))
+    assert repr(load(file(path), Scanner)) == repr(load(file(path), Lexer))
+
+def test_scanner_positions():
+  toks = list(Scanner("(a\n  \"b\nc\" d)"))
+  assert [(t.value, t.lineno, t.col) for t in toks] == [
+    ("(", 1, 1), ("a", 1, 2), ("\"b\nc\"", 2, 3), ("d", 3, 4), (")", 3, 5)]
+
+def test_scanner_filename():
+  toks = list(Scanner("a", "foo.loli"))
+  assert toks[0].infile == "foo.loli"
+
+def test_scanner_unclassifiable():
+  with pytest.raises(ParserError) as e:
+    list(Scanner("(a\n $b)"))
+  assert e.value.token.lineno == 2
+  assert e.value.token.col == 2
+
+def test_scanner_unterminated_string():
+  with pytest.raises(ParserError):
+    list(Scanner("(a \"b\n c"))
+
+class LineStream(object):
+  def __init__(self, lines):
+    self.lines = iter(lines)
+    self.read = 0
+  def readline(self):
+    self.read += 1
+    return next(self.lines, "")
+
+def test_scanner_streams():
+  stream = LineStream(["(a)\n"] * 1000)
+  scanner = iter(Scanner(stream))
+  assert [next(scanner).value for i in xrange(3)] == ["(", "a", ")"]
+  assert stream.read == 1
@@ -58,3 +58,92 @@ def test_deep_mklist():
 def test_pprint():
   out = repr(py_to_type([1,2,3,"ohai",True,[1,3,3,7]]))
   assert out == "(1 2 3 \"ohai\" true (1 3 3 7))"
+
+def test_type_dispatch():
+  assert Type("number", 3).__class__ is Number
+  assert Type("symbol", "ohai").__class__ is Symbol
+  assert Type("number", 3) == py_to_type(3)
+  assert not Type("number", 3) == Type("string", 3)
+  assert type_name(mkfunc([], [], None)) == "function"
+  assert type_name(mkmacro([], [], None)) == "macro"
+  assert not is_function(mkmacro([], [], None))
+
+def test_slots():
+  for value in (cons(nil, nil), py_to_type(1), mksymbol("ohai"),
+                mkprimitive("ohai", None), mkfunc([], [], None)):
+    assert not hasattr(value, "__dict__")
+
+def test_symbols_interned():
+  from load import load
+  assert mksymbol("ohai") is mksymbol("oh" + "ai")
+  assert Type("symbol", "ohai") is mksymbol("ohai")
+  assert list(load("ohai"))[0] is mksymbol("ohai")
+  assert mksymbol(mksymbol("ohai")) is mksymbol("ohai")
+  assert not mksymbol("ohai") == py_to_type("ohai")
+
+def test_symbols_survive_pickling():
+  import pickle, copy
+  s = mksymbol("ohai")
+  assert pickle.loads(pickle.dumps(s)) is s
+  assert copy.copy(s) is s
+  assert copy.deepcopy(cons(s, nil)).car is s
+
+def test_intern_threads():
+  import threading
+  found = []
+  def intern():
+    found.append([mksymbol("thread-%d" % i) for i in xrange(200)])
+  threads = [threading.Thread(target = intern) for i in xrange(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  for symbols in found:
+    assert all(a is b for (a, b) in zip(symbols, found[0]))
+
+def deep(n, leaf = nil):
+  for i in xrange(n):
+    leaf = cons(leaf, nil)
+  return leaf
+
+def test_long_lists():
+  n = 20000
+  a = py_to_type(range(n))
+  b = py_to_type(range(n))
+  assert a == b
+  assert not a == py_to_type(range(n - 1) + [0])
+  assert repr(a) == "(%s)" % " ".join(str(i) for i in xrange(n))
+  assert len(list(a)) == n
+
+def test_deep_lists():
+  n = 20000
+  assert deep(n) == deep(n)
+  assert not deep(n) == deep(n, cons(mksymbol("x"), nil))
+  assert repr(deep(n)) == "(" * n + "nil" + ")" * n
+
+def test_dotted_repr():
+  assert repr(cons(py_to_type(1), py_to_type(2))) == "(1 . 2)"
+  assert repr(cons(py_to_type(1), cons(py_to_type(2), py_to_type(3)))) == \
+    "(1 2 . 3)"
+  assert repr(cons(cons(py_to_type(1), nil), py_to_type(2))) == "((1) . 2)"
+
+def test_cyclic_equality():
+  a = py_to_type([1, 2, 3])
+  a.cdr.cdr.cdr = a
+  b = py_to_type([1, 2, 3, 1, 2, 3])
+  b.cdr.cdr.cdr.cdr.cdr.cdr = b
+  assert a == b
+  c = py_to_type([1, 2, 4])
+  c.cdr.cdr.cdr = c
+  assert not a == c
+
+def test_write_streams():
+  chunks = []
+  write(py_to_type([1, [2, "x"]]), chunks.append)
+  assert len(chunks) > 1
+  assert "".join(chunks) == '(1 (2 "x"))'
+
+def test_nil_survives_pickling():
+  import pickle, copy
+  assert pickle.loads(pickle.dumps(nil)) is nil
+  assert copy.deepcopy(py_to_type([1, 2])).cdr.cdr is nil
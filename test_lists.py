@@ -0,0 +1,87 @@
+import pytest, random
+import lisptypes as types
+from errors import LispException
+from conftest import bootstrapped, run
+
+native = bootstrapped()
+reference = bootstrapped("lists.loli")
+
+def random_list(rng, depth = 0):
+  items = []
+  for i in xrange(rng.randint(0, 6)):
+    r = rng.random()
+    if r < 0.2 and depth < 2:
+      items.append(random_list(rng, depth + 1))
+    elif r < 0.4:
+      items.append("'" + rng.choice(["a", "b", "c", "nil"]))
+    else:
+      items.append(str(rng.randint(-5, 20)))
+  return "(list-of %s)" % " ".join(items)
+
+expressions = [
+  "(map (lambda (n) (+ n 1)) '(1 2 3))",
+  "(map car '((1 2) (3 4) ()))",
+  "(map identity nil)",
+  "(filter even? '(1 2 3 4 5 6))",
+  "(filter (lambda (x) (list? x)) '(1 (2) () 3 (4 5)))",
+  "(filter even? nil)",
+  "(reduce + '(1 2 3 4))",
+  "(reduce + '(1 2 3 4) 10)",
+  "(reduce cons '(1 2 3))",
+  "(reduce cons '(1 2 3) nil)",
+  "(reduce + '(5) 1)",
+  "(append '(1 2) '(3) nil '(4 5))",
+  "(append nil 3)",
+  "(append '(1) 3)",
+  "(append '(1 2) 3)",
+  "(append nil nil)",
+  "(append '(1))",
+  "(append)",
+  "(apply append '((1 2) () (3)))",
+  "(foldr append nil '((1) (2 3)))",
+  "(reverse '(1 2 (3 4) 5))",
+  "(reverse nil)",
+  "(assq 'b '((a 1) (b 2) (c 3)))",
+  "(assq 'd '((a 1) (b 2)))",
+  "(assq 'b '((a . 1) 5 () (b . 2)))",
+  "(assq 1 nil)",
+  "(assq '(x) '(((x) . found)))",
+]
+
+def setup_module(module):
+  for rt in (native, reference):
+    run(rt, "(defn list-of (& xs) xs)")
+
+def test_natives_are_primitives():
+  for name in ("map", "filter", "reduce", "append", "reverse", "assq"):
+    assert types.is_primitive(native.ns.lookup(name))
+    assert types.is_function(reference.ns.lookup(name))
+
+def test_differential():
+  for exp in expressions:
+    assert repr(run(native, exp)) == repr(run(reference, exp)), exp
+
+def test_differential_random():
+  rng = random.Random(1337)
+  for i in xrange(200):
+    a = random_list(rng)
+    b = random_list(rng)
+    for exp in ["(map list? %s)" % a,
+                "(filter list? %s)" % a,
+                "(reverse %s)" % a,
+                "(append %s %s)" % (a, b),
+                "(append %s %s %s)" % (a, b, a),
+                "(assq 'a (map (lambda (x) (cons x x)) %s))" % a,
+                "(assq 3 (list-of %s %s))" % (a, b)]:
+      assert repr(run(native, exp)) == repr(run(reference, exp)), exp
+
+def test_long_lists():
+  native.ns.define("zeros", types.mklist([types.py_to_type(0)] * 5000))
+  run(native, "(define long (map (lambda (x) 1) zeros))")
+  assert run(native, "(reduce + long)").value == 5000
+  assert run(native, "(reduce + (append long long))").value == 10000
+  assert run(native, "(reduce + (reverse (filter (lambda (x) true) long)))").value == 5000
+
+def test_filter_requires_boolean():
+  with pytest.raises(LispException):
+    run(native, "(filter (lambda (x) x) '(1 2))")
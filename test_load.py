@@ -44,3 +44,24 @@ def test_deref():
 def test_deref_list():
   sexp = load("(a b c @(1 2 3))")
   assert repr(sexp) == "((a b c (deref (1 2 3))))"
+
+def test_load_long_list():
+  sexp = load("(%s)" % " ".join(str(i) for i in xrange(10000)))
+  assert len(list(sexp.car)) == 10000
+  assert sexp.car.car.value == 0
+  assert list(sexp.car)[-1].value == 9999
+
+def test_load_nested():
+  sexp = load("(a (b (c d) e) '(f) g)")
+  assert repr(sexp) == "((a (b (c d) e) (quote (f)) g))"
+
+def test_collection_literals():
+  assert repr(load("[1 (a b) [c]]")) == "([1 (a b) [c]])"
+  assert repr(load("{a 1}")) == "({a 1})"
+  assert repr(load("#{a}")) == "(#{a})"
+  assert repr(load("'[a]")) == "((quote [a]))"
+
+def test_collection_literal_errors():
+  for source in ("(]", "[1", "{1}", "#(", "#"):
+    with pytest.raises(ParserError):
+      load(source)
@@ -6,19 +6,25 @@ from rt import RT
 
 test_files = glob.glob(os.path.join(sys.path[0], "test-loli", "*.loli"))
 
-def build_rt(filename):
-  rt = RT()
+engines = ({}, {"compiled": False}, {"bytecode": True}, {"jit": True})
+
+def build_rt(filename, **engine):
+  rt = RT(**engine)
+  if engine.get("jit"):
+    # Translate whatever the tests call more than once.
+    rt.compiler.threshold = 1
   rt.__test_filename__ = filename
-  rt.load(rt.ns, file(os.path.join(sys.path[0], "rt.loli")))
+  rt.load_file(rt.ns, os.path.join(sys.path[0], "rt.loli"))
   rt.ns.define("is", types.mkprimitive("is", lambda s, a: rt.eval(s, a[0])))
   return rt
 
 def pytest_generate_tests(metafunc):
   args = []
   for f in test_files:
-    rt = build_rt(os.path.basename(f))
-    for form in load(file(f)):
-      args.append((rt, form))
+    for engine in engines:
+      rt = build_rt(os.path.basename(f), **engine)
+      for form in load(file(f)):
+        args.append((rt, form))
   metafunc.parametrize(metafunc.funcargnames, args)
 
 def pprint_assert(rt, form):
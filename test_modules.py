@@ -0,0 +1,161 @@
+import pytest, os.path, threading
+import lisptypes as types
+from errors import LispException
+from modules import Registry
+from conftest import bootstrapped, run
+
+def module_rt(tmpdir, **engine):
+  rt = bootstrapped(**engine)
+  rt.modules.path = [str(tmpdir)]
+  return rt
+
+def write(tmpdir, name, source):
+  tmpdir.join(name).write(source)
+
+def test_loaded_once(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "counted.loli", "(swap! loads (lambda (n) (+ n 1))) (define x 1)")
+  run(rt, "(define loads (atom 0))")
+  run(rt, "(require \"counted\") (require \"counted.loli\")")
+  run(rt, "(require \"%s\")" % tmpdir.join("counted.loli"))
+  assert run(rt, "@loads").value == 1
+  assert run(rt, "x").value == 1
+
+def test_search_path(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "a.loli", "(define from-a 1)")
+  tmpdir.mkdir("lib").join("b.loli").write("(define from-b 2)")
+  run(rt, "(require \"a\")")
+  with pytest.raises(LispException) as e:
+    run(rt, "(require \"b\")")
+  assert str(e.value).startswith("module b not found")
+  rt.modules.path.append(str(tmpdir.join("lib")))
+  run(rt, "(require \"b\")")
+  assert run(rt, "(+ from-a from-b)").value == 3
+
+def test_relative_to_requiring_module(tmpdir):
+  rt = module_rt(tmpdir)
+  lib = tmpdir.mkdir("lib")
+  lib.join("inner.loli").write("(define inner 1)")
+  lib.join("outer.loli").write("(require \"inner\") (define outer (+ inner 1))")
+  run(rt, "(require \"lib/outer\")")
+  assert run(rt, "outer").value == 2
+
+def test_namespaces_and_exports(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "shapes.loli", """
+    (export area)
+    (define pi 3)
+    (defn helper (r) (* r r))
+    (defn area (r) (* pi (helper r)))""")
+  run(rt, "(define pi 4) (require \"shapes\")")
+  assert run(rt, "(area 2)").value == 12
+  assert run(rt, "pi").value == 4
+  assert rt.ns.lookup("helper") is None
+  run(rt, "(defn helper (r) 0)")
+  assert run(rt, "(area 2)").value == 12
+
+def test_prefix(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "m.loli", "(defn double (x) (* x 2))")
+  run(rt, "(require \"m\" 'm)")
+  assert run(rt, "(m/double 4)").value == 8
+  assert rt.ns.lookup("double") is None
+
+def test_export_errors(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "bad.loli", "(export missing)")
+  with pytest.raises(LispException) as e:
+    run(rt, "(require \"bad\")")
+  assert "exports missing, which it doesn't define" in str(e.value)
+  with pytest.raises(LispException) as e:
+    run(rt, "(export x)")
+  assert str(e.value) == "export used outside of a module"
+
+def test_failed_load_tried_again(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "flaky.loli", "(undefined-thing)")
+  with pytest.raises(LispException):
+    run(rt, "(require \"flaky\")")
+  write(tmpdir, "flaky.loli", "(define fixed true)")
+  run(rt, "(require \"flaky\")")
+  assert run(rt, "fixed") == types.true
+
+def test_cycle(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "a.loli", "(require \"b\")")
+  write(tmpdir, "b.loli", "(require \"a\")")
+  with pytest.raises(LispException) as e:
+    run(rt, "(require \"a\")")
+  assert "is required while it is loading" in str(e.value)
+
+def test_concurrent_require(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "slow.loli", "(swap! loads (lambda (n) (+ n 1))) (sleep 0.05)")
+  run(rt, "(define loads (atom 0))")
+  threads = [threading.Thread(target = lambda: run(rt.clone(), "(require \"slow\")"))
+             for i in xrange(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert run(rt, "@loads").value == 1
+
+@pytest.mark.parametrize("engine", ({}, {"compiled": False}, {"bytecode": True}))
+def test_define_in_module_function(tmpdir, engine):
+  rt = module_rt(tmpdir, **engine)
+  write(tmpdir, "m.loli", """
+    (export setup get-value)
+    (defn setup () (define value 5))
+    (defn get-value () value)""")
+  run(rt, "(require \"m\")")
+  run(rt, "(setup)")
+  assert run(rt, "(get-value)").value == 5
+  assert rt.ns.lookup("value") is None
+
+def test_module_stats(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "a.loli", "(define a 1)")
+  run(rt, "(require \"a\")")
+  stats = run(rt, "(module-stats)")
+  [(path, seconds)] = list(stats.value.items())
+  assert path.value == str(tmpdir.join("a.loli"))
+  assert seconds.value >= 0
+  assert rt.modules.stats() == [(path.value, seconds.value)]
+
+def test_fork_keeps_loaded_modules(tmpdir):
+  rt = module_rt(tmpdir)
+  write(tmpdir, "counted.loli", """
+    (export scaled)
+    (swap! loads (lambda (n) (+ n 1)))
+    (define factor 2)
+    (defn scaled (x) (* x factor))""")
+  run(rt, "(define loads (atom 0)) (require \"counted\")")
+  fork = rt.fork()
+  run(fork, "(require \"counted\")")
+  assert run(rt, "@loads").value == 1
+  assert fork.modules.stats() == rt.modules.stats()
+  [module] = fork.modules.loaded()
+  assert module is not rt.modules.loaded()[0]
+  assert module.ns.parent is fork.ns
+  assert fork.ns.lookup("scaled").scope is module.ns
+  module.ns.define("factor", types.py_to_type(10))
+  assert run(fork, "(scaled 1)").value == 10
+  assert run(rt, "(scaled 1)").value == 2
+
+def test_restored_image_loads_modules_again(tmpdir):
+  import image
+  rt = module_rt(tmpdir)
+  write(tmpdir, "m.loli", "(define from-m 1)")
+  run(rt, "(require \"m\")")
+  path = str(tmpdir.join("m.image"))
+  image.save(rt, path)
+  restored = image.restore(path)
+  assert restored.modules.loaded() == []
+  assert run(restored, "from-m").value == 1
+
+def test_default_path(monkeypatch):
+  monkeypatch.setenv("LOLISP_PATH", os.pathsep.join(("/one", "/two")))
+  path = Registry(None).path
+  assert path[:3] == [".", "/one", "/two"]
+  assert os.path.isfile(os.path.join(path[-1], "rt.loli"))
@@ -0,0 +1,65 @@
+import pytest, random
+from persistent import *
+
+class Colliding(object):
+  "A key whose hash collides with every other key with the same n % 8."
+  def __init__(self, n):
+    self.n = n
+  def __hash__(self):
+    return self.n % 8
+  def __eq__(self, other):
+    return isinstance(other, Colliding) and other.n == self.n
+
+def test_hash_map_against_dict():
+  for key in (lambda n: n, lambda n: "k%d" % n, Colliding):
+    rng = random.Random(1337)
+    m = HashMap()
+    d = {}
+    for i in xrange(5000):
+      n = rng.randint(0, 1000)
+      if rng.random() < 0.3:
+        m = m.dissoc(key(n))
+        d.pop(n, None)
+      else:
+        m = m.assoc(key(n), i)
+        d[n] = i
+      assert len(m) == len(d)
+    for n in xrange(1001):
+      assert m.get(key(n)) == d.get(n)
+      assert (key(n) in m) == (n in d)
+    assert sorted(value for (k, value) in m.items()) == sorted(d.values())
+
+def test_hash_map_persistence():
+  a = hash_map((i, i) for i in xrange(100))
+  b = a.assoc(5, "five").dissoc(6)
+  assert a.get(5) == 5 and a.get(6) == 6
+  assert b.get(5) == "five" and 6 not in b
+  assert a.assoc(5, 5) is a
+  assert a.dissoc(1000) is a
+  assert a == hash_map((i, i) for i in reversed(xrange(100)))
+  assert a != b
+  assert hash(a) == hash(hash_map((i, i) for i in xrange(100)))
+
+def test_hash_set():
+  s = hash_set([1, 2, 3])
+  assert 2 in s and 4 not in s
+  assert s.conj(2) is s
+  assert s.disj(2) == hash_set([1, 3])
+  assert sorted(s) == [1, 2, 3]
+
+def test_vector():
+  v = vector(xrange(5000))
+  assert len(v) == 5000
+  assert list(v) == range(5000)
+  assert all(v.nth(i) == i for i in xrange(0, 5000, 7))
+  w = v
+  for i in xrange(0, 5000, 13):
+    w = w.assoc(i, -i)
+  assert list(v) == range(5000)
+  assert list(w) == [-i if i % 13 == 0 else i for i in xrange(5000)]
+  assert v.assoc(5000, "end").nth(5000) == "end"
+  assert v == vector(xrange(5000))
+  with pytest.raises(IndexError):
+    v.nth(5000)
+  with pytest.raises(IndexError):
+    v.assoc(-1, 0)
@@ -69,3 +69,39 @@ def test_signature_rest_argument_with_resolution():
                 types.mksymbol("noobs")])
   with pytest.raises(LispException):
     invoke(rest, [types.nil, types.mksymbol("not-defined")])
+
+def test_signature_error_messages():
+  invoke = signature_fixture()
+  @signature("check", "number @callable")
+  def fixed(self, scope, args):
+    return args
+  @signature("check-rest", "number @&")
+  def rest(self, scope, args):
+    return args
+  cases = [
+    (fixed, [types.py_to_type(1)],
+     "check takes 2 arguments, 1 given"),
+    (fixed, [types.py_to_type("x"), types.mksymbol("car")],
+     "argument 1 of check must be number, was string"),
+    (fixed, [types.py_to_type(1), types.mksymbol("nil")],
+     "argument 2 of check must be function|macro|primitive, was nil"),
+    (rest, [], "check-rest takes at least 2 arguments, 0 given"),
+    (rest, [types.py_to_type(1)],
+     "check-rest takes at least 2 arguments, 1 given"),
+  ]
+  for (func, args, message) in cases:
+    with pytest.raises(LispException) as e:
+      invoke(func, args)
+    assert str(e.value) == message
+
+def test_signature_class_matching():
+  invoke = signature_fixture()
+  @signature("Atom|number")
+  def atom(self, scope, args):
+    return args[0]
+  from primitives.concurrent import Atom
+  a = Atom(types.nil)
+  assert invoke(atom, [a]) is a
+  with pytest.raises(LispException) as e:
+    invoke(atom, [types.nil])
+  assert str(e.value) == "argument 1 of atom must be Atom|number, was nil"
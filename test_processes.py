@@ -0,0 +1,39 @@
+import pytest
+from errors import LispException
+from load import load
+from rt import RT
+import processes
+from conftest import run
+
+@pytest.fixture(scope = "module")
+def rt():
+  processes.configure(2)
+  rt = RT()
+  rt.load(rt.ns, file(processes.prelude))
+  for form in load("""
+      (defn fib (n) (cond ((< n 2) n) (else (+ (fib (- n 1)) (fib (- n 2))))))"""):
+    rt.execute(rt.ns, form)
+  yield rt
+  processes.shared().shutdown()
+  processes.shared_pool = None
+
+def test_pfuture(rt):
+  assert repr(run(rt, "@(pfuture (fib 15))")) == "610"
+  assert repr(run(rt, "(let ((k 10)) @(pfuture (+ k (fib 10))))")) == "65"
+  assert repr(run(rt, "(@(pfuture (let ((y 2)) (lambda (x) (+ x y)))) 5)")) == "7"
+
+def test_pfuture_failure(rt):
+  with pytest.raises(LispException) as e:
+    run(rt, "@(pfuture really-not-defined)")
+  assert "really-not-defined" in str(e.value)
+  with pytest.raises(LispException):
+    run(rt, "@(pfuture (atom 1))")
+
+def test_ppmap(rt):
+  assert repr(run(rt, "(ppmap fib '(1 2 3 4 5 6 7 8 9 10))")) == \
+      "(1 1 2 3 5 8 13 21 34 55)"
+  assert repr(run(rt, "(let ((k 3)) (ppmap (lambda (x) (* x k)) '(1 2 3)))")) == \
+      "(3 6 9)"
+  assert repr(run(rt, "(ppmap fib nil)")) == "nil"
+  with pytest.raises(LispException):
+    run(rt, "(ppmap (lambda (x) (nope)) '(1))")
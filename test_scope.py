@@ -0,0 +1,86 @@
+import pytest
+import lisptypes as types
+from errors import LispException
+from scope import *
+
+def func(sig, scope):
+  return types.mkfunc([types.mksymbol(s) for s in sig.split()],
+                      types.nil, scope)
+
+def test_params():
+  p = Params([types.mksymbol(s) for s in "a b & c".split()])
+  assert p.names == [types.mksymbol(s) for s in "a b c".split()]
+  assert p.rest == 2
+  assert p.index == { types.mksymbol("a"): 0, types.mksymbol("b"): 1,
+                      types.mksymbol("c"): 2 }
+
+def test_bind():
+  ns = Scope()
+  frame = bind(func("a b", ns), [1, 2])
+  assert frame.slots == [1, 2]
+  assert frame.lookup("b") == 2
+  assert frame.parent is ns
+
+def test_bind_rest():
+  frame = bind(func("a & b", Scope()), [1, 2, 3])
+  assert frame.slots[0] == 1
+  assert repr(frame.slots[1]) == repr(types.mklist([2, 3]))
+  frame = bind(func("a & b", Scope()), [1])
+  assert frame.slots[1] is types.nil
+
+def test_bind_arity():
+  with pytest.raises(LispException):
+    bind(func("a b", Scope()), [1])
+  with pytest.raises(LispException):
+    bind(func("a b & c", Scope()), [1])
+
+def test_frame_lookup_chain():
+  ns = Scope()
+  ns.define("g", 3)
+  outer = bind(func("a b", ns), [1, 2])
+  inner = bind(func("b", outer), [20])
+  assert inner.lookup("a") == 1
+  assert inner.lookup("b") == 20
+  assert inner.lookup("g") == 3
+  assert inner.lookup("nope") is None
+
+def test_concurrent_define_and_lookup():
+  import threading
+  ns = Scope()
+  ns.define("x", 0)
+  errors = []
+  def reader():
+    for i in xrange(2000):
+      if ns.lookup("x") is None:
+        errors.append(i)
+  def writer(n):
+    for i in xrange(500):
+      ns.define("w%d" % n, i)
+      ns.define("x", i)
+  threads = [threading.Thread(target = reader) for i in xrange(4)] + \
+      [threading.Thread(target = writer, args = (n,)) for n in xrange(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert errors == []
+  assert [ns.lookup("w%d" % n) for n in xrange(4)] == [499] * 4
+
+def test_scope_parent_lookup():
+  parent = Scope()
+  parent.define("a", 1)
+  child = Scope(parent = parent)
+  child.define("b", 2)
+  assert child.lookup("a") == 1
+  assert child.lookup("b") == 2
+  assert parent.lookup("b") is None
+
+def test_watch_fires_once():
+  ns = Scope()
+  seen = []
+  ns.watch(types.mksymbol("a"), seen.append)
+  ns.define("b", 1)
+  assert seen == []
+  ns.define("a", 1)
+  ns.define("a", 2)
+  assert seen == [types.mksymbol("a")]
@@ -0,0 +1,131 @@
+import pytest
+import lisptypes as types
+from errors import LispException
+from rt import RT
+from vm import VM, disassemble
+from conftest import bootstrapped, run, with_recursion_limit
+
+def vm_rt():
+  return bootstrapped(bytecode = True)
+
+def test_selected_by_option():
+  assert isinstance(RT(bytecode = True).compiler, VM)
+  assert isinstance(RT(bytecode = True).clone().compiler, VM)
+  assert not isinstance(RT().compiler, VM)
+
+def test_body_compiled_once():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x) ((lambda (y) (cons x y)) 2)))")
+  f = rt.ns.lookup("f")
+  assert repr(run(rt, "(f 1)")) == "(1 . 2)"
+  code = f.bytecode
+  run(rt, "(f 3)")
+  assert f.bytecode is code
+
+def test_closures_share_code():
+  rt = RT(bytecode = True)
+  run(rt, "(define mk (lambda (x) (lambda () x)))")
+  a = run(rt, "(mk 1)")
+  b = run(rt, "(mk 2)")
+  assert a.bytecode is b.bytecode
+  assert run(rt, "((mk 5))").value == 5
+
+def test_cond_compiles_to_jumps():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x) (cond (x 1) (else 2))))")
+  run(rt, "(f true)")
+  ops = [name for (pc, name, arg) in disassemble(rt.ns.lookup("f").bytecode)]
+  assert ops == ["guard", "local", "test", "const", "jump", "global", "test",
+                 "const", "jump", "const", "return"]
+
+def test_quasiquote():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x & xs) '(a ~x (b ~@xs) c)))")
+  assert repr(run(rt, "(f 1 2 3)")) == "(a 1 (b 2 3) c)"
+
+def test_collections():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x) [x {x (cons x x)} #{x}]))")
+  assert repr(run(rt, "(f 1)")) == "[1 {1 (1 . 1)} #{1}]"
+
+def test_primitive_rebinding():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (op) (op 6 3)))")
+  assert run(rt, "(f +)").value == 9
+  assert run(rt, "(f -)").value == 3
+  assert run(rt, "(f cons)") == types.cons(types.py_to_type(6),
+                                           types.py_to_type(3))
+
+def test_special_form_redefinition():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x) (quote x)))")
+  assert run(rt, "(f 1)") == types.mksymbol("x")
+  run(rt, "(define quote (lambda (x) (cons x x)))")
+  assert repr(run(rt, "(f 1)")) == "(1 . 1)"
+
+def test_same_errors():
+  rt = RT(bytecode = True)
+  run(rt, "(define f (lambda (x) (cond (x 1))))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(f 5)")
+  assert str(e.value) == "expr x does not evaluate to a boolean"
+  run(rt, "(define g (lambda () (undefined-thing)))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(g)")
+  assert str(e.value) == "symbol \"undefined-thing\" is undefined"
+  run(rt, "(define h (lambda () (5 1)))")
+  with pytest.raises(LispException) as e:
+    run(rt, "(h)")
+  assert str(e.value) == "5 is not callable"
+
+def test_lexical_shadowing():
+  rt = RT(bytecode = True)
+  run(rt, "(define x 1)")
+  run(rt, "(define f (lambda (x) (lambda (y) (lambda (x) (cons x y)))))")
+  assert repr(run(rt, "(((f 1) 2) 3)")) == "(3 . 2)"
+  run(rt, "(define g (lambda (y) (cons x y)))")
+  assert repr(run(rt, "(g 2)")) == "(1 . 2)"
+  run(rt, "(define x 5)")
+  assert repr(run(rt, "(g 2)")) == "(5 . 2)"
+
+def test_deep_closure():
+  rt = RT(bytecode = True)
+  run(rt, """(define f (lambda (a) (lambda (b) (lambda (c)
+               (lambda (d) (lambda (e) (cons a e)))))))""")
+  assert repr(run(rt, "(((((f 1) 2) 3) 4) 5)")) == "(1 . 5)"
+
+def test_tail_calls_through_macros():
+  rt = vm_rt()
+  run(rt, """(defn loop (n acc)
+               (let ((m (- n 1)))
+                 (cond ((and (> n 0) true) (loop m (+ acc 1)))
+                       (else acc))))""")
+  assert with_recursion_limit(200, lambda: run(rt, "(loop 1000 0)")).value == 1000
+  run(rt, "(defn count (n acc) (cond ((= n 0) acc) (else (recur (- n 1) (+ acc 1)))))")
+  assert with_recursion_limit(200, lambda: run(rt, "(count 5000 0)")).value == 5000
+
+def test_recursion_needs_no_python_stack():
+  rt = vm_rt()
+  run(rt, "(defn depth (n) (cond ((= n 0) 0) (else (+ 1 (depth (- n 1))))))")
+  assert with_recursion_limit(200, lambda: run(rt, "(depth 5000)")).value == 5000
+
+def test_maximum_depth():
+  rt = vm_rt()
+  rt.compiler.max_depth = 100
+  run(rt, "(defn depth (n) (cond ((= n 0) 0) (else (+ 1 (depth (- n 1))))))")
+  assert run(rt, "(depth 50)").value == 50
+  with pytest.raises(LispException) as e:
+    run(rt, "(depth 500)")
+  assert str(e.value) == "maximum call depth of 100 exceeded"
+
+def test_macro_expansion_cached():
+  rt = RT(bytecode = True)
+  run(rt, """
+    (define twice (macro (x) '(cons ~x ~x)))
+    (define f (lambda (n) (twice n)))""")
+  assert repr(run(rt, "(f 1)")) == "(1 . 1)"
+  assert repr(run(rt, "(f 2)")) == "(2 . 2)"
+  assert repr(run(rt, "(macro-cache-stats)")) == "((hits . 1) (misses . 1))"
+  run(rt, "(define twice (macro (x) '(cons ~x nil)))")
+  assert repr(run(rt, "(f 1)")) == "(1)"
+  assert rt.compiler.macro_misses == 2
@@ -0,0 +1,60 @@
+import pytest
+import lisptypes as types
+from errors import LispException
+from load import load
+from rt import RT
+from wire import pack, unpack, Standard
+from primitives.kanren import Var
+
+def build_rt():
+  rt = RT()
+  for form in load("(define inc (lambda (x) (+ x 1)))"):
+    rt.execute(rt.ns, form)
+  return rt
+
+sender = build_rt()
+receiver = RT()
+
+def roundtrip(values, standard = Standard({})):
+  return unpack(pack(values, standard), receiver)
+
+def test_values():
+  source = "(1 2.5 1/3 \"s\" sym nil (a . b) [1 [2]] {k v} #{x} ((1 2) 3))"
+  values = list(load(source).car)
+  assert roundtrip(values) == values
+
+def test_long_and_deep_lists():
+  long = types.py_to_type(range(100000))
+  deep = types.nil
+  for i in xrange(10000):
+    deep = types.cons(deep, types.nil)
+  (l, d) = roundtrip([long, deep])
+  assert l == long
+  assert d == deep
+
+def test_primitives_by_name():
+  plus = sender.ns.lookup("+")
+  assert roundtrip([plus])[0] is receiver.ns.lookup("+")
+
+def test_closures_carry_their_bindings():
+  for form in load("(define add ((lambda (n) (lambda (x) (inc (+ x n)))) 3))"):
+    f = sender.execute(sender.ns, form)
+  g = roundtrip([f])[0]
+  assert receiver.invoke(receiver.ns, g, [types.py_to_type(1)]) == \
+      types.py_to_type(5)
+  assert receiver.ns.lookup("inc") is None
+
+def test_standard_definitions_are_not_sent():
+  f = sender.execute(sender.ns, load("(lambda (x) (inc x))").car)
+  standard = Standard(sender.ns)
+  assert len(pack([f], standard)) < len(pack([f], Standard({})))
+
+def test_vars_keep_identity_within_a_message():
+  v = Var(types.mksymbol("q"))
+  (a, b) = roundtrip([v, types.mklist([v])])
+  assert a.__class__ is Var and a is b.car and a is not v
+
+def test_unsendable():
+  from primitives.concurrent import Atom
+  with pytest.raises(LispException):
+    pack([Atom(types.nil)], Standard({}))
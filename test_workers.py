@@ -0,0 +1,72 @@
+import threading, time
+import pytest
+from workers import Pool
+
+def test_results_and_errors():
+  pool = Pool(2)
+  assert pool.submit(lambda: 42).result() == 42
+  def fail():
+    raise ValueError("nope")
+  task = pool.submit(fail)
+  with pytest.raises(ValueError):
+    task.result()
+
+def test_thread_count_is_bounded():
+  pool = Pool(3)
+  seen = set()
+  def work():
+    seen.add(threading.current_thread().ident)
+    time.sleep(0.001)
+  tasks = [pool.submit(work) for i in xrange(200)]
+  for task in tasks:
+    task.result()
+  assert pool.workers <= 3
+  stats = pool.stats()
+  assert stats["completed"] == 200
+  assert stats["queued"] == 0
+
+def test_submit_blocks_while_queue_full():
+  pool = Pool(1, queue_size = 1)
+  gate = threading.Event()
+  pool.submit(gate.wait)
+  while pool.stats()["started"] == 0:
+    time.sleep(0.001)
+  pool.submit(lambda: None)
+  submitted = threading.Event()
+  def submitter():
+    pool.submit(lambda: None)
+    submitted.set()
+  threading.Thread(target = submitter).start()
+  assert not submitted.wait(0.05)
+  gate.set()
+  assert submitted.wait(5)
+
+def test_shutdown_with_queue_full():
+  pool = Pool(2, queue_size = 1)
+  gate = threading.Event()
+  for i in xrange(2):
+    pool.submit(gate.wait)
+    while pool.stats()["started"] <= i:
+      time.sleep(0.001)
+  queued = pool.submit(lambda: 7)
+  start = time.time()
+  pool.shutdown(timeout = 0.05)
+  assert time.time() - start < 1
+  gate.set()
+  assert queued.result() == 7
+  pool.join(5)
+  assert not any(thread.is_alive() for thread in pool.threads)
+
+def test_waiting_runs_unstarted_tasks():
+  # With its only worker waiting on a task queued behind it, the pool
+  # would deadlock if waiting didn't run the task itself.
+  pool = Pool(1)
+  def outer():
+    return pool.submit(lambda: 7).result() + 1
+  assert pool.submit(outer).result() == 8
+
+def test_worker_runs_task_when_queue_full():
+  pool = Pool(1, queue_size = 1)
+  def outer():
+    return sum(t.result() for t in [pool.submit(lambda: 1) for i in xrange(5)])
+  assert pool.submit(outer).result() == 5
@@ -0,0 +1,496 @@
+## vm.py -- Compiling s-expressions to bytecode for a stack machine
+
+# An alternative to compiler.Compiler: function bodies are compiled to
+# Code, a flat list of opcodes each followed by one argument, with a
+# pool of the constants they use, and run by a single dispatch loop in
+# VM.run. The loop keeps its own stack of the calls in progress instead
+# of recursing in Python for each, so a Lisp call costs no Python
+# frames, and non-tail recursion is bounded by VM.max_depth rather than
+# by the Python recursion limit.
+#
+# Locals live in the slots of scope.Frame objects just as they do for
+# the closure compiler, so primitives, closures and the tree walker see
+# the same scopes whichever engine runs a function.
+#
+# Calls of the special forms through their global names are compiled
+# inline, behind a guard that falls back to a general call should the
+# name be redefined. Any other call is dispatched on what its operator
+# evaluates to: functions and strict primitives are called with their
+# evaluated arguments; other primitives and macros are specialised at
+# the call site the first time each is seen there, and the compiled
+# code reused until the operator changes, as the closure compiler does.
+
+import lisptypes as types
+from errors import LispException
+from scope import Params, params, bind
+from compiler import Env, scope_env, resolve, is_literal, check, has_unquote
+
+opnames = ("const", "local", "parent", "outer", "global", "pop", "jump",
+           "test", "dispatch", "call", "tailcall", "return", "guard",
+           "define", "closure", "self", "build", "collection")
+(CONST, LOCAL, PARENT, OUTER, GLOBAL, POP, JUMP, TEST, DISPATCH, CALL,
+ TAILCALL, RETURN, GUARD, DEFINE, CLOSURE, SELF, BUILD,
+ COLLECTION) = range(len(opnames))
+
+special_forms = {}
+
+def special(name):
+  "Register a compiler for calls to the primitive called name."
+  def decorate(func):
+    special_forms[name] = func
+    return func
+  return decorate
+
+class Code(object):
+  """
+  A compiled body: ops alternates opcodes and their arguments, consts
+  holds the constants the arguments index, and forms maps the position
+  of each test in a cond to the form tested, for its error message.
+  """
+  __slots__ = ("ops", "consts", "forms")
+
+  def __init__(self, ops, consts, forms):
+    self.ops = ops
+    self.consts = consts
+    self.forms = forms
+
+def disassemble(code):
+  "The ops of code as a list of (position, opname, argument) tuples."
+  return [(pc, opnames[code.ops[pc]], code.ops[pc + 1])
+          for pc in xrange(0, len(code.ops), 2)]
+
+class Assembler(object):
+  "Collects the ops and constants of a Code."
+
+  def __init__(self):
+    self.ops = []
+    self.consts = []
+    self.const_ids = {}
+    self.forms = {}
+
+  def emit(self, op, arg = 0):
+    "Append op, returning its position."
+    self.ops.append(op)
+    self.ops.append(arg)
+    return len(self.ops) - 2
+
+  def const(self, value):
+    "The index of value in the constants, adding it if it's new."
+    i = self.const_ids.get(id(value))
+    if i is None:
+      i = self.const_ids[id(value)] = len(self.consts)
+      self.consts.append(value)
+    return i
+
+  def label(self):
+    "The position the next op will have."
+    return len(self.ops)
+
+  def patch(self, at, target):
+    "Point the jump at position at to target."
+    self.ops[at + 1] = target
+
+  def code(self):
+    return Code(self.ops, self.consts, self.forms)
+
+class Site(object):
+  """
+  A call whose operator is only known at runtime: its forms, the Env
+  and tail position it was compiled for, the position after its code,
+  and the primitive or macro last seen there with its compiled code.
+  """
+  __slots__ = ("sexp", "forms", "env", "tail", "end", "cached")
+
+  def __init__(self, sexp, env, tail):
+    self.sexp = sexp
+    self.forms = list(sexp.cdr)
+    self.env = env
+    self.tail = tail
+    self.end = None
+    self.cached = (None, None)
+
+  def specialise(self, vm, frame, func):
+    "The code of this call for the macro or special form func."
+    (seen, code) = self.cached
+    if seen is func:
+      if func.__class__ is types.Macro:
+        vm.macro_hits += 1
+      return code
+    compiler = vm.compiler
+    if func.__class__ is types.Macro:
+      vm.macro_misses += 1
+      expansion = vm.rt.invoke(frame, func, self.forms)
+      code = compiler.expression(expansion, self.env, self.tail)
+    else:
+      code = compiler.special(func, self.forms, self.env, self.tail)
+    self.cached = (func, code)
+    return code
+
+  def slow(self, vm, frame, func):
+    "Evaluate this call without compiling it, like RT.execute."
+    rt = vm.rt
+    if func.__class__ is types.Primitive:
+      return func.invoke(frame, self.forms)
+    if func.__class__ is types.Macro:
+      return rt.eval(frame, rt.invoke(frame, func, self.forms))
+    if func.__class__ is types.Function:
+      return vm.call(func, [rt.eval(frame, form) for form in self.forms])
+    raise LispException("%s is not callable" % repr(func), self.sexp)
+
+class Compiler(object):
+  "Compiles forms to Code for an Env, as compiler.Compiler does to closures."
+
+  def __init__(self, rt):
+    self.rt = rt
+
+  def function(self, func):
+    "The Code of the body of func."
+    return self.body(func.value, Env(params(func).index, scope_env(func.scope)))
+
+  def body(self, forms, env):
+    asm = Assembler()
+    self.sequence(asm, list(forms), env, True)
+    asm.emit(RETURN)
+    return asm.code()
+
+  def expression(self, exp, env, tail):
+    asm = Assembler()
+    self.compile(asm, exp, env, tail)
+    asm.emit(RETURN)
+    return asm.code()
+
+  def special(self, prim, forms, env, tail):
+    asm = Assembler()
+    special_forms[prim.value](self, asm, prim, forms, env, tail)
+    asm.emit(RETURN)
+    return asm.code()
+
+  def sequence(self, asm, forms, env, tail = False):
+    if not forms:
+      asm.emit(CONST, asm.const(types.nil))
+    for (i, form) in enumerate(forms):
+      if i:
+        asm.emit(POP)
+      self.compile(asm, form, env, tail and i == len(forms) - 1)
+
+  def compile(self, asm, exp, env, tail = False):
+    if types.is_list(exp) and not types.is_nil(exp):
+      self.compile_call(asm, exp, env, tail)
+    elif types.is_symbol(exp):
+      self.compile_symbol(asm, exp, env)
+    elif types.is_collection(exp) and not is_literal(exp):
+      self.compile_collection(asm, exp, env)
+    else:
+      asm.emit(CONST, asm.const(exp))
+
+  def compile_symbol(self, asm, symbol, env):
+    (depth, i) = resolve(env, symbol)
+    if depth == 0:
+      asm.emit(LOCAL, i)
+    elif depth == 1:
+      asm.emit(PARENT, i)
+    elif depth is not None:
+      asm.emit(OUTER, (depth << 16) | i)
+    else:
+      asm.emit(GLOBAL, asm.const((symbol, i)))
+
+  def compile_collection(self, asm, coll, env):
+    count = [0]
+    def element(form):
+      self.compile(asm, form, env)
+      count[0] += 1
+      return form
+    coll.map_forms(element)
+    asm.emit(COLLECTION, asm.const((coll, count[0])))
+
+  def compile_call(self, asm, sexp, env, tail):
+    head = sexp.car
+    if types.is_symbol(head):
+      (depth, scope) = resolve(env, head)
+      if depth is None:
+        prim = scope.lookup(head)
+        if types.is_primitive(prim) and prim.value in special_forms:
+          site = Site(sexp, env, tail)
+          asm.emit(GUARD, asm.const((head, scope, prim, site)))
+          special_forms[prim.value](self, asm, prim, site.forms, env, tail)
+          site.end = asm.label()
+          return
+    self.compile(asm, head, env)
+    site = Site(sexp, env, tail)
+    asm.emit(DISPATCH, asm.const(site))
+    for form in site.forms:
+      self.compile(asm, form, env)
+    asm.emit(TAILCALL if tail else CALL, len(site.forms))
+    site.end = asm.label()
+
+class VM(object):
+  """
+  Runs function bodies, compiling each to Code on first use. It stands
+  in for compiler.Compiler in an RT, and counts macro expansions the
+  same way.
+  """
+
+  max_depth = 100000
+
+  def __init__(self, rt):
+    self.rt = rt
+    self.compiler = Compiler(rt)
+    self.macro_hits = 0
+    self.macro_misses = 0
+
+  def code(self, func):
+    try:
+      return func.bytecode
+    except AttributeError:
+      code = func.bytecode = self.compiler.function(func)
+      return code
+
+  def call(self, func, args):
+    "Call func with a list of evaluated args."
+    return self.run(func, bind(func, args))
+
+  def run(self, func, frame):
+    "Run the body of func in frame, and everything it calls."
+    Function = types.Function
+    Macro = types.Macro
+    Primitive = types.Primitive
+    true = types.true
+    false = types.false
+    max_depth = self.max_depth
+    code = self.code(func)
+    ops = code.ops
+    consts = code.consts
+    pc = 0
+    stack = []
+    # The code, position, stack and frame of each call in progress.
+    calls = []
+
+    while True:
+      op = ops[pc]
+      arg = ops[pc + 1]
+      pc += 2
+
+      if op == LOCAL:
+        stack.append(frame.slots[arg])
+
+      elif op == GLOBAL:
+        (symbol, scope) = consts[arg]
+        value = scope.get(symbol)
+        if value is None:
+          value = scope.lookup(symbol)
+          if value is None:
+            raise LispException("symbol \"%s\" is undefined" % symbol.value)
+        stack.append(value)
+
+      elif op == CONST:
+        stack.append(consts[arg])
+
+      elif op == DISPATCH:
+        func = stack[-1]
+        cls = func.__class__
+        if cls is Function or (cls is Primitive and func.apply is not None):
+          continue
+        stack.pop()
+        site = consts[arg]
+        if cls is Primitive and func.value not in special_forms:
+          stack.append(func.invoke(frame, site.forms))
+          pc = site.end
+          continue
+        if cls is not Primitive and cls is not Macro:
+          raise LispException("%s is not callable" % repr(func), site.sexp)
+        sub = site.specialise(self, frame, func)
+        if not site.tail:
+          calls.append((code, site.end, stack, frame))
+          if len(calls) > max_depth:
+            raise LispException("maximum call depth of %d exceeded" % max_depth)
+        code = sub
+        (ops, consts, pc, stack) = (code.ops, code.consts, 0, [])
+
+      elif op == CALL or op == TAILCALL:
+        if arg:
+          args = stack[-arg:]
+          del stack[-arg:]
+        else:
+          args = []
+        func = stack.pop()
+        if func.__class__ is Primitive:
+          value = func.apply(frame, args)
+          if op == CALL:
+            stack.append(value)
+            continue
+          if not calls:
+            return value
+          (code, pc, stack, frame) = calls.pop()
+          (ops, consts) = (code.ops, code.consts)
+          stack.append(value)
+          continue
+        if op == CALL:
+          calls.append((code, pc, stack, frame))
+          if len(calls) > max_depth:
+            raise LispException("maximum call depth of %d exceeded" % max_depth)
+        frame = bind(func, args)
+        try:
+          code = func.bytecode
+        except AttributeError:
+          code = self.code(func)
+        (ops, consts, pc, stack) = (code.ops, code.consts, 0, [])
+
+      elif op == RETURN:
+        value = stack.pop()
+        if not calls:
+          return value
+        (code, pc, stack, frame) = calls.pop()
+        (ops, consts) = (code.ops, code.consts)
+        stack.append(value)
+
+      elif op == TEST:
+        value = stack.pop()
+        if value is true:
+          continue
+        if value is false:
+          pc = arg
+          continue
+        raise LispException("expr %s does not evaluate to a boolean" %
+                            repr(code.forms[pc - 2]))
+
+      elif op == JUMP:
+        pc = arg
+
+      elif op == POP:
+        stack.pop()
+
+      elif op == PARENT:
+        stack.append(frame.parent.slots[arg])
+
+      elif op == GUARD:
+        (symbol, scope, prim, site) = consts[arg]
+        value = scope.get(symbol)
+        if value is prim:
+          continue
+        if value is None:
+          value = scope.lookup(symbol)
+          if value is prim:
+            continue
+          if value is None:
+            raise LispException("symbol \"%s\" is undefined" % symbol.value)
+        stack.append(site.slow(self, frame, value))
+        pc = site.end
+
+      elif op == SELF:
+        stack.append(frame.callable)
+
+      elif op == OUTER:
+        scope = frame
+        for n in xrange(arg >> 16):
+          scope = scope.parent
+        stack.append(scope.slots[arg & 0xffff])
+
+      elif op == CLOSURE:
+        (make, sig, body, p, sub) = consts[arg]
+        func = make(sig, body, frame)
+        func.params = p
+        func.bytecode = sub
+        stack.append(func)
+
+      elif op == DEFINE:
+        stack.append(self.rt.define(consts[arg], stack.pop(), frame))
+
+      elif op == BUILD:
+        splices = consts[arg]
+        values = stack[-len(splices):]
+        del stack[-len(splices):]
+        out = []
+        for (splice, value) in zip(splices, values):
+          if splice:
+            out.extend(value)
+          else:
+            out.append(value)
+        stack.append(types.mklist(out))
+
+      elif op == COLLECTION:
+        (coll, n) = consts[arg]
+        values = iter(stack[len(stack) - n:])
+        del stack[len(stack) - n:]
+        stack.append(coll.map_forms(lambda form: next(values)))
+
+      else:
+        raise LispException("bad opcode %d" % op)
+
+def compile_template(compiler, asm, sexp, env):
+  "Compile a quoted form, evaluating its unquotes like Primitives._unquote."
+  if not has_unquote(sexp):
+    asm.emit(CONST, asm.const(sexp))
+    return
+  if types.is_symbol(sexp.car) and sexp.car.value == "unquote":
+    compiler.compile(asm, sexp.cdr.car, env)
+    return
+  splices = []
+  for el in sexp:
+    if types.is_list(el) and not types.is_nil(el) and \
+          types.is_symbol(el.car) and el.car.value == "unquote-splice":
+      compiler.compile(asm, el.cdr.car, env)
+      splices.append(True)
+    else:
+      compile_template(compiler, asm, el, env)
+      splices.append(False)
+  asm.emit(BUILD, asm.const(tuple(splices)))
+
+@special("quote")
+def compile_quote(compiler, asm, prim, forms, env, tail):
+  (sexp,) = check(compiler, prim, forms)
+  compile_template(compiler, asm, sexp, env)
+
+@special("cond")
+def compile_cond(compiler, asm, prim, forms, env, tail):
+  for i in xrange(len(forms)):
+    sexp = forms[i]
+    if not types.is_list(sexp):
+      raise LispException("argument %d of cond must be list, is %s" %
+                          (i + 1, types.type_name(sexp)))
+    if types.is_nil(sexp) or types.is_nil(sexp.cdr):
+      raise LispException("argument %d of cond must have a length of >= 2" % (i + 1))
+
+  ends = []
+  for rule in forms:
+    compiler.compile(asm, rule.car, env)
+    test = asm.emit(TEST)
+    asm.forms[test] = rule.car
+    compiler.sequence(asm, list(rule.cdr), env, tail)
+    ends.append(asm.emit(JUMP))
+    asm.patch(test, asm.label())
+  asm.emit(CONST, asm.const(types.nil))
+  for end in ends:
+    asm.patch(end, asm.label())
+
+def compile_closure(compiler, asm, prim, forms, env, make):
+  (sig, body) = check(compiler, prim, forms)
+  sig = list(sig)
+  for arg in sig:
+    if not types.is_symbol(arg):
+      raise LispException("argument 1 of lambda must be a list of symbols, found %s" % types.type_name(arg))
+  p = Params(sig)
+  code = compiler.body(body, Env(p.index, env))
+  asm.emit(CLOSURE, asm.const((make, sig, types.mklist(body), p, code)))
+
+@special("lambda")
+def compile_lambda(compiler, asm, prim, forms, env, tail):
+  compile_closure(compiler, asm, prim, forms, env, types.mkfunc)
+
+@special("macro")
+def compile_macro(compiler, asm, prim, forms, env, tail):
+  compile_closure(compiler, asm, prim, forms, env, types.mkmacro)
+
+@special("define")
+def compile_define(compiler, asm, prim, forms, env, tail):
+  (symbol, value) = check(compiler, prim, forms)
+  compiler.compile(asm, value, env)
+  asm.emit(DEFINE, asm.const(symbol))
+
+@special("recur")
+def compile_recur(compiler, asm, prim, forms, env, tail):
+  # As with the closure compiler, recur is a call of the current
+  # function, which is a loop when in tail position.
+  asm.emit(SELF)
+  for form in forms:
+    compiler.compile(asm, form, env)
+  asm.emit(TAILCALL if tail else CALL, len(forms))
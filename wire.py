@@ -0,0 +1,274 @@
+## wire.py -- Sending Lisp values to other processes
+
+# Values are flattened into a program for a little stack machine, a
+# flat list of opcodes each followed by one argument, which marshal
+# turns into bytes far faster than pickle would walk the cells and
+# objects themselves. Encoding and decoding are iterative, so a list
+# can be as long as memory allows.
+#
+# Functions are sent as their parameters, their body and the bindings
+# of the variables free in it. Bindings in local frames go with the
+# function that closes over them; global definitions are sent once per
+# message, unless the receiver is known to have the same definition
+# already (see Standard). Atoms, refs and the like are bound to the
+# process that made them and can't be sent at all.
+
+import marshal
+from decimal import Decimal
+from fractions import Fraction
+import lisptypes as types
+from errors import LispException
+from scope import Scope, Frame
+from primitives.kanren import Var
+
+class Standard(object):
+  """
+  The global definitions a receiving runtime starts out with, which
+  needn't be sent: those of a runtime with rt.loli loaded, say.
+  """
+
+  def __init__(self, ns):
+    self.ns = dict(ns)
+    self.known = {}
+
+  def has(self, symbol, value):
+    "True if the receiver has value defined as symbol already."
+    std = self.ns.get(symbol)
+    if std is None:
+      return False
+    if std is value:
+      return True
+    if std.__class__ is not value.__class__:
+      return False
+    if types.is_primitive(value):
+      return std.value == value.value
+    if not (types.is_function(value) or types.is_macro(value)):
+      return False
+    known = self.known.get(id(value))
+    if known is None or known[0] is not value:
+      same = std.sig == value.sig and std.value == value.value
+      known = self.known[id(value)] = (value, same)
+    return known[1]
+
+def free_symbols(func):
+  "Every symbol in the body of func, other than its parameters."
+  params = set(func.sig)
+  found = set()
+  stack = [func.value]
+  while stack:
+    form = stack.pop()
+    if form.__class__ is types.ConsCell:
+      if form is not types.nil:
+        stack.append(form.car)
+        stack.append(form.cdr)
+    elif form.__class__ is types.Symbol:
+      if form not in params:
+        found.add(form)
+    elif types.is_collection(form):
+      stack.extend(form.forms())
+  return found
+
+def resolve(scope, symbol):
+  """
+  Find symbol from scope, returning (local, value): local is true if it
+  is bound in a frame or a scope of captured variables, false if it is
+  a global definition. value is None if it's unbound.
+  """
+  while scope.__class__ is Frame:
+    i = scope.index.get(symbol)
+    if i is not None:
+      return (True, scope.slots[i])
+    scope = scope.parent
+  while scope is not None:
+    value = scope.get(symbol)
+    if value is not None:
+      return (scope.parent is not None, value)
+    scope = scope.parent
+  return (False, None)
+
+class Encoder(object):
+  def __init__(self, standard):
+    self.standard = standard
+    self.functions = []
+    self.function_ids = {}
+    self.globals = []
+    self.global_names = set()
+    self.vars = {}
+
+  def function(self, func):
+    "The index of func in the message, adding it the first time it's seen."
+    i = self.function_ids.get(id(func))
+    if i is not None:
+      return i
+    i = self.function_ids[id(func)] = len(self.functions)
+    entry = ["M" if types.is_macro(func) else "F", None, None, None]
+    self.functions.append(entry)
+    entry[1] = self.encode(types.mklist(func.sig))
+    entry[2] = self.encode(func.value)
+    captured = []
+    for symbol in free_symbols(func):
+      (local, value) = resolve(func.scope, symbol)
+      if value is None:
+        continue
+      if local:
+        captured.append((symbol.value, value))
+      else:
+        self.add_global(symbol, value)
+    entry[3] = [(name, self.encode(value)) for (name, value) in captured]
+    return i
+
+  def add_global(self, symbol, value):
+    if symbol in self.global_names or self.standard.has(symbol, value):
+      return
+    self.global_names.add(symbol)
+    self.globals.append((symbol.value, self.encode(value)))
+
+  def encode(self, value):
+    ops = []
+    stack = [(False, value)]
+    while stack:
+      (literal, value) = stack.pop()
+      if literal:
+        ops.extend(value)
+        continue
+      cls = value.__class__
+      if cls is types.ConsCell:
+        if value is types.nil:
+          ops.extend(("0", 0))
+          continue
+        items = []
+        while value.__class__ is types.ConsCell and value is not types.nil:
+          items.append(value.car)
+          value = value.cdr
+        if value is types.nil:
+          stack.append((True, ("l", len(items))))
+        else:
+          stack.append((True, (".", len(items))))
+          stack.append((False, value))
+        stack.extend((False, item) for item in reversed(items))
+      elif cls is types.Symbol:
+        ops.extend(("y", value.value))
+      elif cls is types.Number:
+        n = value.value
+        if isinstance(n, Decimal):
+          ops.extend(("d", str(n)))
+        elif isinstance(n, Fraction):
+          ops.extend(("r", str(n)))
+        else:
+          ops.extend(("n", n))
+      elif cls is types.String:
+        ops.extend(("s", value.value))
+      elif cls is types.Primitive:
+        ops.extend(("p", value.value))
+      elif cls is types.Function or cls is types.Macro:
+        ops.extend(("f", self.function(value)))
+      elif cls is Var:
+        i = self.vars.setdefault(id(value), (len(self.vars), value))[0]
+        stack.append((True, ("x", i)))
+        stack.append((False, value.value))
+      elif types.is_collection(value):
+        if types.is_map(value):
+          (op, forms) = ("m", list(value.forms()))
+        else:
+          (op, forms) = ("v" if types.is_vector(value) else "S", list(value))
+        stack.append((True, (op, len(forms))))
+        stack.extend((False, form) for form in reversed(forms))
+      else:
+        raise LispException("%s can't be sent to another process" %
+                            types.type_name(value))
+    return ops
+
+def pack(values, standard):
+  """
+  Encode a list of values to bytes, with the functions they include and
+  the global definitions those need that standard lacks. Only the
+  bodies of functions are searched for free variables: to evaluate
+  forms remotely, send a function of no arguments with them as its body.
+  """
+  encoder = Encoder(standard)
+  encoded = [encoder.encode(value) for value in values]
+  return marshal.dumps((encoder.functions, encoder.globals, encoded))
+
+class Decoder(object):
+  def __init__(self, primitives):
+    self.primitives = primitives
+    self.functions = []
+    self.vars = {}
+
+  def decode(self, ops):
+    stack = []
+    for i in xrange(0, len(ops), 2):
+      (op, arg) = (ops[i], ops[i + 1])
+      if op == "y":
+        stack.append(types.mksymbol(arg))
+      elif op == "n":
+        stack.append(types.Number(arg))
+      elif op == "d":
+        stack.append(types.Number(Decimal(arg)))
+      elif op == "r":
+        stack.append(types.Number(Fraction(arg)))
+      elif op == "s":
+        stack.append(types.String(arg))
+      elif op == "0":
+        stack.append(types.nil)
+      elif op == "l" or op == ".":
+        tail = stack.pop() if op == "." else types.nil
+        items = stack[len(stack) - arg:]
+        del stack[len(stack) - arg:]
+        out = types.ListBuilder()
+        for item in items:
+          out.append(item)
+        stack.append(out.build(tail))
+      elif op == "p":
+        if arg not in self.primitives:
+          raise LispException("primitive %s is undefined here" % arg)
+        stack.append(self.primitives[arg])
+      elif op == "f":
+        stack.append(self.functions[arg])
+      elif op == "x":
+        name = stack.pop()
+        var = self.vars.get(arg)
+        if var is None:
+          var = self.vars[arg] = Var(name)
+        stack.append(var)
+      elif op in ("v", "S", "m"):
+        items = stack[len(stack) - arg:]
+        del stack[len(stack) - arg:]
+        if op == "v":
+          stack.append(types.mkvector(items))
+        elif op == "S":
+          stack.append(types.mkset(items))
+        else:
+          stack.append(types.mkmap(zip(items[0::2], items[1::2])))
+      else:
+        raise LispException("bad opcode %s in message" % repr(op))
+    return stack[0]
+
+def unpack(data, rt):
+  """
+  Decode a list of values packed by pack. Global definitions sent with
+  them are made in a new namespace over rt's, so they don't disturb it.
+  """
+  (functions, definitions, encoded) = marshal.loads(data)
+  decoder = Decoder(rt.prims)
+  define(decoder, functions, definitions, Scope(parent = rt.ns))
+  return [decoder.decode(ops) for ops in encoded]
+
+def define(decoder, functions, definitions, ns):
+  """
+  Make the functions of a message for decoder, and the global
+  definitions it carries in ns, which the functions close over.
+  """
+  for (kind, sig, body, captured) in functions:
+    make = types.mkmacro if kind == "M" else types.mkfunc
+    decoder.functions.append(make(list(decoder.decode(sig)),
+                                  decoder.decode(body), None))
+  for (name, ops) in definitions:
+    ns.define(name, decoder.decode(ops))
+  for (func, (kind, sig, body, captured)) in zip(decoder.functions, functions):
+    if captured:
+      func.scope = Scope(parent = ns)
+      for (name, ops) in captured:
+        func.scope.define(name, decoder.decode(ops))
+    else:
+      func.scope = ns
@@ -0,0 +1,226 @@
+## workers.py -- A bounded pool of worker threads
+
+import threading, time, os, Queue, atexit
+
+def default_size():
+  """
+  The pool size given by $LOLISP_POOL_SIZE, or else a few more
+  threads than there are CPUs, as futures spend much of their time
+  blocked rather than computing.
+  """
+  size = os.environ.get("LOLISP_POOL_SIZE")
+  if size:
+    return int(size)
+  try:
+    import multiprocessing
+    return min(32, multiprocessing.cpu_count() + 4)
+  except NotImplementedError:
+    return 8
+
+class Task(object):
+  """
+  A call of fn, queued for a worker. Whichever thread gets to it
+  first runs it: a pool worker, or a thread waiting for its result,
+  which runs it itself rather than block on a task nobody has started.
+  """
+  __slots__ = ("pool", "fn", "running", "queued", "value", "error", "done")
+
+  def __init__(self, pool, fn):
+    self.pool = pool
+    self.fn = fn
+    self.running = False
+    self.queued = time.time()
+    self.value = None
+    self.error = None
+    self.done = threading.Event()
+
+  def run(self):
+    "Run the task here, unless another thread has taken it already."
+    if not self.pool.claim(self):
+      return
+    started = time.time()
+    try:
+      self.value = self.fn()
+    except Exception as e:
+      self.error = e
+    self.pool.record(started)
+    self.done.set()
+
+  def cancel(self):
+    "Keep the task from running, unless some thread has started it already."
+    if not self.pool.cancel(self):
+      return False
+    self.done.set()
+    return True
+
+  def result(self):
+    "Wait for the task, and return its value or raise its exception."
+    self.run()
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+class Pool(object):
+  """
+  Runs tasks on at most size threads, started as they are needed.
+  Submitting blocks while queue_size tasks are already waiting, except
+  from a worker, which runs the task itself instead: a worker blocked
+  on a full queue might be the one that would have drained it.
+  """
+
+  def __init__(self, size = None, queue_size = None):
+    self.size = size or default_size()
+    if self.size < 1:
+      raise ValueError("pool size must be at least 1, was %d" % self.size)
+    if queue_size is None:
+      queue_size = self.size * 64
+    self.queue = Queue.Queue(queue_size)
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.workers = 0
+    self.threads = []
+    self.idle = 0
+    self.stopping = False
+    self.submitted = 0
+    self.started = 0
+    self.completed = 0
+    self.cancelled = 0
+    self.max_queued = 0
+    self.wait_time = 0.0
+    self.run_time = 0.0
+
+  def submit(self, fn):
+    task = Task(self, fn)
+    with self.lock:
+      self.submitted += 1
+      if self.idle == 0 and self.workers < self.size:
+        self.workers += 1
+        worker = threading.Thread(target = self.work)
+        self.threads.append(worker)
+        worker.daemon = True
+        worker.start()
+    if getattr(self.local, "worker", False):
+      try:
+        self.queue.put_nowait(task)
+      except Queue.Full:
+        task.run()
+    else:
+      self.queue.put(task)
+    with self.lock:
+      self.max_queued = max(self.max_queued,
+                            self.submitted - self.started - self.cancelled)
+    return task
+
+  def work(self):
+    self.local.worker = True
+    while True:
+      with self.lock:
+        self.idle += 1
+      try:
+        task = self.queue.get_nowait() if self.stopping else self.queue.get()
+      except Queue.Empty:
+        task = None
+      with self.lock:
+        self.idle -= 1
+      if task is None:
+        return
+      task.run()
+
+  def shutdown(self, timeout = None):
+    """
+    Stop the workers once they have run the tasks already queued,
+    waiting up to timeout seconds in all for them to finish. This never
+    blocks on a full queue: workers that find the queue empty once the
+    pool is stopping exit, whether or not their None got into it.
+    """
+    with self.lock:
+      (stopping, self.workers) = (self.workers, 0)
+      self.stopping = True
+    for i in xrange(stopping):
+      try:
+        self.queue.put_nowait(None)
+      except Queue.Full:
+        break
+    if timeout is not None:
+      self.join(timeout)
+
+  def join(self, timeout):
+    "Wait up to timeout seconds in all for stopped workers to exit."
+    deadline = time.time() + timeout
+    for thread in self.threads:
+      thread.join(max(0, deadline - time.time()))
+
+  def claim(self, task):
+    with self.lock:
+      if task.running:
+        return False
+      task.running = True
+      self.started += 1
+      self.wait_time += time.time() - task.queued
+      return True
+
+  def cancel(self, task):
+    with self.lock:
+      if task.running:
+        return False
+      task.running = True
+      self.cancelled += 1
+      return True
+
+  def record(self, started):
+    with self.lock:
+      self.completed += 1
+      self.run_time += time.time() - started
+
+  def stats(self):
+    "Counts of threads and tasks, and the mean seconds tasks spent queued and running."
+    with self.lock:
+      return {
+        "size": self.size,
+        "workers": self.workers,
+        "idle": self.idle,
+        "queued": self.submitted - self.started - self.cancelled,
+        "max-queued": self.max_queued,
+        "submitted": self.submitted,
+        "started": self.started,
+        "completed": self.completed,
+        "cancelled": self.cancelled,
+        "mean-wait": self.wait_time / self.started if self.started else 0.0,
+        "mean-run": self.run_time / self.completed if self.completed else 0.0,
+        }
+
+shared_pool = None
+shared_lock = threading.Lock()
+# Pools configure has replaced, whose workers may still be finishing.
+retired = []
+
+def configure(size = None, queue_size = None):
+  "Replace the shared pool, for tasks submitted from now on."
+  global shared_pool
+  with shared_lock:
+    if shared_pool is not None:
+      shared_pool.shutdown()
+      retired.append(shared_pool)
+    shared_pool = Pool(size, queue_size)
+  return shared_pool
+
+def shared():
+  "The pool futures run on, created on first use."
+  global shared_pool
+  with shared_lock:
+    if shared_pool is None:
+      shared_pool = Pool()
+    return shared_pool
+
+@atexit.register
+def shutdown():
+  # Daemon workers left blocked on the queue as the interpreter
+  # shuts down die noisily, so they are stopped first.
+  with shared_lock:
+    if shared_pool is not None:
+      shared_pool.shutdown()
+      retired.append(shared_pool)
+    deadline = time.time() + 1
+    for pool in retired:
+      pool.join(max(0, deadline - time.time()))